@@ -6,6 +6,7 @@ from django.contrib import messages
 from django.shortcuts import redirect
 
 from mlarchive.archive.tasks import update_mbox
+from mlarchive.archive.thread_cache import defer_generation
 
 import logging
 logger = logging.getLogger(__name__)
@@ -41,7 +42,8 @@ def remove_selected(request, queryset):
         logger.info('User %s removed message [list=%s,hash=%s,msgid=%s,pk=%s]' %
                     (request.user, message.email_list, message.hashcode, message.msgid, message.pk))
     mbox_updates = get_mbox_updates(queryset)
-    queryset.delete()
+    with defer_generation():
+        queryset.delete()
     update_mbox.delay(mbox_updates)
     if not is_ajax(request):
         messages.success(request, '%d Message(s) Removed' % count)
@@ -1,10 +1,15 @@
 from django.contrib import admin
 from mlarchive.archive.models import Message, EmailList, Attachment, Thread
+from mlarchive.archive.thread_cache import defer_generation
 
 
 class MessageAdmin(admin.ModelAdmin):
     raw_id_fields = ('email_list', 'in_reply_to', 'thread')
 
+    def delete_queryset(self, request, queryset):
+        with defer_generation():
+            super(MessageAdmin, self).delete_queryset(request, queryset)
+
 
 class EmailListAdmin(admin.ModelAdmin):
     ordering = ['name']
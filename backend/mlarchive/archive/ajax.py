@@ -8,7 +8,8 @@ from django.utils.cache import add_never_cache_headers, patch_cache_control
 from mlarchive.archive import actions
 from mlarchive.archive.utils import jsonapi
 from mlarchive.archive.models import Message
-from mlarchive.archive.query_utils import get_cached_query, get_order_fields, get_qdr_kwargs
+from mlarchive.archive.query_utils import (get_cached_query, get_order_fields, get_qdr_kwargs,
+    get_cursor_body, decode_cursor, execute_search_after)
 from mlarchive.utils.decorators import check_access, superuser_only, check_ajax_list_access
 
 
@@ -58,11 +59,13 @@ def ajax_messages(request):
     '''Ajax function to retrieve more messages from queryset.
     referenceitem: index of the last/first message displayed
     referenceid: message.pk of last/first message displayed
+    cursor: paging cursor of last/first message displayed, see encode_cursor()
     '''
     qid = request.GET.get('qid')
     browselist = request.GET.get('browselist')
     referenceitem = int(request.GET.get('referenceitem', 0))
     referenceid = request.GET.get('referenceid')
+    cursor = request.GET.get('cursor')
     direction = request.GET.get('direction')
     gbt = request.GET.get('gbt')
     order_fields = get_order_fields(request.GET, use_db=True)
@@ -73,7 +76,7 @@ def ajax_messages(request):
         queryid, query = get_cached_query(request)
         if not query:
             return HttpResponse(status=404)
-        results = get_query_results(query, referenceitem, direction)
+        results = get_query_results(query, referenceitem, direction, cursor=cursor)
 
     elif browselist:
         # if browselist and special order fields
@@ -98,11 +101,18 @@ def ajax_messages(request):
         'browse_list': browselist})
 
 
-def get_query_results(query, referenceitem, direction):
+def get_query_results(query, referenceitem, direction, cursor=None):
     '''Returns a set of messages from query using direction: next or previous
-    from the referenceitem, which is the 1 based index of the query
+    from the referenceitem, which is the 1 based index of the query.  If the
+    cursor of the reference message is given the messages are fetched with
+    search_after, which costs the same at any depth
     '''
     buffer = settings.SEARCH_SCROLL_BUFFER_SIZE
+    if cursor and direction in ('next', 'previous'):
+        body = get_cursor_body(query, buffer)
+        sort_values = decode_cursor(cursor, body)
+        if sort_values is not None:
+            return execute_search_after(body, sort_values, reverse=direction == 'previous')
     if direction == 'next':
         query = query[referenceitem:referenceitem + buffer]
         return query.execute()
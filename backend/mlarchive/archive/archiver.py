@@ -0,0 +1,260 @@
+'''This module contains a long-running archiver process.  Rather than start the
+interpreter, setup Django and import the ORM / Elasticsearch stack for every message
+delivered by Mailman, the archiver keeps all of this loaded and accepts messages on a
+local Unix socket.  bin/archive-mail.py acts as a thin client and falls back to
+archiving in-process if the archiver is not running.
+
+Protocol (one message per connection):
+
+client: a single line JSON header, ie. {"listname": "acme", "private": false}
+        followed by the raw message bytes.  The client then shuts down the
+        write side of the socket.
+server: the archive_message() exit status as a line of ASCII, ie. "0\\n"
+
+The archiver keeps the duplicate filter, see bloom.py, loaded so most deliveries
+skip the duplicate message queries, and the thread cache, see thread_cache.py,
+enabled so replies are threaded without a query per referenced message.
+
+With a spool, see spool.py, the status is sent once the message is written to disk,
+and a drainer thread archives spooled messages in the order received.  If the
+database is unavailable the drainer keeps the messages and retries with a growing
+delay.  While the spool is over its high water mark deliveries wait for it to drain.
+
+Run with: manage.py archiver [--socket PATH] [--no-spool]
+'''
+
+import email
+import json
+import os
+import socketserver
+import threading
+import time
+
+from django.conf import settings
+from django.db import connection, InterfaceError, OperationalError
+
+from mlarchive.archive.bloom import duplicate_filter
+from mlarchive.archive.inspectors import inspector_pipeline
+from mlarchive.archive.mail import archive_message, save_failed_msg
+from mlarchive.archive.thread_cache import thread_cache
+
+import logging
+logger = logging.getLogger(__name__)
+
+STATUS_ERROR = 1
+RETRY_ERRORS = (OperationalError, InterfaceError)
+MAX_ATTEMPTS = 5            # attempts of a message while the database is reachable
+RETRY_DELAY = 5             # seconds, doubled after each failed attempt
+MAX_RETRY_DELAY = 300
+POLL_INTERVAL = 10          # seconds, check for entries spooled by another process
+SPOOL_FULL_WAIT = 60        # seconds a delivery waits for a full spool to drain
+
+
+# --------------------------------------------------
+# Helper Functions
+# --------------------------------------------------
+
+
+def ensure_connection():
+    """The archiver holds its database connection open between messages.  If the
+    connection has gone away, ie. MySQL wait_timeout, close it so Django reconnects
+    on the next query.
+    """
+    if connection.connection is not None and not connection.is_usable():
+        logger.info('archiver: database connection unusable, reconnecting')
+        connection.close()
+
+
+def is_database_available():
+    try:
+        connection.ensure_connection()
+    except RETRY_ERRORS:
+        return False
+    return True
+
+
+def read_request(rfile):
+    """Read one request from file-like object rfile.  Returns tuple of
+    (listname, private, data).  Raises ValueError if the request is malformed.
+    """
+    header = rfile.readline()
+    try:
+        options = json.loads(header.decode('utf8'))
+        listname = options['listname']
+    except (UnicodeDecodeError, ValueError, TypeError, KeyError):
+        raise ValueError('Invalid request header: {}'.format(header[:100]))
+    if not listname:
+        raise ValueError('Invalid request header: missing listname')
+    data = rfile.read()
+    if not data:
+        raise ValueError('Invalid request: no message data')
+    return listname, bool(options.get('private', False)), data
+
+
+# --------------------------------------------------
+# Classes
+# --------------------------------------------------
+
+
+class ArchiveRequestHandler(socketserver.StreamRequestHandler):
+    """Handles a single message delivery"""
+
+    def handle(self):
+        try:
+            listname, private, data = read_request(self.rfile)
+        except ValueError as error:
+            logger.error('archiver: {}'.format(error))
+            self.send_status(STATUS_ERROR)
+            return
+
+        logger.info('archiver: received message for {} ({} bytes)'.format(listname, len(data)))
+        logger.info('envelope: %s' % data.decode('utf8', errors='ignore').split('\n', 1)[0])
+        if self.server.spool is not None:
+            status = self.server.spool_message(data, listname, private)
+        else:
+            ensure_connection()
+            status = archive_message(data, listname, private=private)
+            logger.info('archive_message exit status: %s' % status)
+        self.send_status(status)
+
+    def send_status(self, status):
+        self.wfile.write('{}\n'.format(status).encode('ascii'))
+
+
+class SpoolDrainer(object):
+    """Archives the messages of a spool, oldest first.  run() drains the spool until
+    stopped, see start() and stop().  Messages are archived holding lock, shared with
+    the server.  Index updates that fail while Elasticsearch is unreachable are
+    retried by the signal processor, see IndexBuffer.
+    """
+
+    def __init__(self, spool, lock):
+        self.spool = spool
+        self.lock = lock
+        self.attempts = {}
+        self.wakeup = threading.Event()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def drain(self):
+        """Archive the spooled messages.  Returns the number of messages handled.
+        Raises one of RETRY_ERRORS if the database is unavailable, leaving the message
+        and those after it in the spool.
+        """
+        count = 0
+        for name in self.spool.names():
+            if self.stopped.is_set():
+                break
+            try:
+                listname, private, data = self.spool.get(name)
+            except ValueError as error:
+                logger.error('archiver: {}, moved {} aside'.format(error, name))
+                self.spool.set_aside(name)
+                continue
+            with self.lock:
+                self.archive(name, listname, private, data)
+            self.spool.remove(name)
+            count += 1
+        return count
+
+    def archive(self, name, listname, private, data):
+        ensure_connection()
+        try:
+            status = archive_message(data, listname, private=private, retry_on=RETRY_ERRORS)
+        except RETRY_ERRORS as error:
+            connection.close()
+            if not is_database_available():
+                raise
+            # the database is up, something about this message fails
+            attempts = self.attempts.get(name, 0) + 1
+            if attempts < MAX_ATTEMPTS:
+                self.attempts[name] = attempts
+                raise
+            logger.error('archiver: giving up on {} after {} attempts'.format(name, attempts))
+            self.attempts.pop(name, None)
+            save_failed_msg(email.message_from_bytes(data), listname, error)
+            return
+        self.attempts.pop(name, None)
+        logger.info('archive_message exit status: %s' % status)
+
+    def run(self):
+        delay = 0
+        while not self.stopped.is_set():
+            try:
+                self.drain()
+                delay = 0
+            except RETRY_ERRORS as error:
+                delay = min(delay * 2 or RETRY_DELAY, MAX_RETRY_DELAY)
+                logger.warning('archiver: database error, {} spooled, retry in {} sec [{}]'.format(
+                    len(self.spool), delay, error))
+            self.wakeup.wait(delay or POLL_INTERVAL)
+            self.wakeup.clear()
+        connection.close()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='spool-drainer', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.wakeup.set()
+        if self.thread:
+            self.thread.join()
+
+
+class ArchiveServer(socketserver.UnixStreamServer):
+    """Unix socket server which archives messages.  Requests are handled one at a
+    time, in the order received, so message threading sees the same ordering as
+    when each message was archived by a separate process.  With a spool, messages
+    are archived by a SpoolDrainer started by serve_forever().
+    """
+
+    def __init__(self, path=None, spool=None):
+        self.path = path or settings.ARCHIVER_SOCKET
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        super(ArchiveServer, self).__init__(self.path, ArchiveRequestHandler)
+        # the mail system delivers as a different user
+        os.chmod(self.path, 0o666)
+        duplicate_filter.load()
+        thread_cache.enable()
+        self.spool = spool
+        self.lock = threading.Lock()
+        self.drainer = SpoolDrainer(spool, self.lock) if spool is not None else None
+
+    def serve_forever(self, *args, **kwargs):
+        if self.drainer:
+            self.drainer.start()
+        super(ArchiveServer, self).serve_forever(*args, **kwargs)
+
+    def spool_message(self, data, listname, private):
+        """Write the message to the spool and wake the drainer.  Waits up to
+        SPOOL_FULL_WAIT while the spool is full.  If the spool can't be written
+        the message is archived now.  Returns the exit status
+        """
+        deadline = time.monotonic() + SPOOL_FULL_WAIT
+        while self.spool.is_full() and time.monotonic() < deadline:
+            time.sleep(1)
+        try:
+            name = self.spool.put(data, listname, private=private)
+        except OSError as error:
+            logger.error('archiver: spool write failed, archiving now [{}]'.format(error))
+            with self.lock:
+                ensure_connection()
+                return archive_message(data, listname, private=private)
+        logger.info('archiver: spooled {}'.format(name))
+        self.drainer.wakeup.set()
+        return 0
+
+    def server_close(self):
+        super(ArchiveServer, self).server_close()
+        if self.drainer:
+            self.drainer.stop()
+        thread_cache.disable()
+        for line in inspector_pipeline.report():
+            logger.info('inspector {}'.format(line))
+        if os.path.exists(self.path):
+            os.remove(self.path)
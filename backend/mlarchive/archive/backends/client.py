@@ -0,0 +1,101 @@
+'''The process wide Elasticsearch client, configured from settings.ELASTICSEARCH_CONNECTION.
+
+The client is thread safe and keeps a pool of persistent (keep-alive) HTTP connections
+per node, so searches and index updates reuse connections rather than setting up a
+new pool each time.  Options in the "KWARGS" entry of the setting are passed to
+Elasticsearch(), over DEFAULT_CLIENT_KWARGS, ie. "maxsize" the number of connections
+kept per node.
+
+A client created before a fork, ie. by a pre-forking web server or Celery worker, is
+replaced in the child, so processes don't share sockets.
+'''
+import os
+import threading
+import time
+
+from elasticsearch import Elasticsearch, TransportError
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+import logging
+logger = logging.getLogger(__name__)
+
+DEFAULT_CLIENT_KWARGS = {
+    'maxsize': 10,
+    'timeout': 30,
+    'retry_on_timeout': True,
+}
+
+_lock = threading.Lock()
+_client = None
+_client_pid = None
+_clients_created = 0
+
+
+def get_client():
+    '''Returns the shared Elasticsearch client'''
+    global _client, _client_pid, _clients_created
+    pid = os.getpid()
+    if _client is None or _client_pid != pid:
+        with _lock:
+            if _client is None or _client_pid != pid:
+                _client = create_client()
+                _client_pid = pid
+                _clients_created += 1
+    return _client
+
+
+def create_client():
+    connection_options = settings.ELASTICSEARCH_CONNECTION
+    if 'URL' not in connection_options:
+        raise ImproperlyConfigured("You must specify a 'URL' in your settings for connection Elasticsearch.")
+    kwargs = dict(DEFAULT_CLIENT_KWARGS)
+    kwargs.update(connection_options.get('KWARGS', {}))
+    logger.debug('creating Elasticsearch client pid:{}'.format(os.getpid()))
+    return Elasticsearch(connection_options['URL'], **kwargs)
+
+
+def reset_client():
+    '''Discard the shared client, the next get_client() creates a new one'''
+    global _client, _client_pid
+    with _lock:
+        client, _client, _client_pid = _client, None, None
+    if client is not None:
+        client.transport.close()
+
+
+def get_client_stats():
+    '''Returns dictionary describing the shared client and its connection pools.
+    Doesn't contact the cluster
+    '''
+    stats = {'pid': os.getpid(), 'clients_created': _clients_created, 'nodes': []}
+    if _client is None or _client_pid != os.getpid():
+        return stats
+    connection_pool = _client.transport.connection_pool
+    # a single node uses DummyConnectionPool, which doesn't track dead nodes
+    dead = getattr(connection_pool, 'dead', None)
+    stats['dead_nodes'] = dead.qsize() if dead is not None else 0
+    for connection in connection_pool.connections:
+        pool = getattr(connection, 'pool', None)
+        stats['nodes'].append({
+            'host': connection.host,
+            'maxsize': getattr(getattr(pool, 'pool', None), 'maxsize', None),
+            'connections': getattr(pool, 'num_connections', None),
+            'requests': getattr(pool, 'num_requests', None),
+        })
+    return stats
+
+
+def check_health():
+    '''Returns dictionary of cluster health: "status" (green, yellow, red or
+    unavailable), "elapsed" the round trip in milliseconds, and the client stats
+    '''
+    start = time.perf_counter()
+    try:
+        status = get_client().cluster.health(request_timeout=5)['status']
+    except TransportError as error:
+        logger.warning('Elasticsearch health check failed [{}]'.format(error))
+        status = 'unavailable'
+    result = {'status': status, 'elapsed': round((time.perf_counter() - start) * 1000, 1)}
+    result.update(get_client_stats())
+    return result
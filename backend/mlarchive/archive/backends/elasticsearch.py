@@ -1,41 +1,66 @@
+import copy
+import datetime
+import functools
 import logging
 import re
 import six
+import threading
+import time
 
-from elasticsearch import Elasticsearch, TransportError
-from elasticsearch.helpers import bulk
+from elasticsearch import ConnectionError as ESConnectionError, TransportError
+from elasticsearch.helpers import BulkIndexError, bulk
 from elasticsearch_dsl import Search, A, Q
 
 from django.conf import settings
 from django.core.cache import cache
 from django.core.exceptions import ImproperlyConfigured
+from django.urls import get_script_prefix, reverse
 from django.utils.encoding import force_str
 
+from mlarchive.archive.backends.client import get_client
 from mlarchive.archive.query_utils import (queries_from_params,
-    filters_from_params, get_order_fields, generate_queryid, parse_query)
-from mlarchive.archive.utils import get_noauth
+    filters_from_params, get_order_fields, generate_queryid, parse_query, SORT_TIEBREAKER,
+    invalidate_search_cache_after_update)
+from mlarchive.archive.text_cache import get_text
+from mlarchive.archive.utils import get_noauth, get_private_list_ids, get_private_lists_for_user
+from mlarchive.utils.batch import BatchBuffer
 
 logger = logging.getLogger(__name__)
+# related objects used by full_prepare()
+PREPARE_RELATED = ('email_list', 'thread')
+BUILD_INDEX_KEY = 'elasticsearch_build_index'
+BUILD_INDEX_CHECK_INTERVAL = 10     # seconds
+BUILD_INDEX_TIMEOUT = 7 * 24 * 3600
+UPDATE_PRIVATE_RETRIES = 3
+UPDATE_PRIVATE_TIMEOUT = 300     # seconds
+PRIVATE_PENDING_KEY = 'elasticsearch_private_pending'
+PRIVATE_PENDING_LOCK_KEY = 'elasticsearch_private_pending_lock'
+PRIVATE_PENDING_LOCK_TIMEOUT = 10
+_build_index = {'name': None, 'checked': 0}
 IDENTIFIER_REGEX = re.compile('^[\w\d_]+\.[\w\d_]+\.[\w\d-]+$')
 
 
 def full_prepare(message):
     '''Takes database Message object and returns dictionary for index update.
-    For dates use isoformat().'''
+    For dates use isoformat().  To index many messages without a query per message,
+    load them with select_related('email_list', 'thread'), see PREPARE_RELATED.'''
     logger.debug('full_prepare pk:{}'.format(message.pk))
+    list_name = message.email_list.name
     prepared_data = {
         'id': 'archive.message.' + force_str(message.pk),
         'django_ct': 'archive.message',
         'django_id': force_str(message.pk),
     }
-    prepared_data['text'] = '\n'.join([message.subject, message.get_body()])
+    prepared_data['text'] = '\n'.join([message.subject, get_text(message)])
     prepared_data['date'] = message.date.isoformat()
-    prepared_data['email_list'] = message.email_list.name
-    prepared_data['email_list_exact'] = message.email_list.name
+    prepared_data['email_list'] = list_name
+    prepared_data['email_list_exact'] = list_name
     prepared_data['frm'] = message.frm
     prepared_data['frm_name'] = message.frm_name
     prepared_data['frm_name_exact'] = message.frm_name
     prepared_data['msgid'] = message.msgid
+    prepared_data['private'] = message.email_list.private
+    prepared_data['acl_token'] = get_acl_token(message.email_list_id)
     prepared_data['subject'] = message.subject
     prepared_data['subject_base'] = message.base_subject
     prepared_data['thread_date'] = message.thread_date
@@ -43,11 +68,18 @@ def full_prepare(message):
     prepared_data['thread_depth'] = message.thread_depth
     prepared_data['thread_order'] = message.thread_order
     prepared_data['spam_score'] = message.spam_score
-    prepared_data['url'] = message.get_absolute_url()
+    prepared_data['url'] = get_url_prefix(get_script_prefix(), list_name) + message.hashcode.rstrip('=') + '/'
 
     return prepared_data
 
 
+@functools.lru_cache(maxsize=None)
+def get_url_prefix(script_prefix, list_name):
+    '''Returns the start of the detail URL of messages in the list, the same as
+    Message.get_absolute_url() up to the message id, without a reverse() per message'''
+    return reverse('archive_detail', kwargs={'list_name': list_name, 'id': 'ID'})[:-len('ID/')]
+
+
 class ESBackend():
     """Elasticsearch Backend"""
     
@@ -104,7 +136,7 @@ class ESBackend():
         }
     }
 
-    def __init__(self):
+    def __init__(self, index_name=None):
         connection_options = settings.ELASTICSEARCH_CONNECTION
         if 'URL' not in connection_options:
             raise ImproperlyConfigured("You must specify a 'URL' in your settings for connection Elasticsearch.")
@@ -112,10 +144,8 @@ class ESBackend():
         if 'INDEX_NAME' not in connection_options:
             raise ImproperlyConfigured("You must specify a 'INDEX_NAME' in your settings for connection Elasticsearch.")
 
-        self.client = Elasticsearch(
-            connection_options['URL'],
-            **connection_options.get('KWARGS', {}))
-        self.index_name = connection_options['INDEX_NAME']
+        self.client = get_client()
+        self.index_name = index_name or connection_options['INDEX_NAME']
         self.log = logging.getLogger(__name__)
         self.mapping = settings.ELASTICSEARCH_INDEX_MAPPINGS
         self.setup_complete = False
@@ -123,26 +153,83 @@ class ESBackend():
 
     def setup(self):
         """
-        If the index doesn't exist, create it and set mappings. You can't
-        change mappings of existing indexes.
+        If the index doesn't exist, create a versioned index with the mappings
+        and point index_name, an alias, at it.  You can't change mappings of
+        existing indexes, rebuild_index builds a new index and swaps the alias.
         """
         if not self.client.indices.exists(self.index_name):
-            self.client.indices.create(index=self.index_name,
-                                       body=self.DEFAULT_SETTINGS)
-            self.client.indices.put_mapping(index=self.index_name,
-                                            body=self.mapping)
+            self.swap_alias(self.create_index())
 
         self.setup_complete = True
 
+    def create_index(self, bulk_load=False):
+        """
+        Create a new index, named after index_name and the time, with the current
+        settings and mappings.  Returns the name.  With bulk_load, replicas and
+        refresh are off until finish_bulk_load()
+        """
+        name = '{}-{}'.format(self.index_name, datetime.datetime.now().strftime('%Y%m%d%H%M%S%f'))
+        body = copy.deepcopy(self.DEFAULT_SETTINGS)
+        if bulk_load:
+            body['settings']['index'] = {'number_of_replicas': 0, 'refresh_interval': '-1'}
+        body['mappings'] = self.mapping
+        self.client.indices.create(index=name, body=body)
+        return name
+
+    def finish_bulk_load(self, name, replicas=None):
+        """Restore refresh, and replicas of an index created with bulk_load"""
+        index_settings = {'refresh_interval': None}
+        if replicas is not None:
+            index_settings['number_of_replicas'] = replicas
+        self.client.indices.put_settings(index=name, body={'index': index_settings})
+        self.client.indices.refresh(index=name)
+
+    def get_alias_indices(self):
+        """Returns list of the indexes index_name refers to.  An index created before
+        aliases were used has the name itself"""
+        if self.client.indices.exists_alias(name=self.index_name):
+            return sorted(self.client.indices.get_alias(name=self.index_name))
+        if self.client.indices.exists(index=self.index_name):
+            return [self.index_name]
+        return []
+
+    def swap_alias(self, name):
+        """Point index_name at index name, in one atomic request.  An index with the
+        name of the alias, from before aliases were used, is deleted by the same
+        request.  Returns list of the indexes the alias referred to"""
+        old = self.get_alias_indices()
+        actions = []
+        for index in old:
+            if index == self.index_name:
+                actions.append({'remove_index': {'index': index}})
+            else:
+                actions.append({'remove': {'index': index, 'alias': self.index_name}})
+        actions.append({'add': {'index': name, 'alias': self.index_name}})
+        self.client.indices.update_aliases(body={'actions': actions})
+        return [index for index in old if index != self.index_name]
+
     def clear(self, commit=True):
         '''Clears index of all data, and runs setup, leaving 
         an empty index.'''
         logger.debug('ESBackend.clear() called.')
-        self.client.indices.delete(index=self.index_name, ignore=404)
+        for index in self.get_alias_indices():
+            self.client.indices.delete(index=index, ignore=404)
         self.setup()
 
+    def bulk(self, actions, refresh=False, **kwargs):
+        """Send bulk actions to the index, and to an index being built by rebuild_index,
+        see get_build_index().  Returns the result of the request to the index"""
+        results = bulk(self.client, actions, index=self.index_name, refresh=refresh, **kwargs)
+        build_index = get_build_index()
+        if build_index and build_index != self.index_name:
+            # the index being built has refresh off, don't wait for it
+            bulk(self.client, actions, index=build_index, **kwargs)
+        return results
+
     def update(self, iterable, commit=True):
-        '''Update index records using iterable of instances'''
+        '''Update index records using iterable of instances.  With commit the call
+        returns once the records are searchable (refresh=wait_for), otherwise they
+        appear after the next scheduled refresh of the index'''
         logger.debug('ESBackend.update() called. iterable={}, iterable_length={}, last_message={}, commit={}, setup_complete={}'.format(
             type(iterable), len(iterable), iterable[-1].django_id, commit, self.setup_complete))
         
@@ -155,6 +242,18 @@ class ESBackend():
                 self.log.error("Failed to add documents to Elasticsearch: %s", e, exc_info=True)
                 return
 
+        self.update_prepared(self.prepare(iterable), commit=commit)
+
+    def update_prepared(self, documents, commit=True):
+        '''Update index records using documents from prepare(), ie. prepared in
+        another process'''
+        if not self.setup_complete:
+            self.setup()
+        results = self.bulk(documents, refresh=get_refresh(commit))
+        logger.debug('ESBackend.update() bulk results={}'.format(results))
+
+    def prepare(self, iterable):
+        '''Returns list of index documents for iterable of instances'''
         prepped_docs = []
         for obj in iterable:
             try:
@@ -186,13 +285,7 @@ class ESBackend():
                     u"%s while preparing object for update" % e.__class__.__name__,
                     exec_info=True,
                     extra=extra)
-
-        results = bulk(self.client, prepped_docs,
-                       index=self.index_name)
-        logger.debug('ESBackend.update() bulk results={}'.format(results))
-
-        if commit:
-            self.client.indices.refresh(index=self.index_name)
+        return prepped_docs
 
     def remove(self, obj_or_string, commit=True):
         """Remove record from index"""
@@ -210,15 +303,170 @@ class ESBackend():
                 return
 
         try:
-            self.client.delete(index=self.index_name, id=doc_id, ignore=404)
+            self.bulk([{'_op_type': 'delete', '_id': doc_id}], refresh=get_refresh(commit), ignore_status=(404,))
+        except (TransportError, BulkIndexError) as e:
+            if not self.silently_fail:
+                raise
+
+            self.log.error("Failed to remove document '%s' from Elasticsearch: %s", doc_id, e, exc_info=True)
 
-            if commit:
-                self.client.indices.refresh(index=self.index_name)
+    def update_list_private(self, list_name, private):
+        """Set the private field of the list's documents, after the list's privacy
+        changes, see tasks.update_list_private.  Waits for the update, documents
+        changed meanwhile are retried up to UPDATE_PRIVATE_RETRIES times.  Returns True
+        if all documents were updated"""
+        body = {
+            'query': {'bool': {
+                'filter': [{'term': {'email_list': list_name}}],
+                'must_not': [{'term': {'private': private}}]}},
+            'script': {
+                'source': 'ctx._source.private = params.private',
+                'params': {'private': private}}}
+        indexes = [self.index_name]
+        build_index = get_build_index()
+        if build_index and build_index != self.index_name:
+            indexes.append(build_index)
+        complete = True
+        try:
+            if not self.setup_complete:
+                self.setup()
+            for index in indexes:
+                for attempt in range(UPDATE_PRIVATE_RETRIES):
+                    result = self.client.update_by_query(index=index, body=body, conflicts='proceed',
+                                                         refresh=True, request_timeout=UPDATE_PRIVATE_TIMEOUT)
+                    if not result['failures'] and not result['version_conflicts']:
+                        break
+                else:
+                    complete = False
+                    self.log.error("Failed to update private field of list '%s' in index '%s': "
+                                   "%d failures, %d version conflicts", list_name, index,
+                                   len(result['failures']), result['version_conflicts'])
         except TransportError as e:
             if not self.silently_fail:
                 raise
 
-            self.log.error("Failed to remove document '%s' from Elasticsearch: %s", doc_id, e, exc_info=True)
+            self.log.error("Failed to update private field of list '%s' in Elasticsearch: %s", list_name, e,
+                           exc_info=True)
+            return False
+        return complete
+
+    def remove_many(self, identifiers, commit=True):
+        """Remove records from index in one bulk request"""
+        if not self.setup_complete:
+            self.setup()
+        actions = [{'_op_type': 'delete', '_id': get_identifier(i)} for i in identifiers]
+        self.bulk(actions, refresh=get_refresh(commit), ignore_status=(404,))
+
+
+class IndexBuffer(BatchBuffer):
+    '''Coalesces index updates and removals, used by the signal processor.  Documents
+    are prepared when added and sent in one bulk request, delay seconds after the
+    first pending change or once size documents are pending.  A document changed
+    more than once is sent once.  With delay 0 changes are sent immediately.
+
+    While Elasticsearch is unreachable the documents of a failed request are kept,
+    up to ELASTICSEARCH_INDEX_RETRY_SIZE, and sent again after
+    ELASTICSEARCH_INDEX_RETRY_DELAY seconds, doubled after each failure.  A change
+    put meanwhile replaces the kept document, changes are only sent by the retry
+    rather than at the end of each request.
+
+    refresh is passed to the bulk request: False relies on the refresh interval of
+    the index, "wait_for" returns once the documents are searchable.  Cached search
+    results of the lists changed are then expired, see
+    invalidate_search_cache_after_update().  stats holds counters of the bulk
+    requests sent, see get_stats().
+    '''
+    def __init__(self, backend, delay=None, size=None, refresh=None):
+        super(IndexBuffer, self).__init__(
+            settings.ELASTICSEARCH_INDEX_BATCH_DELAY if delay is None else delay,
+            size or settings.ELASTICSEARCH_INDEX_BATCH_SIZE)
+        self.backend = backend
+        self.refresh = settings.ELASTICSEARCH_INDEX_REFRESH if refresh is None else refresh
+        self.retry_delay = 0
+        self.stats = {'batches': 0, 'documents': 0, 'errors': 0, 'seconds': 0.0, 'max_batch': 0}
+
+    def add(self, instances):
+        for doc in self.backend.prepare(instances):
+            self.put(doc['_id'], doc)
+
+    def put(self, key, item):
+        if not self.retry_delay:
+            return super(IndexBuffer, self).put(key, item)
+        with self.lock:
+            if key in self.pending or len(self.pending) < settings.ELASTICSEARCH_INDEX_RETRY_SIZE:
+                self.pending[key] = item
+                return
+        # the index is reconciled with update_index --age
+        logger.error('Dropped document %s, over ELASTICSEARCH_INDEX_RETRY_SIZE', key)
+
+    def flush(self, retry=False):
+        if self.retry_delay and not retry:
+            return
+        super(IndexBuffer, self).flush()
+
+    def remove(self, obj_or_string):
+        email_list = getattr(obj_or_string, 'email_list', None)
+        self.put(get_identifier(obj_or_string), {'deleted': True, 'email_list': email_list and email_list.name})
+
+    def send(self, items):
+        actions = []
+        list_names = set()
+        for doc_id, doc in items:
+            if doc.get('deleted'):
+                actions.append({'_op_type': 'delete', '_id': doc_id})
+            else:
+                actions.append(doc)
+            if doc.get('email_list'):
+                list_names.add(doc['email_list'])
+        start = time.perf_counter()
+        try:
+            if not self.backend.setup_complete:
+                self.backend.setup()
+            self.backend.bulk(actions, refresh=self.refresh, ignore_status=(404,))
+            invalidate_search_cache_after_update(list_names, refreshed=bool(self.refresh))
+            self.retry_delay = 0
+        except ESConnectionError as e:
+            self.stats['errors'] += 1
+            self.retry(items, e)
+        except (TransportError, BulkIndexError) as e:
+            self.stats['errors'] += 1
+            if not self.backend.silently_fail:
+                raise
+            logger.error("Failed to send %s documents to Elasticsearch: %s", len(actions), e)
+        finally:
+            elapsed = time.perf_counter() - start
+            self.stats['batches'] += 1
+            self.stats['documents'] += len(actions)
+            self.stats['seconds'] += elapsed
+            self.stats['max_batch'] = max(self.stats['max_batch'], len(actions))
+            logger.debug('IndexBuffer.send() documents={}, seconds={:.3f}'.format(len(actions), elapsed))
+
+    def retry(self, items, error):
+        '''Keep the documents of a request that failed to connect, see class docstring'''
+        self.retry_delay = min(self.retry_delay * 2 or settings.ELASTICSEARCH_INDEX_RETRY_DELAY,
+                               settings.ELASTICSEARCH_INDEX_RETRY_MAX_DELAY)
+        with self.lock:
+            pending = dict(items[:max(settings.ELASTICSEARCH_INDEX_RETRY_SIZE - len(self.pending), 0)])
+            dropped = len(items) - len(pending)
+            pending.update(self.pending)
+            self.pending = pending
+            if self.timer is not None:
+                self.timer.cancel()
+            self.timer = threading.Timer(self.retry_delay, self.flush, kwargs={'retry': True})
+            self.timer.daemon = True
+            self.timer.start()
+        logger.warning('Failed to send %s documents to Elasticsearch, retry in %s sec: %s',
+                       len(items) - dropped, self.retry_delay, error)
+        if dropped:
+            logger.error('Dropped %s documents, over ELASTICSEARCH_INDEX_RETRY_SIZE', dropped)
+
+    def get_stats(self):
+        '''Returns the counters and the average batch size and latency'''
+        stats = dict(self.stats)
+        batches = stats['batches']
+        stats['avg_batch'] = stats['documents'] / batches if batches else 0
+        stats['avg_ms'] = stats['seconds'] / batches * 1000 if batches else 0
+        return stats
 
 
 class ElasticsearchQuery():
@@ -231,7 +479,7 @@ class ElasticsearchQuery():
     def __init__(self, form, email_list=None, skip_facets=False):
         self.form = form
         self.request = form.request
-        self.client = Elasticsearch()
+        self.client = get_client()
         self.search = Search(using=self.client, index=settings.ELASTICSEARCH_INDEX_NAME)
         self.skip_facets = skip_facets
         self.email_list = email_list
@@ -267,14 +515,28 @@ class ElasticsearchQuery():
         return search
 
     def exclude_private_lists(self):
+        '''Exclude the private lists the user can't access.  With
+        ELASTICSEARCH_PRIVATE_FILTER results are limited with the private and acl_token
+        fields of the index, see get_access_filter(), and only lists whose private
+        field is being updated are excluded by name.  Otherwise, or if the pending
+        updates aren't known, all inaccessible private lists are excluded by name'''
+        pending = get_private_pending() if settings.ELASTICSEARCH_PRIVATE_FILTER else None
+        noauth = get_noauth(self.request.user)
+        if pending is not None:
+            access_filter = get_access_filter(self.request.user, pending)
+            if access_filter:
+                self.search = self.search.filter(access_filter)
+            noauth = [name for name in noauth if name in pending]
+            if not noauth:
+                return
         self.search = self.search.exclude(
             'terms',
-            email_list=get_noauth(self.request.user))
+            email_list=noauth)
 
     def handle_sort(self):
         fields = get_order_fields(self.request.GET)
         logger.debug('sort fields: {}'.format(fields))
-        self.search = self.search.sort(*fields)
+        self.search = self.search.sort(*fields, SORT_TIEBREAKER)
 
     def post_process(self):
         # if no search parameters at all, return empty set
@@ -319,6 +581,99 @@ class ElasticsearchQuery():
             self.search = self.search.filter(f)
 
 
+def get_access_filter(user, pending=()):
+    '''Returns filter limiting results to public lists and the private lists the user
+    can access, by their ACL tokens, None if the user can access all lists.  The
+    pending lists, whose private field is being updated, are included, the caller
+    excludes those the user can't access by name.  Anonymous users, and users who
+    aren't members of a private list, share the same filter, which Elasticsearch can
+    cache'''
+    if user.is_superuser:
+        return None
+    access_filter = Q('term', private=False)
+    list_ids = get_private_list_ids()
+    tokens = [get_acl_token(list_ids[name]) for name in get_private_lists_for_user(user) if name in list_ids]
+    if tokens:
+        access_filter = access_filter | Q('terms', acl_token=tokens)
+    if pending:
+        access_filter = access_filter | Q('terms', email_list=sorted(pending))
+    return access_filter
+
+
+def get_acl_token(email_list_id):
+    '''Returns the ACL token of the messages of a list, see get_access_filter()'''
+    return 'list-{}'.format(email_list_id)
+
+
+def get_private_pending():
+    '''Returns dictionary of the names of the lists whose private field is being
+    updated -> number of updates, None if not known, ie. the cache entry was evicted'''
+    return cache.get(PRIVATE_PENDING_KEY)
+
+
+def update_private_pending(list_names, delta, reset=False):
+    '''Add (delta 1) an update of the private field of list_names, or remove (-1) one
+    that completed.  While the pending updates aren't known the change is ignored,
+    unless reset, which starts tracking them anew'''
+    for attempt in range(PRIVATE_PENDING_LOCK_TIMEOUT * 10):
+        if cache.add(PRIVATE_PENDING_LOCK_KEY, 1, timeout=PRIVATE_PENDING_LOCK_TIMEOUT):
+            break
+        time.sleep(0.1)
+    else:
+        logger.error('update_private_pending: timed out waiting for lock')
+        if delta > 0:
+            forget_private_pending()
+        return
+    try:
+        pending = cache.get(PRIVATE_PENDING_KEY)
+        if pending is None and not reset:
+            return
+        pending = dict(pending or {})
+        for name in list_names:
+            count = pending.get(name, 0) + delta
+            if count > 0:
+                pending[name] = count
+            else:
+                pending.pop(name, None)
+        cache.set(PRIVATE_PENDING_KEY, pending, timeout=None)
+    finally:
+        cache.delete(PRIVATE_PENDING_LOCK_KEY)
+
+
+def forget_private_pending():
+    '''Searches exclude all inaccessible private lists by name, until rebuild_index
+    tracks the pending updates anew'''
+    cache.delete(PRIVATE_PENDING_KEY)
+
+
+def get_build_index():
+    '''Returns the name of the index being built by rebuild_index, or None.  Writes
+    go to both indexes during the build.  Checked every BUILD_INDEX_CHECK_INTERVAL
+    seconds, rebuild_index replays messages updated since the build started to
+    cover the interval'''
+    now = time.monotonic()
+    if now - _build_index['checked'] > BUILD_INDEX_CHECK_INTERVAL:
+        _build_index['name'] = cache.get(BUILD_INDEX_KEY)
+        _build_index['checked'] = now
+    return _build_index['name']
+
+
+def set_build_index(name):
+    '''Start or, with None, end writing to an index being built'''
+    if name:
+        cache.set(BUILD_INDEX_KEY, name, timeout=BUILD_INDEX_TIMEOUT)
+    else:
+        cache.delete(BUILD_INDEX_KEY)
+    _build_index['checked'] = 0
+
+
+def get_refresh(commit):
+    '''Returns the refresh parameter of an index request.  A caller which needs to
+    read its writes commits, and waits for the next refresh rather than forcing one,
+    which would create a segment per request'''
+    return 'wait_for' if commit else False
+
+
 def get_identifier(obj_or_string):
     """
     Get an unique identifier for the object or a string representing the
@@ -0,0 +1,155 @@
+'''This module implements a Bloom filter, used for duplicate message detection.
+https://en.wikipedia.org/wiki/Bloom_filter
+
+A Bloom filter answers "definitely not present" or "maybe present".
+DuplicateFilter keeps filters of the msgids of each list and of all
+hashcodes, so MessageWrapper.save() only queries the database for a
+possible duplicate.  It is loaded by the long running archiver process,
+see archiver.py.  Until load() is called every answer is "maybe present",
+so other callers fall through to the database.
+'''
+import hashlib
+import math
+import time
+
+from django.db.models import Count, Max, Q
+
+from mlarchive.archive.models import Message
+
+import logging
+logger = logging.getLogger(__name__)
+
+DEFAULT_ERROR_RATE = 0.01
+MIN_CAPACITY = 1000
+GAP_TIMEOUT = 3600          # seconds
+GAP_WINDOW = 10000          # primary keys checked for gaps on load
+
+
+class BloomFilter(object):
+    '''A Bloom filter sized for capacity items with the given false positive rate.
+    Items are strings.  Uses double hashing of a single blake2b digest to get the
+    bit positions.
+    '''
+    def __init__(self, capacity, error_rate=DEFAULT_ERROR_RATE):
+        self.capacity = max(int(capacity), 1)
+        self.error_rate = error_rate
+        self.size = int(math.ceil(-self.capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hash_count = max(int(round(self.size / self.capacity * math.log(2))), 1)
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def __contains__(self, item):
+        return all(self.bits[p >> 3] & (1 << (p & 7)) for p in self._positions(item))
+
+    def __len__(self):
+        return self.count
+
+    def _positions(self, item):
+        digest = hashlib.blake2b(item.encode('utf8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hash_count)]
+
+    def add(self, item):
+        for p in self._positions(item):
+            self.bits[p >> 3] |= 1 << (p & 7)
+        self.count += 1
+
+    def is_full(self):
+        return self.count >= self.capacity
+
+
+class DuplicateFilter(object):
+    '''Bloom filters of existing message msgids, per list, and hashcodes.
+    Mirrors the duplicate checks of MessageWrapper.save(): msgid within a list,
+    hashcode across all lists.
+
+    Messages saved by other processes, ie. the load command, are added by sync(),
+    which reads messages with a primary key greater than the last seen.  This is a
+    range scan of the primary key, usually returning no rows.  Primary keys below
+    the last seen which are missing, ie. from a transaction which had not committed,
+    are checked again until they appear or GAP_TIMEOUT passes.  Removed messages
+    stay in the filters, which only costs a database query.
+    '''
+    def __init__(self, error_rate=DEFAULT_ERROR_RATE):
+        self.error_rate = error_rate
+        self.loaded = False
+        self.msgids = {}
+        self.hashcodes = None
+        self.max_pk = 0
+        self.gaps = {}          # missing primary key -> time first missed
+        self.full = False
+
+    def load(self):
+        '''Build the filters from the database'''
+        counts = dict(Message.objects.values_list('email_list__name').annotate(Count('pk')).order_by())
+        self.msgids = {name: self._new_filter(count) for name, count in counts.items()}
+        self.hashcodes = self._new_filter(sum(counts.values()))
+        self.full = False
+        self.gaps = {}
+        max_pk = Message.objects.aggregate(Max('pk'))['pk__max'] or 0
+        self.max_pk = max(max_pk - GAP_WINDOW, 0)
+        self._add_messages(Message.objects.filter(pk__lte=self.max_pk))
+        self._add_messages(Message.objects.filter(pk__gt=self.max_pk, pk__lte=max_pk), find_gaps=True)
+        self.loaded = True
+        logger.info('duplicate filter loaded: {} lists, {} messages'.format(
+            len(self.msgids), len(self.hashcodes)))
+
+    def _new_filter(self, count):
+        # allow for growth, filters are rebuilt when full
+        return BloomFilter(max(count * 2, MIN_CAPACITY), self.error_rate)
+
+    def _add_messages(self, queryset, find_gaps=False):
+        start = self.max_pk
+        pks = set()
+        qs = queryset.order_by().values_list('pk', 'email_list__name', 'msgid', 'hashcode')
+        for pk, listname, msgid, hashcode in qs.iterator():
+            self.add(listname, msgid, hashcode)
+            pks.add(pk)
+            self.gaps.pop(pk, None)
+        if pks:
+            self.max_pk = max(self.max_pk, max(pks))
+        if find_gaps:
+            now = time.time()
+            for pk in range(start + 1, self.max_pk):
+                if pk not in pks:
+                    self.gaps[pk] = now
+
+    def add(self, listname, msgid, hashcode):
+        if listname not in self.msgids:
+            self.msgids[listname] = self._new_filter(0)
+        self.msgids[listname].add(msgid)
+        self.hashcodes.add(hashcode)
+        if self.msgids[listname].is_full() or self.hashcodes.is_full():
+            self.full = True
+
+    def sync(self):
+        '''Add messages saved since the last load or sync.  Reload when a filter
+        is over capacity and the false positive rate has degraded.  Call before
+        checking for duplicates
+        '''
+        if not self.loaded:
+            return
+        expired = time.time() - GAP_TIMEOUT
+        self.gaps = {pk: missed for pk, missed in self.gaps.items() if missed > expired}
+        query = Q(pk__gt=self.max_pk)
+        if self.gaps:
+            query = query | Q(pk__in=list(self.gaps))
+        self._add_messages(Message.objects.filter(query), find_gaps=True)
+        if self.full:
+            self.load()
+
+    def might_contain_msgid(self, listname, msgid):
+        '''Returns False if no message with msgid exists in the list'''
+        if not self.loaded:
+            return True
+        return listname in self.msgids and msgid in self.msgids[listname]
+
+    def might_contain_hashcode(self, hashcode):
+        '''Returns False if no message with hashcode exists'''
+        if not self.loaded:
+            return True
+        return hashcode in self.hashcodes
+
+
+duplicate_filter = DuplicateFilter()
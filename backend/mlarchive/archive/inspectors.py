@@ -5,10 +5,17 @@ The value of the entry is a dictionary of options.
 
 Supported Options:
 "includes": a list of list names to act upon. If not present acts on all lists
-'''
 
+MessageWrapper.inspect() runs the configured inspectors through inspector_pipeline,
+see InspectorPipeline.
+'''
+import time
 
 from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+import logging
+logger = logging.getLogger(__name__)
 
 
 class InspectorMessage(Exception):
@@ -39,15 +46,21 @@ class InspectorMeta(type):
 class Inspector(object, metaclass=InspectorMeta):
     '''The base class for inspector classes.  Takes a MessageWrapper object and listname
     (string).  Inherit from this class and implement has_condition(), handle_file(),
-    raise_error() methods.  Call inspect() to run inspection.'''
+    raise_error() methods.  Call inspect() to run inspection.  Use header_values to
+check headers, see get_header_values(), message_wrapper.headers for parsed header
+values, message_wrapper.email_message parses the whole message.'''
 
-    def __init__(self, message_wrapper, options=None):
+    def __init__(self, message_wrapper, options=None, header_values=None):
         self.message_wrapper = message_wrapper
         self.listname = message_wrapper.listname
-        if options:
+        if options is not None:
             self.options = options
         else:
             self.options = settings.INSPECTORS.get(self.__class__.__name__)
+        if header_values is not None:
+            self.header_values = header_values
+        else:
+            self.header_values = get_header_values(message_wrapper.headers)
 
     def inspect(self):
         if 'includes' in self.options and self.listname not in self.options['includes']:
@@ -86,7 +99,7 @@ class ListIdSpamInspector(SpamInspector):
     '''Checks for missing or bogus List-Id header (doesn't contain listname).  If so,
     message is spam (has_condition = True)'''
     def has_condition(self):
-        listid = self.message_wrapper.email_message.get('List-Id')
+        listid = self.header_values.get('list-id')
         if listid and self.listname in listid:
             return False
         else:
@@ -96,7 +109,7 @@ class ListIdSpamInspector(SpamInspector):
 class ListIdExistsSpamInspector(SpamInspector):
     '''Checks for missing List-Id header.  If so, message is spam (has_condition = True)'''
     def has_condition(self):
-        listid = self.message_wrapper.email_message.get('List-Id')
+        listid = self.header_values.get('list-id')
         if listid is None:
             return True
         else:
@@ -106,23 +119,22 @@ class ListIdExistsSpamInspector(SpamInspector):
 class SpamStatusSpamInspector(SpamInspector):
     '''Checks for SpamStatus == Yes'''
     def has_condition(self):
-        return self.message_wrapper.email_message.get('X-Spam-Status', '').startswith('Yes')
+        return self.header_values.get('x-spam-status', '').startswith('Yes')
 
 
 class SpamLevelSpamInspector(SpamInspector):
     '''Checks for SpamLevel >= *****'''
     def has_condition(self):
-        return self.message_wrapper.email_message.get('X-Spam-Level', '').startswith('*****')
+        return self.header_values.get('x-spam-level', '').startswith('*****')
 
 
 class NoArchiveInspector(Inspector):
     '''Checks for no archive headers'''
     def has_condition(self):
-        keys = self.message_wrapper.email_message.keys()
-        if 'X-No-Archive' in keys:
+        if 'x-no-archive' in self.header_values:
             return True
-        value = self.message_wrapper.email_message.get('X-Archive', '')
-        if value.lower() == 'no':
+        value = self.header_values.get('x-archive', '')
+        if value.strip().lower() == 'no':
             return True
         return False
 
@@ -131,4 +143,106 @@ class NoArchiveInspector(Inspector):
         pass
 
     def raise_error(self):
-        raise NoArchiveMessage('X-No-Archive  Message-ID: {}'.format(self.message_wrapper.msgid))
\ No newline at end of file
+        raise NoArchiveMessage('X-No-Archive  Message-ID: {}'.format(self.message_wrapper.msgid))
+
+
+# --------------------------------------------------
+# Pipeline
+# --------------------------------------------------
+
+
+def get_header_values(headers):
+    '''Returns a dictionary of lowercase header name -> value of the first occurrence,
+    read in a single pass over headers, an email.message.Message.  Values are parsed
+    by the message policy, the same as headers.get() returns'''
+    header_values = {}
+    for name, value in headers.raw_items():
+        key = name.lower()
+        if key not in header_values:
+            header_values[key] = headers.policy.header_fetch_parse(name, value)
+    return header_values
+
+
+class InspectorStats(object):
+    '''Counters of an inspector: calls, matches (the inspector raised) and the total
+    time spent in seconds'''
+    __slots__ = ('calls', 'matches', 'seconds')
+
+    def __init__(self):
+        self.calls = 0
+        self.matches = 0
+        self.seconds = 0.0
+
+
+class InspectorPipeline(object):
+    '''The inspectors of settings.INSPECTORS.  Classes are looked up in the Inspector
+    registry once, and the inspectors acting on a list are determined on first use,
+    so lists not named in the "includes" option of an inspector skip it entirely.
+    The headers of each message are read once and shared by the inspectors.
+
+    stats: inspector name -> InspectorStats, see report()
+    '''
+    def __init__(self):
+        self.inspectors = None
+        self.lists = {}
+        self.stats = {}
+
+    def load(self):
+        '''Resolve the configured inspector classes'''
+        inspectors = []
+        for name, options in getattr(settings, 'INSPECTORS', {}).items():
+            inspector_class = Inspector.registry.get(name.lower())
+            if inspector_class is None:
+                raise ImproperlyConfigured('INSPECTORS: unknown inspector {}'.format(name))
+            inspectors.append((name, inspector_class, options or {}))
+        self.inspectors = inspectors
+        self.lists = {}
+
+    def reset(self):
+        self.inspectors = None
+        self.lists = {}
+
+    def get_inspectors(self, listname):
+        '''Returns list of (name, class, options) of the inspectors acting on listname'''
+        if self.inspectors is None:
+            self.load()
+        if listname not in self.lists:
+            self.lists[listname] = [(name, inspector_class, options)
+                                    for name, inspector_class, options in self.inspectors
+                                    if 'includes' not in options or listname in options['includes']]
+        return self.lists[listname]
+
+    def inspect(self, message_wrapper):
+        '''Run the inspectors of the message list.  An inspector raises an exception,
+        ie. SpamMessage, if the message should not be archived'''
+        inspectors = self.get_inspectors(message_wrapper.listname)
+        if not inspectors:
+            return
+        header_values = get_header_values(message_wrapper.headers)
+        for name, inspector_class, options in inspectors:
+            stats = self.stats.get(name)
+            if stats is None:
+                stats = self.stats[name] = InspectorStats()
+            start = time.perf_counter()
+            try:
+                inspector_class(message_wrapper, options, header_values).inspect()
+            except InspectorMessage:
+                stats.matches += 1
+                raise
+            finally:
+                stats.calls += 1
+                stats.seconds += time.perf_counter() - start
+
+    def report(self):
+        '''Returns list of lines describing the inspector counters, most time spent
+        first'''
+        lines = []
+        items = sorted(self.stats.items(), key=lambda item: item[1].seconds, reverse=True)
+        for name, stats in items:
+            average = stats.seconds / stats.calls * 1000 if stats.calls else 0
+            lines.append('{}: {} calls, {} matches, {:.3f} sec, {:.3f} ms/call'.format(
+                name, stats.calls, stats.matches, stats.seconds, average))
+        return lines
+
+
+inspector_pipeline = InspectorPipeline()
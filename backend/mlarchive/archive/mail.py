@@ -1,9 +1,12 @@
+import array
 import base64
+import bisect
 import datetime
 import email
 import glob
 import hashlib
 import mailbox
+import mmap
 import os
 import pytz
 import re
@@ -15,6 +18,7 @@ import traceback
 import uuid
 from collections import deque
 from email import policy
+from email.parser import Parser
 from email.utils import parsedate_tz, getaddresses, make_msgid
 from email.utils import parsedate_to_datetime
 from io import StringIO
@@ -22,13 +26,20 @@ from io import StringIO
 from django.conf import settings
 from django.core.cache import cache
 from django.core.management.base import CommandError
+from django.db import transaction
+from django.db.models import Case, IntegerField, Max, Value, When
 from dateutil.tz import tzoffset
 
+from mlarchive.archive.bloom import duplicate_filter
 from mlarchive.archive.models import (Attachment, EmailList, Legacy, Message,
-    Thread, get_in_reply_to_message, is_attachment)
+    Thread, is_attachment)
 from mlarchive.archive.management.commands._mimetypes import CONTENT_TYPES, UNKNOWN_CONTENT_TYPE
 from mlarchive.archive.inspectors import *      # noqa
-from mlarchive.archive.thread import compute_thread, reconcile_thread, parse_message_ids
+from mlarchive.archive.inspectors import inspector_pipeline
+from mlarchive.archive.signals import messages_updated
+from mlarchive.archive.thread import (compute_thread, reconcile_thread, parse_message_ids,
+    place_message, shift_thread_order)
+from mlarchive.archive.thread_cache import thread_cache
 from mlarchive.utils.decorators import check_datetime
 from mlarchive.utils.encoding import decode_safely, decode_rfc2047_header, get_filename
 
@@ -36,6 +47,8 @@ import logging
 logger = logging.getLogger(__name__)
 
 NO_REFOLD_POLICY = policy.SMTP.clone(refold_source='none')
+HEADER_END_PATTERN = re.compile(br'\n\r?\n')
+BARE_CR_PATTERN = re.compile(br'\r(?!\n)')
 
 '''
 Notes on character encoding.
@@ -64,6 +77,8 @@ date_formats = ["%a %b %d %H:%M:%S %Y",
                 "%a, %d %b %Y %H:%M:%S %Z",
                 "%a %b %d %H:%M:%S %Y %Z"]
 
+DEFAULT_BULK_CHUNK_SIZE = 1000
+
 MBOX_SEPARATOR_PATTERN = re.compile(r'^From .* (Mon|Tue|Wed|Thu|Fri|Sat|Sun),?\s.+')
 SEPARATOR_PATTERNS = [re.compile(b'^Return-[Pp]ath:'),
                       re.compile(b'^Envelope-to:'),
@@ -123,18 +138,22 @@ class UnknownFormat(Exception):
 # --------------------------------------------------
 
 
-def archive_message(data, listname, private=False, save_failed=True):
+def archive_message(data, listname, private=False, save_failed=True, retry_on=()):
     """This function is the internals of the interface to Mailman.  It is called by the
     standalone script archive-mail.py.  Inputs are:
     data: the message as bytes (comes from sys.stdin.buffer.read())
     listname: a string, provided as command line argument to archive-mail
     private: boolean, True if the list is private.  Only used if this is a new list
     save_failed: default is True, set to false when calling from compare utility script
+    retry_on: tuple of exception classes which are raised rather than saving the message
+    as failed, the archiver retries these, see archiver.SpoolDrainer
     """
     try:
         assert isinstance(data, bytes)
         mw = MessageWrapper.from_bytes(data, listname, private=private)
         mw.save()
+    except retry_on:
+        raise
     except DuplicateMessage as error:
         # if DuplicateMessage it's already been saved to _dupes
         logger.warning('Archive message failed [{0}]'.format(error.args))
@@ -226,6 +245,20 @@ def get_content_disposition(part):
     return ''
 
 
+def get_email_list(listname, private=False):
+    """Returns the EmailList, creating it if it doesn't exist.  If the list exists and
+    private is True the list is changed to private
+    """
+    email_list, created = EmailList.objects.get_or_create(
+        name=listname, defaults={'description': listname, 'private': private})
+    if not created and private is True and email_list.private is False:
+        # the list has been changed from public to private
+        logger.info('Email List {} changed from public to private'.format(email_list.name))
+        email_list.private = True
+        email_list.save()
+    return email_list
+
+
 def get_envelope_date(msg):
     """Returns the date, a naive or aware datetime object, from the message
     envelope line.  msg is a email.message.Message object
@@ -262,6 +295,12 @@ def get_from(msg):
             return frm
 
 
+def get_header_end(data):
+    """Returns the offset of the end of the header block of data, a raw message"""
+    match = HEADER_END_PATTERN.search(data)
+    return match.end() if match else len(data)
+
+
 def get_header_date(msg):
     """Returns the date, a naive or aware datetime object, from the message header.
     First checks the 'Date:' field, then 'Sent:'.  Returns None if it can't locate
@@ -335,6 +374,15 @@ def is_aware(date):
     return False
 
 
+def parse_headers(data):
+    """Returns an email.message.Message of the headers of data, a raw message as a
+    bytes-like object.  Only the header block is decoded, the body isn't parsed.
+    See walk_headers()
+    """
+    return Parser(policy=NO_REFOLD_POLICY).parsestr(str(data[:get_header_end(data)], 'ascii', 'surrogateescape'),
+                                                    headersonly=True)
+
+
 def save_failed_msg(data, listname, error):
     """Called when an attempt to import a message fails.  "data" will typically be an
     instance of email.message.Message.  In some odd case where message parsing fails
@@ -413,6 +461,48 @@ def subject_is_reply(text):
     return False
 
 
+def walk_headers(data, headers=None):
+    """Returns a list of the MIME parts of data, a raw message as a bytes-like object,
+    in the order of email.message.Message.walk().  Each part is an email.message.Message
+    of the part headers only, so the parts are found without decoding the bodies.
+    Returns None if the message has a structure only the full parser handles: a
+    message/* part, multipart/digest, a missing boundary or close delimiter, or bare CR
+    line endings
+    """
+    data = memoryview(data)
+    if headers is None:
+        headers = parse_headers(data)
+    parts = [headers]
+    if headers.get_content_maintype() == 'message':
+        return None
+    if headers.get_content_maintype() != 'multipart':
+        return parts
+    boundary = headers.get_boundary()
+    if not boundary or headers.get_content_subtype() == 'digest' or headers.defects:
+        return None
+    body = data[get_header_end(data):]
+    if BARE_CR_PATTERN.search(body):
+        return None
+    # a delimiter must start a line.  Not part of the pattern, which would make the
+    # search much slower
+    pattern = re.compile(b'--' + re.escape(boundary.encode('ascii', 'surrogateescape')) +
+                         br'(--)?[ \t]*\r?$', re.MULTILINE)
+    start = None
+    for match in pattern.finditer(body):
+        if match.start() > 0 and body[match.start() - 1] != 10:     # newline
+            continue
+        if start is not None:
+            part = walk_headers(body[start:match.start()])
+            if part is None:
+                return None
+            parts.extend(part)
+        if match.group(1):
+            return parts
+        start = match.end() + 1
+    # no close delimiter
+    return None
+
+
 def write_file(path, data):
     """Function to write file to disk.
     - creates directory if it doesn't exist
@@ -420,7 +510,7 @@ def write_file(path, data):
     - sets mode of file
     - calls external backup script if defined
     """
-    assert isinstance(data, bytes)
+    assert isinstance(data, (bytes, memoryview))
     directory = os.path.dirname(path)
     if not os.path.exists(directory):
         os.makedirs(directory)
@@ -532,6 +622,112 @@ class CustomMbox(mailbox.mbox):
         return msg
 
 
+class MMapMailbox(object):
+    """Read-only mailbox, mbox or MMDF, for loading large files.  The file is memory
+    mapped and message boundaries are found with a byte search rather than reading
+    the file a line at a time.  Iterating yields a memoryview slice of the map for
+    each message.  Pass these to MessageWrapper.from_bytes(), there is no copy.
+
+    mbox: a separator is a "From " line, at the start of the file or following a
+    blank line, which matches MBOX_SEPARATOR_PATTERN.  Same as CustomMbox, false
+    separators like "From your message Mon, 9 Nov 1998 06:09:48 -0000:" are excluded.
+    The slice includes the "From " line, which the email parser keeps as the unixfrom.
+
+    MMDF: messages are enclosed by "^A^A^A^A" lines, which are excluded.
+    """
+    MMDF_SEPARATOR = b'\x01\x01\x01\x01\n'
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'rb')
+        if os.fstat(self._file.fileno()).st_size:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self._map = b''
+        self._separator = re.compile(MBOX_SEPARATOR_PATTERN.pattern.encode('ascii'))
+        self._false_separator = re.compile(b'^From .* message (Mon|Tue|Wed|Thu|Fri|Sat|Sun),?\\s.+')
+        self.format = self._get_format()
+        self._toc = None
+
+    def __iter__(self):
+        data = memoryview(self._map)
+        toc = self.toc
+        for i in range(0, len(toc), 2):
+            yield data[toc[i]:toc[i + 1]]
+
+    def __len__(self):
+        return len(self.toc) // 2
+
+    def _get_format(self):
+        """Returns the mailbox format, "mbox" or "MMDF", based on the first line of the
+        file.  See get_mb()
+        """
+        start = 0
+        while self._map[start:start + 1] == b'\n':
+            start += 1
+        self._start = start
+        if self._map[start:start + 5] == b'From ':
+            return 'mbox'
+        elif self._map[start:start + 5] == self.MMDF_SEPARATOR:
+            return 'MMDF'
+        raise UnknownFormat('%s, %s' % (self.path, self._map[start:self._map.find(b'\n', start) + 1]))
+
+    def _get_toc(self):
+        """Returns the table of contents, an array of message offsets: start, stop,
+        start, stop...
+        """
+        if self._toc is None:
+            if self.format == 'mbox':
+                self._toc = self._generate_mbox_toc()
+            else:
+                self._toc = self._generate_mmdf_toc()
+        return self._toc
+    toc = property(_get_toc)
+
+    def _generate_mbox_toc(self):
+        data = self._map
+        toc = array.array('q', [self._start])
+        pos = self._start
+        while True:
+            pos = data.find(b'\n\nFrom ', pos)
+            if pos == -1:
+                break
+            start = pos + 2
+            end = data.find(b'\n', start)
+            line = data[start:end if end != -1 else len(data)]
+            if self._separator.match(line) and not self._false_separator.match(line):
+                # stop before the blank line
+                toc.extend((pos + 1, start))
+            pos = start
+        toc.append(len(data))
+        return toc
+
+    def _generate_mmdf_toc(self):
+        data = self._map
+        toc = array.array('q')
+        pos = self._start
+        while data[pos:pos + 5] == self.MMDF_SEPARATOR:
+            start = pos + 5
+            end = data.find(b'\n' + self.MMDF_SEPARATOR, start - 1)
+            if end == -1:
+                toc.extend((start, len(data)))
+                break
+            toc.extend((start, end))
+            pos = end + 6
+            while data[pos:pos + 1] == b'\n':
+                pos += 1
+        return toc
+
+    def close(self):
+        """Close the file.  The map stays open while slices are still referenced"""
+        if isinstance(self._map, mmap.mmap):
+            try:
+                self._map.close()
+            except BufferError:
+                pass
+        self._file.close()
+
+
 class Loader(object):
     """Object which handles loading messages from a mailbox file.  filename is the name
     of the file to load.  Accepts the following keyword options:
@@ -539,6 +735,7 @@ class Loader(object):
     dryrun: if True just perform parsing, no saves
     firstrun: True if this is the initial load, skips messages not in "legacy" table
     listname: the name of the email list we are loading messages for
+    mmap: if True read the file with MMapMailbox
     private: True is this is a private list
     test: if True don't save the message to disk archive (only to database)
 
@@ -554,7 +751,10 @@ class Loader(object):
         self.stats = {'count': 0, 'errors': 0, 'spam': 0, 'bytes_loaded': 0}
         self.private = options.get('private')
         self.listname = options.get('listname')
-        self.mb = get_mb(filename)
+        if options.get('mmap'):
+            self.mb = MMapMailbox(filename)
+        else:
+            self.mb = get_mb(filename)
         self.klass = self.mb.__class__.__name__
         self.stats[self.klass] = self.stats.get(self.klass, 0) + 1
 
@@ -571,21 +771,15 @@ class Loader(object):
         """
         self.stats['count'] += 1
         try:
-            mw = MessageWrapper.from_message(msg, self.listname, private=self.private)
+            mw = self._get_wrapper(msg)
         except Exception as e:
             print(self.filename)
             raise
             # import sys
             # raise e.with_traceback(sys.exc_info()[2])
 
-        # filter using Legacy archive
-        if self.options.get('firstrun') and mw.date < (datetime.datetime.now() - datetime.timedelta(days=30)) and mw.created_id is False:  # noqa
-            legacy = Legacy.objects.filter(msgid=mw.msgid, email_list_id=self.listname)
-            if not legacy:
-                self.stats['spam'] += 1
-                if not (self.options.get('dryrun') or self.options.get('test')):
-                    mw.write_msg(subdir='_filtered')
-                return
+        if self._is_filtered(mw):
+            return
 
         # process message
         mw.archive_message
@@ -594,6 +788,26 @@ class Loader(object):
         if not self.options.get('dryrun'):
             mw.save(test=self.options.get('test'))
 
+    def _get_wrapper(self, msg):
+        """Returns MessageWrapper for msg, an email.message.Message or the bytes-like
+        object yielded by MMapMailbox
+        """
+        if isinstance(msg, email.message.Message):
+            return MessageWrapper.from_message(msg, self.listname, private=self.private)
+        return MessageWrapper.from_bytes(msg, self.listname, private=self.private)
+
+    def _is_filtered(self, mw):
+        """Filter using Legacy archive.  Returns True if the message should be skipped
+        """
+        if self.options.get('firstrun') and mw.date < (datetime.datetime.now() - datetime.timedelta(days=30)) and mw.created_id is False:  # noqa
+            legacy = Legacy.objects.filter(msgid=mw.msgid, email_list_id=self.listname)
+            if not legacy:
+                self.stats['spam'] += 1
+                if not (self.options.get('dryrun') or self.options.get('test')):
+                    mw.write_msg(subdir='_filtered')
+                return True
+        return False
+
     def process(self):
         """If the "break" option is set propogate the exception
         """
@@ -607,9 +821,269 @@ class Loader(object):
                 self.stats['errors'] += 1
                 if self.options.get('break'):
                     raise
+            self._message_done()
 
+        self.flush()
         self._cleanup()
 
+    def _message_done(self):
+        """Called after each message is loaded.  BulkLoader saves a chunk when full"""
+        pass
+
+    def flush(self):
+        """Save pending messages.  Loader saves each message as it is loaded"""
+        pass
+
+
+class ListIndex(object):
+    """In-memory index of the messages of an email list.  Used by BulkLoader in place
+    of the per message database queries MessageWrapper makes to check for duplicates
+    and resolve threads.  Loaded with a single query and updated as messages are
+    added, so one index can be shared by the loaders of all the files of a list.
+
+    Threads are referenced by Thread object.  Messages are referenced by primary key
+    if they existed when the index was loaded, or by archive.models.Message object
+    if they were added during the load.
+    """
+    def __init__(self, email_list):
+        self.email_list = email_list
+        self.load()
+
+    def load(self):
+        self.msgids = {}            # msgid -> (message, thread), None if not unique
+        self.hashcodes = set()
+        self.subjects = {}          # base_subject -> ([date], [thread]), sorted by date
+        self.threads = Thread.objects.filter(email_list=self.email_list).in_bulk()
+        qs = Message.objects.filter(email_list=self.email_list).order_by('date')
+        rows = list(qs.values_list('pk', 'msgid', 'hashcode', 'base_subject', 'date', 'thread_id'))
+        missing = {row[5] for row in rows} - set(self.threads)
+        if missing:
+            self.threads.update(Thread.objects.in_bulk(missing))
+        for pk, msgid, hashcode, base_subject, date, thread_id in rows:
+            self.add(msgid, hashcode, base_subject, date, pk, self.threads[thread_id])
+
+    def add(self, msgid, hashcode, base_subject, date, message, thread):
+        if msgid in self.msgids:
+            self.msgids[msgid] = None
+        else:
+            self.msgids[msgid] = (message, thread)
+        self.hashcodes.add(hashcode)
+        dates, threads = self.subjects.setdefault(base_subject, ([], []))
+        i = bisect.bisect_right(dates, date)
+        dates.insert(i, date)
+        threads.insert(i, thread)
+
+    def get(self, msgid):
+        """Returns tuple (message, thread) or None if msgid is not found or not unique"""
+        return self.msgids.get(msgid)
+
+    def get_subject_thread(self, base_subject, date):
+        """Returns the thread of the most recent message before date with base_subject"""
+        if base_subject not in self.subjects:
+            return None
+        dates, threads = self.subjects[base_subject]
+        i = bisect.bisect_left(dates, date)
+        if i:
+            return threads[i - 1]
+
+
+class BulkLoader(Loader):
+    """Loader for large imports, ie. backfilling a list archive.  Messages are saved
+    in chunks of the "chunk_size" option using bulk queries rather than one at a time.
+    Thread resolution and duplicate checks use a ListIndex.  Pass "index" to share an
+    index between the loaders of a list.
+
+    NOTE: bulk_create() does not send signals, so messages are not indexed and the
+    cache is not purged.  The caller is responsible for indexing created_ids and
+    updated_ids, see the load command --bulk option.
+    """
+    def __init__(self, filename, index=None, **options):
+        super(BulkLoader, self).__init__(filename, **options)
+        self.chunk_size = options.get('chunk_size') or DEFAULT_BULK_CHUNK_SIZE
+        self.email_list = get_email_list(self.listname, self.private)
+        self.index = index or ListIndex(self.email_list)
+        self.chunk = []
+        self.created_ids = []
+        self.updated_ids = set()
+
+    def _load_message(self, msg):
+        """Parse the message, check for duplicates and resolve the thread using the
+        ListIndex.  The message is saved when the chunk is flushed
+        """
+        self.stats['count'] += 1
+        mw = self._get_wrapper(msg)
+
+        if self._is_filtered(mw):
+            return
+
+        mw.email_list = self.email_list
+        mw.process_headers()
+        self.stats['bytes_loaded'] += len(mw.bytes)
+
+        if self.options.get('dryrun'):
+            return
+
+        mw.inspect()
+
+        if mw.msgid in self.index.msgids:
+            mw.write_msg(subdir='_dupes')
+            raise DuplicateMessage('Duplicate msgid: %s' % mw.msgid)
+
+        if mw.hashcode in self.index.hashcodes:
+            mw.write_msg(subdir='_dupes')
+            raise CommandError('Duplicate hash, msgid: %s' % mw.msgid)
+
+        # in_reply_to is set when the chunk is saved, see save_chunk()
+        mw.in_reply_to_id = None
+        mw.in_reply_to_ref = self.get_in_reply_to(mw)
+        mw.thread = self.get_thread(mw)
+        mw._archive_message = mw.build_archive_message()
+        self.index.add(mw.msgid, mw.hashcode, mw.base_subject, mw.date, mw.archive_message, mw.thread)
+        self.chunk.append(mw)
+
+    def get_in_reply_to(self, mw):
+        """Returns the in_reply_to message, primary key or Message, if it exists.
+        See archive.models.get_in_reply_to_message()
+        """
+        msgids = parse_message_ids(mw.in_reply_to_value)
+        if not msgids:
+            return None
+        entry = self.index.get(msgids[0])
+        if entry:
+            return entry[0]
+        return Message.objects.filter(msgid=msgids[0]).values_list('pk', flat=True).first()
+
+    def get_thread(self, mw):
+        """Returns the Thread for the message, unsaved if it is a new thread.
+        See MessageWrapper.get_thread()
+        """
+        for header in (mw.references, mw.in_reply_to_value):
+            for msgid in parse_message_ids(header):
+                entry = self.index.get(msgid)
+                if entry:
+                    return entry[1]
+
+        # check subject
+        if subject_is_reply(mw.subject):
+            thread = self.index.get_subject_thread(mw.base_subject, mw.date)
+            if thread:
+                return thread
+
+        return Thread(date=mw.date, email_list=self.email_list)
+
+    def flush(self):
+        """Save the current chunk of messages, then write their files.  If the save
+        fails all messages in the chunk are saved as failed messages
+        """
+        chunk, self.chunk = self.chunk, []
+        if not chunk:
+            return
+        try:
+            with transaction.atomic():
+                self.save_chunk(chunk)
+        except Exception as error:
+            for mw in chunk:
+                save_failed_msg(mw.email_message, self.listname, error)
+            self.stats['errors'] += len(chunk)
+            # the index refers to messages that were not saved
+            self.index.load()
+            if self.options.get('break'):
+                raise
+            return
+        if not self.options.get('test'):
+            transaction.on_commit(lambda: self.write_files(chunk))
+
+    def write_files(self, chunk):
+        for mw in chunk:
+            mw.write_msg()
+
+    def save_chunk(self, chunk):
+        """Save a chunk of messages, their new threads and attachments"""
+        messages = [mw.archive_message for mw in chunk]
+
+        # save new threads
+        new_threads = list({id(mw.thread): mw.thread for mw in chunk if mw.thread.pk is None}.values())
+        if new_threads:
+            last_pk = Thread.objects.aggregate(Max('pk'))['pk__max'] or 0
+            Thread.objects.bulk_create(new_threads)
+            if new_threads[0].pk is None:
+                # database does not return primary keys from bulk inserts
+                pks = list(Thread.objects.filter(pk__gt=last_pk,
+                                                 email_list=self.email_list,
+                                                 first__isnull=True).order_by('pk').values_list('pk', flat=True))
+                if len(pks) != len(new_threads):
+                    raise CommandError('Could not determine new thread ids')
+                for thread, pk in zip(new_threads, pks):
+                    thread.pk = pk
+            self.index.threads.update({t.pk: t for t in new_threads})
+
+        # compute thread order and depth, including messages already saved
+        threads = {}
+        for mw in chunk:
+            # assign again, setting thread_id, so the Thread shared with the index is kept
+            mw.archive_message.thread = mw.thread
+            threads.setdefault(mw.thread.pk, (mw.thread, []))[1].append(mw.archive_message)
+        new_pks = {t.pk for t in new_threads}
+        saved = {}
+        for message in Message.objects.filter(thread__in=[pk for pk in threads if pk not in new_pks]):
+            saved.setdefault(message.thread_id, []).append(message)
+        changed = []
+        for pk, (thread, pending) in threads.items():
+            thread_messages = sorted(saved.get(pk, []) + pending, key=lambda m: m.date)
+            for info in compute_thread(thread_messages).values():
+                message = info.message
+                if message.pk is None:
+                    message.thread_depth = info.depth
+                    message.thread_order = info.order
+                elif message.thread_order != info.order or message.thread_depth != info.depth:
+                    message.thread_order = info.order
+                    message.thread_depth = info.depth
+                    message.updated = datetime.datetime.now()
+                    changed.append(message)
+        Message.objects.bulk_update(changed, ['thread_order', 'thread_depth', 'updated'])
+        self.updated_ids.update(m.pk for m in changed)
+
+        # save messages
+        replies = []
+        for mw in chunk:
+            ref = mw.in_reply_to_ref
+            if isinstance(ref, int):
+                mw.archive_message.in_reply_to_id = ref
+            elif ref is not None and ref.pk is not None:
+                mw.archive_message.in_reply_to = ref
+            elif ref is not None:
+                replies.append((mw.archive_message, ref))
+        Message.objects.bulk_create(messages)
+        if messages[0].pk is None:
+            pks = dict(Message.objects.filter(
+                email_list=self.email_list,
+                hashcode__in=[m.hashcode for m in messages]).values_list('hashcode', 'pk'))
+            for message in messages:
+                message.pk = pks[message.hashcode]
+        self.created_ids.extend(m.pk for m in messages)
+
+        # replies to messages in this chunk
+        for message, ref in replies:
+            message.in_reply_to = ref
+        Message.objects.bulk_update([message for message, ref in replies], ['in_reply_to'])
+
+        # update thread first message and date.  See signals._update_thread()
+        updated_threads = []
+        for thread, pending in threads.values():
+            first = min(pending, key=lambda m: m.date)
+            if not thread.first_id or first.date < thread.date:
+                thread.first = first
+                thread.date = first.date
+                updated_threads.append(thread)
+        Thread.objects.bulk_update(updated_threads, ['first', 'date'])
+
+        # save attachments
+        Attachment.objects.bulk_create([a for mw in chunk for a in mw.get_attachments()])
+
+    def _message_done(self):
+        if len(self.chunk) >= self.chunk_size:
+            self.flush()
+
 
 class MessageWrapper(object):
     """This class takes a bytes object (raw email message) or message object
@@ -621,6 +1095,10 @@ class MessageWrapper(object):
     filtered by message id, no use performing rest of message parsing.  This means you
     must explicitly call process() or access the archive_message object for the object
     to contain valid data.
+
+    Given bytes, only the headers are parsed, to self.headers.  The full MIME tree,
+    email_message, is parsed on first use.  Attachments are found from the part
+    headers, see walk_headers().  Given a message, bytes are serialized on first use.
     """
     def __init__(self, bytes=None, message=None, listname=None, private=False, backup=True):
         """Create a MessageWrapper out of raw bytes or a email.Message
@@ -635,18 +1113,21 @@ class MessageWrapper(object):
         self._date = None
         self.created_id = False
         if bytes is not None:
-            self.bytes = bytes
-            self.email_message = email.message_from_bytes(bytes, policy=NO_REFOLD_POLICY)
+            # bytes may be any bytes-like object, ie. memoryview
+            self._bytes = bytes
+            self._email_message = None
+            self.headers = parse_headers(bytes)
         else:
-            self.bytes = message.as_bytes(policy=NO_REFOLD_POLICY)
-            self.email_message = message
+            self._bytes = None
+            self._email_message = message
+            self.headers = message
         self.hashcode = None
         self.listname = listname
         self.private = private
         self.spam_score = 0
         
         # fail right away if no headers
-        if not list(self.email_message.items()):         # no headers, something is wrong
+        if not list(self.headers.items()):         # no headers, something is wrong
             raise NoHeaders
 
         self.msgid = self.get_msgid()
@@ -659,6 +1140,29 @@ class MessageWrapper(object):
     def from_message(cls, message, listname, private=False):
         return cls(message=message, listname=listname, private=private)
 
+    def _get_bytes(self):
+        """Returns the raw message"""
+        if self._bytes is None:
+            self._bytes = self._email_message.as_bytes(policy=NO_REFOLD_POLICY)
+        return self._bytes
+    bytes = property(_get_bytes)
+
+    def _get_email_message(self):
+        """Returns the email.message.Message, parsing the raw message, decoded as
+        message_from_bytes() does, on first use
+        """
+        if self._email_message is None:
+            self._email_message = email.message_from_string(str(self._bytes, 'ascii', 'surrogateescape'),
+                                                            policy=NO_REFOLD_POLICY)
+            if self.created_id:
+                # see get_msgid()
+                if 'message-id' in self._email_message:
+                    self._email_message.replace_header('Message-ID', self.msgid)
+                else:
+                    self._email_message.add_header('Message-ID', self.msgid)
+        return self._email_message
+    email_message = property(_get_email_message)
+
     def _get_archive_message(self):
         """Returns the archive.models.Message instance"""
         if self._archive_message is None:
@@ -673,12 +1177,24 @@ class MessageWrapper(object):
     date = property(_get_date)
 
     def _init_in_reply_to_fields(self):
-        """Initialize self.in_reply_to, self.in_reply_to_value"""
+        """Initialize self.in_reply_to_id, self.in_reply_to_value.  Prefers a message
+        in the same list, see archive.models.get_in_reply_to_message()
+        """
         assert self.email_list
-        self.in_reply_to_value = self.email_message.get('In-Reply-To', '')
-        self.in_reply_to = get_in_reply_to_message(
-            self.in_reply_to_value,
-            self.email_list)
+        self.in_reply_to_value = self.headers.get('In-Reply-To', '')
+        self.in_reply_to_id = None
+        msgids = parse_message_ids(self.in_reply_to_value)
+        if not msgids:
+            return
+        entry = thread_cache.get_messages(self.email_list, msgids[:1]).get(msgids[0])
+        if entry:
+            self.in_reply_to_id = entry[1]
+        else:
+            # none, or several, in the list
+            same_list = Case(When(email_list=self.email_list, then=Value(0)), default=Value(1),
+                             output_field=IntegerField())
+            messages = Message.objects.filter(msgid=msgids[0]).order_by(same_list, 'pk')
+            self.in_reply_to_id = messages.values_list('pk', flat=True).first()
 
     @staticmethod
     def get_addresses(text):
@@ -696,7 +1212,7 @@ class MessageWrapper(object):
 
     def get_cc(self):
         """Returns the CC field realname and email addresses"""
-        cc = self.email_message.get('cc')
+        cc = self.headers.get('cc')
         if not cc:
             return ''
         return self.get_addresses(cc)
@@ -716,7 +1232,7 @@ class MessageWrapper(object):
         2366079 of 2426328 records, 97.5% of the time (all but 2 were timezone aware)
         """
         for func in (get_received_date, get_header_date, get_envelope_date):
-            date = func(self.email_message)
+            date = func(self.headers)
             if date:
                 if is_aware(date):
                     # try:
@@ -727,7 +1243,7 @@ class MessageWrapper(object):
                     return date
         else:
             # can't really proceed without a date, likely indicates bigger parsing error
-            raise DateError("%s, %s" % (self.msgid, self.email_message.get_unixfrom()))
+            raise DateError("%s, %s" % (self.msgid, self.headers.get_unixfrom()))
 
     def get_hash(self):
         """Returns the message hashcode, a SHA-1 digest of the Message-ID and listname.
@@ -742,23 +1258,25 @@ class MessageWrapper(object):
         return b64.decode('utf8')
 
     def get_msgid(self):
-        msgid = self.normalize(self.email_message.get('Message-ID', ''))
+        msgid = self.normalize(self.headers.get('Message-ID', ''))
         if msgid:
             msgid = msgid.strip('<>')
         else:
             # see if this is a resent Message, which sometimes have missing Message-ID field
-            resent_msgid = self.email_message.get('Resent-Message-ID')
+            resent_msgid = self.headers.get('Resent-Message-ID')
             if resent_msgid:
                 msgid = resent_msgid.strip('<>')
         if not msgid:
             msgid = make_msgid('ARCHIVE')
             self.created_id = True
             self.spam_score = self.spam_score | settings.MARK_BITS['NO_MSGID']
-            # add message-id to email_message headers so it gets to disk file
-            if 'message-id' in self.email_message:
-                self.email_message.replace_header('Message-ID', msgid)
+            # add message-id to the message headers.  The raw message is unchanged,
+            # serialize it first if necessary
+            _ = self.bytes      # noqa
+            if 'message-id' in self.headers:
+                self.headers.replace_header('Message-ID', msgid)
             else:
-                self.email_message.add_header('Message-ID', msgid)
+                self.headers.add_header('Message-ID', msgid)
             # raise GenericWarning('No MessageID (%s)' % self.email_message.get_from())
         return msgid
 
@@ -766,7 +1284,7 @@ class MessageWrapper(object):
         """Gets the message subject.  If the subject looks like spam, long line with
         no spaces, truncate it so as not to cause index errors
         """
-        subject = self.normalize(self.email_message.get('Subject', ''))
+        subject = self.normalize(self.headers.get('Subject', ''))
         # TODO: spam?
         # if len(subject) > 120 and len(subject.split()) == 1:
         #    subject = subject[:120]
@@ -774,7 +1292,7 @@ class MessageWrapper(object):
 
     def get_to(self):
         """Returns the To field realname and email addresses"""
-        to = self.email_message.get('to')
+        to = self.headers.get('to')
         if not to:
             return ''
         return self.get_addresses(to)
@@ -787,30 +1305,31 @@ class MessageWrapper(object):
         - http://www.jwz.org/doc/threading.html
         - http://tools.ietf.org/html/rfc5256
         """
-        for header in (self.references, self.in_reply_to_value):
-            thread = self.get_thread_from_header(header)
-            if thread:
-                return thread
+        thread = self.get_thread_from_header(' '.join([self.references, self.in_reply_to_value]))
+        if thread:
+            return thread
 
         # check subject
         if subject_is_reply(self.subject):
-            messages = Message.objects.filter(email_list=self.email_list,
-                                              date__lt=self.date,
-                                              base_subject=self.base_subject).order_by('-date')
-            if messages:
-                return messages[0].thread
+            thread_id = thread_cache.get_subject_thread_id(self.email_list, self.base_subject, self.date)
+            thread = Thread.objects.filter(pk=thread_id).first() if thread_id else None
+            if thread:
+                return thread
 
         # return a new thread
         return Thread.objects.create(date=self.date, email_list=self.email_list)
 
     def get_thread_from_header(self, value):
-        """Returns the thread given text containing message ids"""
-        for msgid in parse_message_ids(value):
-            try:
-                message = Message.objects.get(email_list=self.email_list, msgid=msgid)
-                return message.thread
-            except (Message.DoesNotExist, Message.MultipleObjectsReturned):
-                pass
+        """Returns the thread given text containing message ids, the thread of the
+        first one found in the list.  See ThreadCache.get_messages()
+        """
+        msgids = parse_message_ids(value)
+        messages = thread_cache.get_messages(self.email_list, msgids)
+        for msgid in msgids:
+            if msgid in messages:
+                thread = Thread.objects.filter(pk=messages[msgid][0]).first()
+                if thread:
+                    return thread
 
     def normalize(self, header_text):
         """This function takes some header_text as a string.
@@ -841,49 +1360,62 @@ class MessageWrapper(object):
         """Perform the rest of the parsing and construct the Message object.  Note,
         we are not saving the object to the database.  This happens in the save() function.
         """
-        self.email_list, created = EmailList.objects.get_or_create(
-            name=self.listname, defaults={'description': self.listname, 'private': self.private})
-        if not created and self.private is True and self.email_list.private is False:
-            # the list has been changed from public to private
-            logger.info('Email List {} changed from public to private'.format(self.email_list.name))
-            self.email_list.private = True
-            self.email_list.save()
-        self.hashcode = self.get_hash()
+        self.email_list = get_email_list(self.listname, self.private)
+        thread_cache.sync()
+        self.process_headers()
         self._init_in_reply_to_fields()
-        self.references = self.email_message.get('References', '')
+        self.thread = self.get_thread()
+        self._archive_message = self.build_archive_message()
+        # not saving here.  Place the message in the thread incrementally if
+        # possible, else compute the whole thread, see save()
+        self.thread_info = None
+        info = place_message(self._archive_message)
+        if info is None:
+            thread_messages = list(self.thread.message_set.all().order_by('date'))
+            thread_messages.append(self._archive_message)
+            self.thread_info = compute_thread(thread_messages)
+            info = self.thread_info[self.hashcode]
+        self._archive_message.thread_depth = info.depth
+        self._archive_message.thread_order = info.order
+
+    def process_headers(self):
+        """Initialize the attributes which are derived from the message headers
+        alone.  No database access.
+        """
+        self.hashcode = self.get_hash()
+        self.in_reply_to_value = self.headers.get('In-Reply-To', '')
+        self.references = self.headers.get('References', '')
         self.subject = self.get_subject()
         self.base_subject = get_base_subject(self.subject)
-        self.thread = self.get_thread()
-        self.from_line = self.normalize(get_from(self.email_message)) or ''
+        self.from_line = self.normalize(get_from(self.headers)) or ''
         if self.from_line:
             self.from_line = self.from_line[5:].lstrip()    # we only need the unique part
-        self.frm = self.normalize(self.email_message.get('From', ''))
-        self._archive_message = Message(base_subject=self.base_subject,
-                                        cc=self.get_cc(),
-                                        date=self.date,
-                                        email_list=self.email_list,
-                                        frm=self.frm,
-                                        from_line=self.from_line,
-                                        hashcode=self.hashcode,
-                                        in_reply_to_value=self.in_reply_to_value,
-                                        in_reply_to=self.in_reply_to,
-                                        msgid=self.msgid,
-                                        references=self.references,
-                                        spam_score=self.spam_score,
-                                        subject=self.subject,
-                                        thread=self.thread,
-                                        to=self.get_to())
-        # not saving here.
-        thread_messages = list(self.thread.message_set.all().order_by('date'))
-        thread_messages.append(self._archive_message)
-        self.thread_info = compute_thread(thread_messages)
-        info = self.thread_info[self.hashcode]
-        self._archive_message.thread_depth = info.depth
-        self._archive_message.thread_order = info.order
+        self.frm = self.normalize(self.headers.get('From', ''))
 
-    def process_attachments(self, test=False):
+    def build_archive_message(self):
+        """Returns a new, unsaved, archive.models.Message.  Requires email_list,
+        in_reply_to_id and thread
         """
-        Walks the message parts and saves any attachments.  See is_attachment().
+        return Message(base_subject=self.base_subject,
+                       cc=self.get_cc(),
+                       date=self.date,
+                       email_list=self.email_list,
+                       frm=self.frm,
+                       from_line=self.from_line,
+                       hashcode=self.hashcode,
+                       in_reply_to_value=self.in_reply_to_value,
+                       in_reply_to_id=self.in_reply_to_id,
+                       msgid=self.msgid,
+                       references=self.references,
+                       spam_score=self.spam_score,
+                       subject=self.subject,
+                       thread=self.thread,
+                       to=self.get_to())
+
+    def get_attachments(self):
+        """
+        Walks the message parts and returns a list of unsaved Attachment objects.
+        See is_attachment().
         See docs for details: https://docs.python.org/3/library/email.message.html
         The message/external-body type indicates that the actual body data are not
         included, but merely referenced.
@@ -891,50 +1423,86 @@ class MessageWrapper(object):
         NOTE: Python 3 has iter_attachments()
         NOTE: get_filename() may return folded name so remove newlines
         """
-        for sequence, part in enumerate(self.email_message.walk()):
+        attachments = []
+        # find the parts without parsing the whole message if possible
+        parts = None
+        if self._email_message is None:
+            parts = walk_headers(self._bytes, self.headers)
+        if parts is None:
+            parts = self.email_message.walk()
+        for sequence, part in enumerate(parts):
             if is_attachment(part):
                 filename = get_filename(part)
                 filename = filename.replace('\r', '').replace('\n', '')
-                Attachment.objects.create(message=self.archive_message,
-                                          description='',
-                                          content_type=part.get_content_type(),
-                                          content_disposition=get_content_disposition(part),
-                                          name=filename,
-                                          sequence=sequence)
+                attachments.append(Attachment(message=self.archive_message,
+                                              description='',
+                                              content_type=part.get_content_type(),
+                                              content_disposition=get_content_disposition(part),
+                                              name=filename,
+                                              sequence=sequence))
+        return attachments
+
+    def process_attachments(self, test=False):
+        """Save any attachments.  See get_attachments()"""
+        for attachment in self.get_attachments():
+            attachment.save()
+
+    def inspect(self):
+        """Run the configured inspectors, see InspectorPipeline.  An inspector raises
+        an exception, ie. SpamMessage, if the message should not be archived
+        """
+        inspector_pipeline.inspect(self)
 
     def save(self, test=False):
         """Ensure message is not duplicate message-id or hash.  Save message to database.
         Save to disk (if not test mode) and process attachments.
         """
         # check for spam
-        if hasattr(settings, 'INSPECTORS'):
-            for inspector_name in settings.INSPECTORS:
-                inspector_class = eval(inspector_name)
-                inspector = inspector_class(self)
-                inspector.inspect()
-
-        # check for duplicate message id, and skip
-        if Message.objects.filter(msgid=self.msgid, email_list__name=self.listname):
+        self.inspect()
+
+        # check for duplicate message id, and skip.  Only query the database if the
+        # duplicate filter, when loaded, can't rule it out
+        duplicate_filter.sync()
+        if (duplicate_filter.might_contain_msgid(self.listname, self.msgid)
+                and Message.objects.filter(msgid=self.msgid, email_list__name=self.listname).exists()):
             self.write_msg(subdir='_dupes')
             raise DuplicateMessage('Duplicate msgid: %s' % self.msgid)
 
         # check for duplicate hash
-        if Message.objects.filter(hashcode=self.hashcode):
+        if self.hashcode is None:
+            self.hashcode = self.get_hash()
+        if (duplicate_filter.might_contain_hashcode(self.hashcode)
+                and Message.objects.filter(hashcode=self.hashcode).exists()):
             self.write_msg(subdir='_dupes')
             raise CommandError('Duplicate hash, msgid: %s' % self.msgid)
 
-        # ensure message has been processed
-        _ = self.archive_message    # noqa
-
         # write message to disk and then save, post_save signal calls indexer
-        # which requires file to be present
-        if not test:
-            self.write_msg()
+        # which requires file to be present.  The database changes are one
+        # transaction, if it fails the file is removed so that the archiver can
+        # retry the message, see archiver.SpoolDrainer
+        path = None if test else self.write_msg()
+        try:
+            with transaction.atomic():
+                self.save_to_database(test=test)
+        except BaseException:
+            if path:
+                os.remove(path)
+            raise
+        thread_cache.add(self.archive_message)
+
+    def save_to_database(self, test=False):
+        """Save the message, thread information and attachments"""
         self.archive_message.save()
 
-        # update thread information
-        if self.archive_message.thread.message_set.count() > 1:
-            reconcile_thread(self.thread_info)
+        # update thread information.  Bulk updates don't send post_save
+        if self.thread_info is None:
+            pks = shift_thread_order(self.archive_message)
+            if pks:
+                messages_updated.send(sender=Message, instances=Message.objects.filter(pk__in=pks))
+        elif self.archive_message.thread.message_set.count() > 1:
+            changed = reconcile_thread(self.thread_info)
+            if changed:
+                messages_updated.send(sender=Message, instances=changed)
 
         # now that the archive.Message object is created we can process any attachments
         self.process_attachments(test=test)
@@ -942,7 +1510,7 @@ class MessageWrapper(object):
     def write_msg(self, subdir=None):
         """Write a copy of the original email message to the disk archive.
         Use optional argument subdir to specify a subdirectory within the list directory
-        ie. "_filtered" or "_failure"
+        ie. "_filtered" or "_failure".  Returns the path written
         """
         # set filename
         filename = self.hashcode
@@ -963,3 +1531,4 @@ class MessageWrapper(object):
 
         # write file
         write_file(path, self.bytes)
+        return path
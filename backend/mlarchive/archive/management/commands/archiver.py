@@ -0,0 +1,34 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from mlarchive.archive.archiver import ArchiveServer
+from mlarchive.archive.spool import Spool
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Runs the persistent archiver process which accepts messages from archive-mail.py'
+
+    def add_arguments(self, parser):
+        parser.add_argument('-s', '--socket', dest='socket', default=settings.ARCHIVER_SOCKET,
+            help='path of the Unix socket to listen on (default is settings.ARCHIVER_SOCKET)')
+        parser.add_argument('--no-spool', action='store_true', dest='no_spool', default=False,
+            help='archive each message before responding instead of using settings.ARCHIVER_SPOOL_DIR')
+
+    def handle(self, *args, **options):
+        spool = None
+        if not options['no_spool']:
+            spool = Spool(settings.ARCHIVER_SPOOL_DIR, max_messages=settings.ARCHIVER_SPOOL_MAX_MESSAGES)
+        server = ArchiveServer(options['socket'], spool=spool)
+        logger.info('archiver listening on {}'.format(server.path))
+        if options['verbosity'] >= 1:
+            self.stdout.write('Archiver listening on {}'.format(server.path))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            logger.info('archiver stopped')
@@ -0,0 +1,15 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from mlarchive.archive.backends.client import check_health
+
+
+class Command(BaseCommand):
+    help = 'Checks Elasticsearch cluster health and prints client connection pool metrics as JSON'
+
+    def handle(self, *args, **options):
+        result = check_health()
+        self.stdout.write(json.dumps(result, indent=2))
+        if result['status'] in ('red', 'unavailable'):
+            raise CommandError('Elasticsearch status: {}'.format(result['status']))
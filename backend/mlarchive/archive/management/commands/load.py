@@ -6,17 +6,39 @@ import time
 
 from django.core.management.base import BaseCommand, CommandError
 
-from mlarchive.archive.models import EmailList, Legacy
-from mlarchive.archive.mail import get_mb, CustomMbox, Loader, UnknownFormat
+from mlarchive.archive.backends.elasticsearch import ESBackend, PREPARE_RELATED
+from mlarchive.archive.models import EmailList, Legacy, Message
+from mlarchive.archive.mail import (get_mb, BulkLoader, CustomMbox, Loader, UnknownFormat,
+    DEFAULT_BULK_CHUNK_SIZE)
+from mlarchive.archive.thread_cache import increment_generation
 
 import logging
 logger = logging.getLogger(__name__)
 
+FILE_PATTERN = re.compile(r'^\d{4}-\d{2}(|.mail)$')
+
 # --------------------------------------------------
 # Helper Functions
 # --------------------------------------------------
 
 
+def get_files(source):
+    """Returns the list of mailbox files to import from source, a file or a list
+    archive directory of YYYY-MM files
+    """
+    if os.path.isfile(source):
+        return [source]
+    elif os.path.isdir(source):
+        mboxs = [f for f in os.listdir(source) if FILE_PATTERN.match(f)]
+        # we need to import the files in chronological order so thread resolution works
+        sorted_mboxs = sorted(mboxs)
+        full = [os.path.join(source, x) for x in sorted_mboxs]
+        # exclude directories and empty files
+        return list(filter(isfile, full))
+    else:
+        raise CommandError("%s is not a file or directory" % source)
+
+
 def guess_list(path):
     """Try to guess the list we are importing based on header values
     """
@@ -41,6 +63,18 @@ def guess_list(path):
             return match.groups()[0]
 
 
+def index_messages(pks, batch_size=DEFAULT_BULK_CHUNK_SIZE):
+    """Index messages with the given primary keys.  Used after a bulk load, which
+    bypasses the signal processor.  The index is refreshed once, at the end
+    """
+    backend = ESBackend()
+    for start in range(0, len(pks), batch_size):
+        messages = list(Message.objects.filter(pk__in=pks[start:start + batch_size]).select_related(*PREPARE_RELATED))
+        if messages:
+            backend.update(messages, commit=False)
+    backend.client.indices.refresh(index=backend.index_name)
+
+
 def isfile(path):
     """Custom version of os.path.isfile, return True if path is an existing regular file
     and not empty
@@ -63,6 +97,10 @@ class Command(BaseCommand):
 
     def add_arguments(self, parser):
         parser.add_argument('source')
+        parser.add_argument('--bulk', action='store_true', dest='bulk', default=False,
+            help='save messages in chunks with bulk queries, for large imports.  messages are indexed at the end'),
+        parser.add_argument('--chunk-size', type=int, dest='chunk_size', default=DEFAULT_BULK_CHUNK_SIZE,
+            help='number of messages per chunk with --bulk (default is %s)' % DEFAULT_BULK_CHUNK_SIZE),
         parser.add_argument('-b', '--break', action='store_true', dest='break', default=False,
             help='break on error')
         parser.add_argument('-d', '--dry-run', action='store_true', dest='dryrun', default=False,
@@ -71,6 +109,8 @@ class Command(BaseCommand):
             help='mailbox format.  accepted values: mbox,mmdf (default is mbox)'),
         parser.add_argument('-l', '--listname', dest='listname',
             help='specify the name of the email list'),
+        parser.add_argument('--mmap', action='store_true', dest='mmap', default=False,
+            help='memory map mailbox files, faster for very large files'),
         parser.add_argument('-p', '--private', action='store_true', dest='private', default=False,
             help='private list (default is public)'),
         parser.add_argument('-s', '--summary', action='store_true', dest='summary', default=False,
@@ -86,19 +126,7 @@ class Command(BaseCommand):
         if options.get('firstrun') and Legacy.objects.all().count() == 0:
             raise CommandError('firstrun specified but the legacy archive table is empty')
 
-        # gather source files
-        if os.path.isfile(source):
-            files = [source]
-        elif os.path.isdir(source):
-            FILE_PATTERN = re.compile(r'^\d{4}-\d{2}(|.mail)$')
-            mboxs = [f for f in os.listdir(source) if FILE_PATTERN.match(f)]
-            # we need to import the files in chronological order so thread resolution works
-            sorted_mboxs = sorted(mboxs)
-            full = [os.path.join(source, x) for x in sorted_mboxs]
-            # exclude directories and empty files
-            files = list(filter(isfile, full))
-        else:
-            raise CommandError("%s is not a file or directory" % source)
+        files = get_files(source)
 
         # determine list
         if not options['listname']:
@@ -110,10 +138,20 @@ class Command(BaseCommand):
         options['listname'] = options['listname'].lower()
 
         start_time = time.time()
+        index = None
+        created_ids = []
+        updated_ids = set()
         for filename in files:
             try:
-                loader = Loader(filename, **options)
-                loader.process()
+                if options.get('bulk'):
+                    loader = BulkLoader(filename, index=index, **options)
+                    loader.process()
+                    index = loader.index
+                    created_ids.extend(loader.created_ids)
+                    updated_ids.update(loader.updated_ids)
+                else:
+                    loader = Loader(filename, **options)
+                    loader.process()
                 for key, val in list(loader.stats.items()):          # compile stats
                     stats[key] = stats.get(key, 0) + val
             except UnknownFormat as error:
@@ -126,6 +164,15 @@ class Command(BaseCommand):
                 logger.error("Import Error [Unknown file format, {0}]".format(error.args))
                 stats['unknown'] = stats.get('unknown', 0) + 1
 
+        # messages were archived without the archiver's thread cache
+        if not options['dryrun']:
+            increment_generation()
+
+        pks = created_ids + sorted(updated_ids.difference(created_ids))
+        if pks:
+            index_messages(pks)
+            stats['indexed'] = len(pks)
+
         stats['time'] = int(time.time() - start_time)
 
         if options.get('summary'):
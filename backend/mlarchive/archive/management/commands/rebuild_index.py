@@ -2,31 +2,86 @@
 
 from django.core.management import call_command
 from django.core.management.base import BaseCommand
+from django.utils.encoding import smart_bytes
+from django.utils.timezone import now
+
+from mlarchive.archive.backends.elasticsearch import (ESBackend, set_build_index, forget_private_pending,
+    update_private_pending)
+from mlarchive.archive.management.commands.update_index import get_chunks, index_chunk, remove_stale_records
+from mlarchive.archive.models import EmailList, Message
 
 
 class Command(BaseCommand):
-    help = "Completely rebuilds the search index by removing the old data and then updating."
+    help = ("Completely rebuilds the search index.  A new index is built with the current "
+            "mappings while searches use the existing one, then the index alias is switched.")
 
     def add_arguments(self, parser):
         parser.add_argument(
             '--noinput', action='store_false', dest='interactive', default=True,
-            help='If provided, no prompts will be issued to the user and the data will be wiped out.'
+            help='Ignored, the existing index is kept until the new one is complete.'
         )
         parser.add_argument(
             '--nocommit', action='store_false', dest='commit',
-            default=True, help='Will pass commit=False to the backend.'
+            default=True, help='Ignored, the new index is refreshed before it is used.'
         )
         parser.add_argument(
             '-b', '--batch-size', dest='batchsize', type=int, default=1000,
             help='Number of items to index at once.'
         )
+        parser.add_argument(
+            '-w', '--workers', type=int, default=0,
+            help='Number of worker processes to index with.'
+        )
+        parser.add_argument(
+            '-k', '--keep-old', action='store_true', dest='keep_old', default=False,
+            help='Keep the previous index after switching the alias.'
+        )
 
     def handle(self, **options):
-        clear_options = options.copy()
-        update_options = options.copy()
-        for key in ('batchsize', ):
-            del clear_options[key]
-        for key in ('interactive', ):
-            del update_options[key]
-        call_command('clear_index', **clear_options)
-        call_command('update_index', **update_options)
+        self.verbosity = int(options.get('verbosity', 1))
+        backend = ESBackend()
+        old_indices = backend.get_alias_indices()
+        replicas = None
+        if old_indices:
+            old_settings = backend.client.indices.get_settings(index=old_indices[0], name='index.number_of_replicas')
+            replicas = old_settings[old_indices[0]]['settings']['index']['number_of_replicas']
+
+        # Build the new index with replicas and refresh off.  Writes from now on also
+        # go to the new index, messages updated during the build are indexed again
+        # at the end, and messages deleted during the build removed, to cover writers
+        # which haven't seen the build yet
+        name = backend.create_index(bulk_load=True)
+        if self.verbosity >= 1:
+            self.stdout.write("Building index {}".format(name))
+        start = now()
+        set_build_index(name)
+        # searches exclude private lists by name until the new index is used, then
+        # rely on its private field, see ElasticsearchQuery.exclude_private_lists()
+        list_names = list(EmailList.objects.values_list('name', flat=True))
+        update_private_pending(list_names, 1, reset=True)
+        try:
+            call_command('update_index', index_name=name, batchsize=options['batchsize'],
+                         workers=options['workers'], commit=False, verbosity=self.verbosity,
+                         stdout=self.stdout)
+            new_backend = ESBackend(name)
+            updated = Message.objects.filter(updated__gte=start)
+            for low, high in get_chunks(updated, options['batchsize']):
+                index_chunk(new_backend, updated, low, high, verbosity=self.verbosity, commit=False)
+            backend.finish_bulk_load(name, replicas=replicas)
+            database_pks = set(smart_bytes(pk) for pk in Message.objects.values_list('pk', flat=True))
+            remove_stale_records(new_backend, database_pks, options['batchsize'], verbosity=self.verbosity,
+                                 stdout=self.stdout)
+            removed = backend.swap_alias(name)
+            update_private_pending(list_names, -1)
+        except BaseException:
+            forget_private_pending()
+            backend.client.indices.delete(index=name, ignore=404)
+            raise
+        finally:
+            set_build_index(None)
+
+        if self.verbosity >= 1:
+            self.stdout.write("Index {} now refers to {}".format(backend.index_name, name))
+        if not options['keep_old']:
+            for index in removed:
+                backend.client.indices.delete(index=index, ignore=404)
@@ -1,19 +1,22 @@
+import json
 import logging
 import multiprocessing
 import os
+import queue
+import threading
 import time
 
 from datetime import timedelta
 
-from django.conf import settings
-from django.core.management.base import BaseCommand
-from django.db import close_old_connections, reset_queries
+from django.core.management.base import BaseCommand, CommandError
+from django.db import close_old_connections, connection, connections, reset_queries
+from django.db.models import Max, Min
 from django.utils.encoding import force_text, smart_bytes
 from django.utils.timezone import now
 from elasticsearch_dsl import Search
 
 from mlarchive.archive.models import Message
-from mlarchive.archive.backends.elasticsearch import ESBackend
+from mlarchive.archive.backends.elasticsearch import ESBackend, PREPARE_RELATED
 
 LOG = multiprocessing.log_to_stderr(level=logging.WARNING)
 logger = logging.getLogger(__name__)
@@ -23,41 +26,57 @@ DEFAULT_AGE = None
 DEFAULT_MAX_RETRIES = 5
 
 
-def do_update(backend, qs, start, end, total, verbosity=1, commit=True,
-              max_retries=DEFAULT_MAX_RETRIES, last_max_pk=None):
+class QueryCounter(object):
+    """Counts the database queries run in the block, doesn't require DEBUG"""
 
-    logger.debug('do_update() called. backend={}, qs={}'.format(
-        type(backend), qs.count()))
+    def __init__(self):
+        self.count = 0
 
-    # Get a clone of the QuerySet so that the cache doesn't bloat up
-    # in memory. Useful when reindexing large amounts of data.
-    small_cache_qs = qs.all()
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
 
-    # If we got the max seen PK from last batch, use it to restrict the qs
-    # to values above; this optimises the query for Postgres as not to
-    # devolve into multi-second run time at large offsets.
-    if last_max_pk is not None:
-        current_qs = small_cache_qs.filter(pk__gt=last_max_pk)[:end - start]
-    else:
-        current_qs = small_cache_qs[start:end]
+    def __enter__(self):
+        self.wrapper = connection.execute_wrapper(self)
+        self.wrapper.__enter__()
+        return self
 
-    # Remember maximum PK seen so far
-    max_pk = None
-    current_qs = list(current_qs)
-    if current_qs:
-        max_pk = current_qs[-1].pk
+    def __exit__(self, *exc_info):
+        return self.wrapper.__exit__(*exc_info)
 
-    if verbosity >= 2:
-        print("  indexed %s - %d of %d." % (start + 1, end, total))
-        
+
+def index_chunk(backend, qs, low, high, verbosity=1, commit=True, max_retries=DEFAULT_MAX_RETRIES):
+    """Index the messages of qs with low < pk <= high.  Returns tuple of
+    (documents, queries)"""
+    counter = QueryCounter()
+    with counter:
+        messages = get_chunk_messages(qs, low, high)
+
+    if messages:
+        with counter:
+            with_retries(lambda: backend.update(messages, commit=commit), low, high,
+                         verbosity=verbosity, max_retries=max_retries)
+
+    # Clear out the DB connections queries because it bloats up RAM.
+    reset_queries()
+    return len(messages), counter.count
+
+
+def get_chunk_messages(qs, low, high):
+    return list(qs.filter(pk__gt=low, pk__lte=high).select_related(*PREPARE_RELATED).order_by('pk'))
+
+
+def with_retries(func, low, high, verbosity=1, max_retries=DEFAULT_MAX_RETRIES):
+    """Call func, the update of chunk low - high, retrying failures with a
+    growing delay"""
     retries = 0
     while retries < max_retries:
         try:
-            backend.update(current_qs, commit=commit)
+            func()
             if verbosity >= 2 and retries:
                 print('Completed indexing {} - {}, tried {}/{} times'.format(
-                    start + 1,
-                    end,
+                    low + 1,
+                    high,
                     retries + 1,
                     max_retries))
             break
@@ -66,8 +85,8 @@ def do_update(backend, qs, start, end, total, verbosity=1, commit=True,
             # KeyboardInterrupt.
             retries += 1
 
-            error_context = {'start': start + 1,
-                             'end': end,
+            error_context = {'start': low + 1,
+                             'end': high,
                              'retries': retries,
                              'max_retries': max_retries,
                              'pid': os.getpid(),
@@ -84,9 +103,253 @@ def do_update(backend, qs, start, end, total, verbosity=1, commit=True,
             # If going to try again, sleep a bit before
             time.sleep(2 ** retries)
 
-    # Clear out the DB connections queries because it bloats up RAM.
-    reset_queries()
-    return max_pk
+
+def worker_index_chunk(task):
+    """Index a chunk in a worker process.  Each process has its own database
+    connection and Elasticsearch client, see backends/client.py"""
+    index_name, filters, low, high, verbosity, commit, max_retries = task
+    qs = Message.objects.filter(**filters)
+    documents, queries = index_chunk(ESBackend(index_name), qs, low, high, verbosity=verbosity,
+                                     commit=commit, max_retries=max_retries)
+    return low, high, documents, queries
+
+
+def remove_stale_records(backend, database_pks, batch_size, verbosity=1, commit=True, stdout=None):
+    """Remove the records of the index whose message is no longer in the database.
+    database_pks is the set of primary keys, as bytes, of all messages"""
+    # Since records may still be in the search index but not the local database
+    # we'll use that to create batches for processing.
+    s = Search(using=backend.client, index=backend.index_name)
+    index_total = s.count()
+
+    # Retrieve PKs from the index. Note that this cannot be a numeric range query because although
+    # pks are normally numeric they can be non-numeric UUIDs or other custom values. To reduce
+    # load on the search engine, we only retrieve the pk field, which will be checked against the
+    # full list obtained from the database, and the id field, which will be used to delete the
+    # record should it be found to be stale.
+    s = Search(using=backend.client, index=backend.index_name)
+    s = s.source(fields={'includes': ['django_id', 'id']})
+    s = s.scan()
+    index_pks = [(h['django_id'], h['id']) for h in s]
+    # index_pks = SearchQuerySet(using=backend.connection_alias).models(model)
+    # index_pks = index_pks.values_list('pk', 'id')
+
+    # We'll collect all of the record IDs which are no longer present in the database and delete
+    # them after walking the entire index. This uses more memory than the incremental approach but
+    # avoids needing the pagination logic below to account for both commit modes:
+    stale_records = set()
+
+    for start in range(0, index_total, batch_size):
+        upper_bound = start + batch_size
+
+        # If the database pk is no longer present, queue the index key for removal:
+        for pk, rec_id in index_pks[start:upper_bound]:
+            if smart_bytes(pk) not in database_pks:
+                stale_records.add(rec_id)
+
+    if stale_records:
+        if verbosity >= 1:
+            stdout.write("  removing %d stale records." % len(stale_records))
+
+        for rec_id in stale_records:
+            # Since the PK was not in the database list, we'll delete the record from the search
+            # index:
+            if verbosity >= 2:
+                stdout.write("  removing %s." % rec_id)
+
+            backend.remove(rec_id, commit=commit)
+
+
+def get_chunks(qs, batch_size):
+    """Returns list of (low, high) primary key ranges covering qs, low < pk <= high.
+    Ranges are batch_size primary key values wide, so they don't depend on which
+    messages exist, and are the same when a run is resumed"""
+    bounds = qs.aggregate(Min('pk'), Max('pk'))
+    if bounds['pk__min'] is None:
+        return []
+    first = bounds['pk__min'] - 1
+    return [(low, min(low + batch_size, bounds['pk__max']))
+            for low in range(first, bounds['pk__max'], batch_size)]
+
+
+class Stage(object):
+    """Throughput of a pipeline stage.  seconds is the time spent working, summed
+    over the stage's processes"""
+
+    def __init__(self, name, processes=1):
+        self.name = name
+        self.processes = processes
+        self.documents = 0
+        self.seconds = 0.0
+
+    def add(self, documents, seconds):
+        self.documents += documents
+        self.seconds += seconds
+
+    def __str__(self):
+        rate = self.documents * self.processes / self.seconds if self.seconds else 0
+        return '{}: {} documents, {:.1f}s in {} process(es), {:.0f} documents/s'.format(
+            self.name, self.documents, self.seconds, self.processes, rate)
+
+
+def extract_chunk(task):
+    """Prepare the index documents of a chunk in an extraction process.  Returns
+    tuple of (documents, seconds)"""
+    index_name, messages = task
+    start = time.perf_counter()
+    documents = ESBackend(index_name).prepare(messages)
+    return documents, time.perf_counter() - start
+
+
+class IndexPipeline(object):
+    """Indexes chunks in three stages, running at the same time: fetch, a thread
+    loading the messages of each chunk from the database, extract, a pool of
+    worker processes preparing the index documents, which parses the message
+    files, and submit, sending the documents to Elasticsearch.  The stages are
+    connected by queues holding at most queue_size chunks, so a slow stage holds
+    back the stages before it, rather than chunks piling up in memory"""
+
+    def __init__(self, backend, qs, workers, queue_size=None, verbosity=1, commit=True,
+                 max_retries=DEFAULT_MAX_RETRIES):
+        self.backend = backend
+        self.qs = qs
+        self.workers = workers
+        self.queue_size = queue_size or workers * 2
+        self.verbosity = verbosity
+        self.commit = commit
+        self.max_retries = max_retries
+        self.stages = [Stage('fetch'), Stage('extract', workers), Stage('submit')]
+        self.seconds = 0.0
+        self.stopped = threading.Event()
+
+    def run(self, chunks, chunk_done):
+        """Index chunks, calling chunk_done(low, high, documents, queries) as each
+        chunk is submitted, in order"""
+        fetched = queue.Queue(self.queue_size)
+        extracted = queue.Queue(self.queue_size)
+        start = time.perf_counter()
+        # extraction processes don't use the database
+        connections.close_all()
+        context = multiprocessing.get_context('fork')
+        with context.Pool(self.workers) as pool:
+            threads = [
+                threading.Thread(target=self.fetch, args=(chunks, fetched)),
+                threading.Thread(target=self.extract, args=(pool, fetched, extracted))]
+            for thread in threads:
+                thread.start()
+            try:
+                self.submit(extracted, chunk_done)
+            finally:
+                self.stopped.set()
+                for thread in threads:
+                    thread.join()
+        self.seconds = time.perf_counter() - start
+
+    def put(self, q, item):
+        """Put item in q, unless the pipeline stops while waiting for room"""
+        while not self.stopped.is_set():
+            try:
+                q.put(item, timeout=1)
+                return
+            except queue.Full:
+                pass
+
+    def get(self, q):
+        """Get item from q, returns None if the pipeline stops while waiting"""
+        while not self.stopped.is_set():
+            try:
+                return q.get(timeout=1)
+            except queue.Empty:
+                pass
+
+    def fetch(self, chunks, fetched):
+        stage = self.stages[0]
+        try:
+            for low, high in chunks:
+                if self.stopped.is_set():
+                    return
+                start = time.perf_counter()
+                counter = QueryCounter()
+                with counter:
+                    messages = get_chunk_messages(self.qs, low, high)
+                stage.add(len(messages), time.perf_counter() - start)
+                self.put(fetched, (low, high, messages, counter.count))
+            self.put(fetched, None)
+        except Exception as exc:
+            self.put(fetched, exc)
+        finally:
+            # the thread's own database connection
+            connection.close()
+
+    def extract(self, pool, fetched, extracted):
+        try:
+            while True:
+                item = self.get(fetched)
+                if item is None or isinstance(item, Exception):
+                    self.put(extracted, item)
+                    return
+                low, high, messages, queries = item
+                result = pool.apply_async(extract_chunk, ((self.backend.index_name, messages),))
+                self.put(extracted, (low, high, result, queries))
+        except Exception as exc:
+            self.put(extracted, exc)
+
+    def submit(self, extracted, chunk_done):
+        stage = self.stages[2]
+        while True:
+            item = extracted.get()
+            if item is None:
+                return
+            if isinstance(item, Exception):
+                raise item
+            low, high, result, queries = item
+            documents, seconds = result.get()
+            self.stages[1].add(len(documents), seconds)
+            start = time.perf_counter()
+            if documents:
+                with_retries(lambda: self.backend.update_prepared(documents, commit=self.commit), low, high,
+                             verbosity=self.verbosity, max_retries=self.max_retries)
+            stage.add(len(documents), time.perf_counter() - start)
+            chunk_done(low, high, len(documents), queries)
+
+    def report(self):
+        """Returns list of lines describing the throughput of each stage"""
+        documents = self.stages[-1].documents
+        rate = documents / self.seconds if self.seconds else 0
+        lines = [str(stage) for stage in self.stages]
+        lines.append('pipeline: {} documents in {:.1f}s, {:.0f} documents/s'.format(documents, self.seconds, rate))
+        return lines
+
+
+class Checkpoint(object):
+    """Records the chunks indexed, in a JSON file, so an interrupted run can be
+    resumed.  options identify the run, a checkpoint of a run with different
+    options can't be used"""
+
+    def __init__(self, path, options):
+        self.path = path
+        self.options = options
+        self.done = set()
+        if path and os.path.exists(path):
+            with open(path) as f:
+                data = json.load(f)
+            if data['options'] != options:
+                raise CommandError('Checkpoint {} is for a run with different options: {}'.format(
+                    path, data['options']))
+            self.done = set(data['done'])
+
+    def add(self, low):
+        self.done.add(low)
+        if not self.path:
+            return
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'options': self.options, 'done': sorted(self.done)}, f)
+        os.replace(tmp_path, self.path)
+
+    def remove(self):
+        if self.path and os.path.exists(self.path):
+            os.remove(self.path)
 
 
 class Command(BaseCommand):
@@ -117,7 +380,25 @@ class Command(BaseCommand):
         )
         parser.add_argument(
             '--nocommit', action='store_false', dest='commit',
-            default=True, help='Will pass commit=False to the backend.'
+            default=True, help="Don't refresh the index once indexing is done."
+        )
+        parser.add_argument(
+            '-w', '--workers', type=int, default=0,
+            help='Number of worker processes to index with.  Default is to index in this process.'
+        )
+        parser.add_argument(
+            '-p', '--pipeline', action='store_true', default=False,
+            help='Index in stages, fetching messages, extracting their text in --workers processes, '
+                 'default one per CPU, and submitting documents at the same time.'
+        )
+        parser.add_argument(
+            '-i', '--index', dest='index_name',
+            help='Name of the index to update.  Default is settings.ELASTICSEARCH_INDEX_NAME.'
+        )
+        parser.add_argument(
+            '-c', '--checkpoint',
+            help='Path of a file recording progress.  If the file exists, indexing resumes '
+                 'after the chunks it records.  Removed when indexing completes.'
         )
 
     def handle(self, **options):
@@ -127,8 +408,11 @@ class Command(BaseCommand):
         self.end_date = None
         self.remove = options.get('remove', False)
         self.workers = options.get('workers', 0)
+        self.pipeline = options.get('pipeline', False)
         self.commit = options.get('commit', True)
         self.max_retries = options.get('max_retries', DEFAULT_MAX_RETRIES)
+        self.checkpoint_path = options.get('checkpoint')
+        self.index_name = options.get('index_name')
 
         age = options.get('age', DEFAULT_AGE)
         start_date = options.get('start_date')
@@ -165,7 +449,7 @@ class Command(BaseCommand):
             raise
 
     def update_backend(self):
-        backend = ESBackend()
+        backend = ESBackend(self.index_name)
         
         # handle date range
         kwargs = {}
@@ -184,16 +468,53 @@ class Command(BaseCommand):
             self.stdout.write("Indexing {} Messages".format(total))
 
         batch_size = self.batchsize
-
-        max_pk = None
-        for start in range(0, total, batch_size):
-            end = min(start + batch_size, total)
-
-            max_pk = do_update(backend, qs, start, end, total,
-                               verbosity=self.verbosity,
-                               commit=self.commit, max_retries=self.max_retries,
-                               last_max_pk=max_pk)
-            logger.debug('max_pk: {}'.format(max_pk))
+        chunks = get_chunks(qs, batch_size)
+        checkpoint = Checkpoint(self.checkpoint_path, {
+            'start_date': self.start_date.isoformat() if self.start_date else None,
+            'end_date': self.end_date.isoformat() if self.end_date else None,
+            'batch_size': batch_size,
+            'index': backend.index_name})
+        todo = [chunk for chunk in chunks if chunk[0] not in checkpoint.done]
+        if self.verbosity >= 1 and len(todo) < len(chunks):
+            self.stdout.write("Resuming, {} of {} chunks done".format(len(chunks) - len(todo), len(chunks)))
+
+        stats = {'documents': 0, 'queries': 0}
+
+        def chunk_done(low, high, documents, queries):
+            checkpoint.add(low)
+            stats['documents'] += documents
+            stats['queries'] += queries
+            if self.verbosity >= 2:
+                print("  indexed pk {} - {}, {} documents, {} queries.".format(low + 1, high, documents, queries))
+
+        # bulk requests don't wait for a refresh, with commit the index is refreshed once
+        # at the end
+        if self.pipeline:
+            pipeline = IndexPipeline(backend, qs, self.workers if self.workers > 0 else os.cpu_count(),
+                                     verbosity=self.verbosity, commit=False, max_retries=self.max_retries)
+            pipeline.run(todo, chunk_done)
+            if self.verbosity >= 1:
+                for line in pipeline.report():
+                    self.stdout.write('  ' + line)
+        elif self.workers > 1:
+            tasks = [(backend.index_name, kwargs, low, high, self.verbosity, False, self.max_retries)
+                     for low, high in todo]
+            # each worker opens its own database connection
+            connections.close_all()
+            context = multiprocessing.get_context('fork')
+            with context.Pool(self.workers) as pool:
+                for result in pool.imap_unordered(worker_index_chunk, tasks):
+                    chunk_done(*result)
+        else:
+            for low, high in todo:
+                documents, queries = index_chunk(backend, qs, low, high, verbosity=self.verbosity,
+                                                 commit=False, max_retries=self.max_retries)
+                chunk_done(low, high, documents, queries)
+        checkpoint.remove()
+
+        if self.verbosity >= 1 and stats['documents']:
+            self.stdout.write("Indexed {} documents with {} queries, {:.2f} per document".format(
+                stats['documents'], stats['queries'], stats['queries'] / stats['documents']))
 
         if self.remove:
             if self.start_date or self.end_date or total <= 0:
@@ -204,44 +525,8 @@ class Command(BaseCommand):
             else:
                 database_pks = set(smart_bytes(pk) for pk in qs.values_list('pk', flat=True))
 
-            # Since records may still be in the search index but not the local database
-            # we'll use that to create batches for processing.
-            s = Search(using=backend.client, index=settings.ELASTICSEARCH_INDEX_NAME)
-            index_total = s.count()
-
-            # Retrieve PKs from the index. Note that this cannot be a numeric range query because although
-            # pks are normally numeric they can be non-numeric UUIDs or other custom values. To reduce
-            # load on the search engine, we only retrieve the pk field, which will be checked against the
-            # full list obtained from the database, and the id field, which will be used to delete the
-            # record should it be found to be stale.
-            s = Search(using=backend.client, index=settings.ELASTICSEARCH_INDEX_NAME)
-            s = s.source(fields={'includes': ['django_id', 'id']})
-            s = s.scan()
-            index_pks = [(h['django_id'], h['id']) for h in s]
-            # index_pks = SearchQuerySet(using=backend.connection_alias).models(model)
-            # index_pks = index_pks.values_list('pk', 'id')
-
-            # We'll collect all of the record IDs which are no longer present in the database and delete
-            # them after walking the entire index. This uses more memory than the incremental approach but
-            # avoids needing the pagination logic below to account for both commit modes:
-            stale_records = set()
-
-            for start in range(0, index_total, batch_size):
-                upper_bound = start + batch_size
-
-                # If the database pk is no longer present, queue the index key for removal:
-                for pk, rec_id in index_pks[start:upper_bound]:
-                    if smart_bytes(pk) not in database_pks:
-                        stale_records.add(rec_id)
-
-            if stale_records:
-                if self.verbosity >= 1:
-                    self.stdout.write("  removing %d stale records." % len(stale_records))
-
-                for rec_id in stale_records:
-                    # Since the PK was not in the database list, we'll delete the record from the search
-                    # index:
-                    if self.verbosity >= 2:
-                        self.stdout.write("  removing %s." % rec_id)
-
-                    backend.remove(rec_id, commit=self.commit)
+            remove_stale_records(backend, database_pks, batch_size, verbosity=self.verbosity,
+                                 commit=False, stdout=self.stdout)
+
+        if self.commit:
+            backend.client.indices.refresh(index=backend.index_name)
@@ -1,14 +1,21 @@
+import base64
+import binascii
+import hashlib
+import json
 import random
 import re
+import threading
 from datetime import datetime, timedelta
 
 from django.conf import settings
 from django.core.cache import cache
 from django.core.paginator import Paginator
-from elasticsearch import Elasticsearch
+from django.utils.functional import cached_property
 from elasticsearch.exceptions import RequestError
 from elasticsearch_dsl import Q, Search
+from elasticsearch_dsl.response import Response
 
+from mlarchive.archive.backends.client import get_client
 from mlarchive.archive.utils import get_lists
 
 import logging
@@ -25,6 +32,11 @@ VALID_SORT_OPTIONS = ('frm', '-frm', 'date', '-date', 'email_list', '-email_list
 DEFAULT_SORT = getattr(settings, 'ARCHIVE_DEFAULT_SORT', '-date')
 DB_THREAD_SORT_FIELDS = ('-thread__date', 'thread_id', 'thread_order')
 IDX_THREAD_SORT_FIELDS = ('-thread_date', 'thread_id', 'thread_order')
+# last index sort field, so results have a unique order, see get_query_neighbors()
+SORT_TIEBREAKER = 'django_id'
+SEARCH_CACHE_KEY_PREFIX = 'search_results:'
+SEARCH_GENERATION_KEY = 'search_generation:{}'
+ALL_LISTS = '*'
 
 # --------------------------------------------------
 # Functions handle URL parameters
@@ -58,8 +70,7 @@ def get_cached_query(request):
     search_dict = cache.get(queryid)
     if search_dict:
         logger.debug('Found search in cache: {}'.format(search_dict))
-        client = Elasticsearch()
-        search = Search(using=client, index=settings.ELASTICSEARCH_INDEX_NAME)
+        search = Search(using=get_client(), index=settings.ELASTICSEARCH_INDEX_NAME)
         search = search.update_from_dict(search_dict)
         logger.debug('Built search object from cache: {}'.format(search))
         return (queryid, search)
@@ -259,19 +270,221 @@ def get_count(query):
 # TODO: remove?
 def get_empty_response():
     '''Return an empty elasticsearch response'''
-    client = Elasticsearch()
-    s = Search(using=client, index=settings.ELASTICSEARCH_INDEX_NAME)
+    s = Search(using=get_client(), index=settings.ELASTICSEARCH_INDEX_NAME)
     s = s.query('term', dummy='')
     return s.execute()
 
 
+def get_search_cache_key(search, list_names=None):
+    """Returns the cache key of results of search, see CustomPaginator.  The key is a
+    digest of the search body, which is the same for equivalent queries, and includes
+    the private lists hidden from the user, so users who can see the same lists share
+    entries.  list_names are the lists the search is limited to, None for all lists,
+    the key changes when messages are added to them, see invalidate_search_cache()
+    """
+    keys = [SEARCH_GENERATION_KEY.format(name.lower()) for name in sorted(set(list_names or [ALL_LISTS]))]
+    generations = cache.get_many(keys)
+    data = json.dumps({
+        'search': search.to_dict(),
+        'generations': [generations.get(key) for key in keys]}, sort_keys=True, default=str)
+    return SEARCH_CACHE_KEY_PREFIX + hashlib.md5(data.encode('utf8')).hexdigest()
+
+
+def invalidate_search_cache(list_names):
+    """Expire cached results of searches of list_names, or of all lists, called when
+    messages of the lists change.  Entries already cached are no longer used, and
+    expire after SEARCH_RESULTS_CACHE_TIMEOUT"""
+    for name in {name.lower() for name in list_names} | {ALL_LISTS}:
+        key = SEARCH_GENERATION_KEY.format(name)
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.set(key, 1, timeout=None)
+
+
+def invalidate_search_cache_after_update(list_names, refreshed=False):
+    """Expire cached results of list_names after their messages were sent to the index.
+    If the request waited for the refresh (refreshed) they are expired once, otherwise
+    now and again SEARCH_RESULTS_CACHE_REFRESH_DELAY seconds later, from a timer thread,
+    so results cached before the changes are searchable aren't used for long"""
+    invalidate_search_cache(list_names)
+    if not refreshed and settings.SEARCH_RESULTS_CACHE_TIMEOUT:
+        timer = threading.Timer(settings.SEARCH_RESULTS_CACHE_REFRESH_DELAY, invalidate_search_cache,
+                                args=(list(list_names),))
+        timer.daemon = True
+        timer.start()
+
+
+def get_search_from_dict(body):
+    return Search(using=get_client(), index=settings.ELASTICSEARCH_INDEX_NAME).update_from_dict(body)
+
+
+def get_sort_field(item):
+    """Returns the field of an Elasticsearch sort item, a field name or
+    {field: options} dictionary"""
+    return item if isinstance(item, str) else list(item)[0]
+
+
+def reverse_sort(sort):
+    """Returns the reverse of Elasticsearch sort, a list of field names or
+    {field: options} dictionaries"""
+    result = []
+    for item in sort:
+        field = get_sort_field(item)
+        options = {} if isinstance(item, str) else item[field]
+        if isinstance(options, str):
+            options = {'order': options}
+        order = options.get('order', 'desc' if field == '_score' else 'asc')
+        options = dict(options, order='asc' if order == 'desc' else 'desc')
+        if field != '_score':
+            # documents missing the field sort last
+            options['missing'] = '_first' if options.get('missing', '_last') == '_last' else '_last'
+        result.append({field: options})
+    return result
+
+
+def get_cursor_body(search, size, aggs=False):
+    """Returns the body of search, as a dictionary, for paging with search_after:
+    size results, no offset, and SORT_TIEBREAKER as the last sort field, so a
+    message's sort values identify its position.  Without aggregations unless
+    aggs"""
+    body = search.to_dict()
+    body.pop('from', None)
+    body.pop('highlight', None)
+    if not aggs:
+        body.pop('aggs', None)
+    # default sort is relevance
+    sort = list(body.get('sort') or ['_score'])
+    if SORT_TIEBREAKER not in [get_sort_field(item) for item in sort]:
+        sort.append(SORT_TIEBREAKER)
+    body.update(sort=sort, size=size)
+    return body
+
+
+def get_cursor_digest(body):
+    """Returns a short digest of the query and sort of body, from get_cursor_body()"""
+    data = json.dumps({key: body.get(key) for key in ('query', 'post_filter', 'sort')}, sort_keys=True, default=str)
+    return hashlib.md5(data.encode('utf8')).hexdigest()[:12]
+
+
+def encode_cursor(sort_values, body=None):
+    """Returns a paging cursor, the sort values of a result as urlsafe base64 encoded
+    JSON, so the next results are fetched with search_after in one request.  With
+    body, from get_cursor_body(), the cursor is only used with the same search, see
+    decode_cursor()"""
+    data = {'s': list(sort_values)}
+    if body is not None:
+        data['q'] = get_cursor_digest(body)
+    value = json.dumps(data, separators=(',', ':'), default=str).encode('utf8')
+    return base64.urlsafe_b64encode(value).decode('ascii').rstrip('=')
+
+
+def decode_cursor(value, body):
+    """Returns the sort values of a cursor from encode_cursor(), or None if it is
+    invalid or was made for a different search than body"""
+    try:
+        data = json.loads(base64.urlsafe_b64decode(value + '=' * (-len(value) % 4)).decode('utf8'))
+        sort_values = data['s']
+    except (binascii.Error, ValueError, TypeError, KeyError):
+        return None
+    if not isinstance(sort_values, list) or len(sort_values) != len(body['sort']):
+        return None
+    if not all(v is None or isinstance(v, (str, int, float)) for v in sort_values):
+        return None
+    if 'q' in data and data['q'] != get_cursor_digest(body):
+        return None
+    return sort_values
+
+
+def get_sort_values(body, message_id):
+    """Returns the sort values of message_id in the results of search body, from
+    get_cursor_body(), or None if it isn't in the results"""
+    query = {'bool': {
+        'must': [body.get('query', {'match_all': {}})],
+        'filter': [{'ids': {'values': ['archive.message.{}'.format(message_id)]}}]}}
+    located = dict(body, query=query, size=1, _source=False)
+    located.pop('aggs', None)
+    response = get_search_from_dict(located).execute()
+    if not response.hits:
+        return None
+    return list(response.hits[0].meta.sort)
+
+
+def get_search_after(body, sort_values, reverse=False):
+    """Returns Search for the results of body, from get_cursor_body(), after the
+    result with sort_values, or with reverse the results before it, nearest first"""
+    if reverse:
+        body = dict(body, sort=reverse_sort(body['sort']))
+    return get_search_from_dict(dict(body, search_after=sort_values))
+
+
+def execute_search_after(body, sort_values, reverse=False, **params):
+    """Returns response of the results of body after, or with reverse before, the
+    result with sort_values, in the order of body.  params are passed to the
+    request, ie. track_total_hits"""
+    search = get_search_after(body, sort_values, reverse=reverse)
+    data = get_client().search(index=settings.ELASTICSEARCH_INDEX_NAME, body=dict(search.to_dict(), **params))
+    if reverse:
+        data['hits']['hits'].reverse()
+    return Response(search, data)
+
+
 class CustomPaginator(Paginator):
     '''A Django Paginator customized to handle Elasticsearch Search
     object as object_list input. page.object_list is the search
-    response object'''
+    response object.  For a Search, page() runs a single request, with
+    track_total_hits, and count is the total of its response, rather than
+    another request.
+
+    cursor is an optional tuple of ("after" or "before", cursor), the cursor,
+    see encode_cursor(), of the last message of the previous page or first
+    message of the next page.  The page is then fetched with search_after,
+    which costs the same at any depth, rather than an offset.  An invalid
+    cursor, or one from a different search, is ignored.
+
+    With cache_key, from get_search_cache_key(), the page response is cached
+    for SEARCH_RESULTS_CACHE_TIMEOUT seconds'''
+
+    def __init__(self, object_list, per_page, cursor=None, cache_key=None, **kwargs):
+        super().__init__(object_list, per_page, **kwargs)
+        self.cursor = cursor
+        self.cache_key = cache_key
+        self.response = None
+
+    @cached_property
+    def count(self):
+        if self.response is not None:
+            return self.response.hits.total.value
+        return super().count
 
     def page(self, number):
         """Return a Page object for the given 1-based page number."""
+        if isinstance(self.object_list, Search) and not self.orphans:
+            try:
+                bottom = (int(number) - 1) * self.per_page
+            except (TypeError, ValueError):
+                bottom = -1
+            cursor = self.cursor if bottom > 0 else None
+            page_key = data = None
+            if self.cache_key and bottom >= 0:
+                # the cursor holds sort values, ie. subjects, hash it to bound the key length
+                cursor_digest = hashlib.md5(':'.join(cursor).encode('utf8')).hexdigest() if cursor else ''
+                page_key = '{}:{}:{}'.format(self.cache_key, bottom, cursor_digest)
+                data = cache.get(page_key)
+                if data is not None:
+                    self.response = Response(self.object_list, data)
+            if cursor and self.response is None:
+                self.response = self.get_cursor_response()
+            if bottom >= 0 and self.response is None:
+                # raises RequestError if the query can't be parsed
+                query = self.object_list[bottom:bottom + self.per_page]
+                self.response = query.extra(track_total_hits=True).execute()
+            if page_key and self.response is not None and data is None:
+                cache.set(page_key, self.response.to_dict(), settings.SEARCH_RESULTS_CACHE_TIMEOUT)
+            if self.response is not None:
+                number = self.validate_number(number)
+                return self._get_page(self.response, number, self)
+
         # Note: this will call search.count() which will unveil
         # any parsing errors
         number = self.validate_number(number)
@@ -288,3 +501,34 @@ class CustomPaginator(Paginator):
             response = query
 
         return self._get_page(response, number, self)
+
+    def get_cursor_response(self):
+        """Returns the response of the page after or before the cursor, or None if
+        the cursor isn't valid for the search"""
+        direction, value = self.cursor
+        body = get_cursor_body(self.object_list, self.per_page, aggs=True)
+        sort_values = decode_cursor(value, body)
+        if sort_values is None:
+            return None
+        try:
+            return execute_search_after(body, sort_values, reverse=direction == 'before', track_total_hits=True)
+        except RequestError as error:
+            # sort values of the wrong type for the sort fields
+            logger.warning('Invalid search cursor {} [{}]'.format(value, error))
+            return None
+
+    def get_next_cursor(self):
+        """Returns cursor of the last result of the page, for the next page link"""
+        return self.get_result_cursor(-1)
+
+    def get_previous_cursor(self):
+        """Returns cursor of the first result of the page, for the previous page link"""
+        return self.get_result_cursor(0)
+
+    def get_result_cursor(self, index):
+        if self.response is None or not self.response.hits:
+            return None
+        sort_values = getattr(self.response.hits[index].meta, 'sort', None)
+        if sort_values is None:
+            return None
+        return encode_cursor(sort_values, get_cursor_body(self.object_list, self.per_page))
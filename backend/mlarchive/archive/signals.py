@@ -11,16 +11,24 @@ from importlib import import_module
 from django.conf import settings
 from django.core.cache import cache
 from django.core.exceptions import ImproperlyConfigured
-from django.dispatch import receiver
-from django.db.models.signals import pre_delete, post_delete, post_save
+from django.dispatch import receiver, Signal
+from django.db.models.signals import m2m_changed, pre_delete, pre_save, post_delete, post_save
 from django.db import models, connection, transaction
 
 from mlarchive.archive.models import Message, EmailList
-from mlarchive.archive.backends.elasticsearch import ESBackend, get_identifier
-from mlarchive.archive.utils import _export_lists
+from mlarchive.archive.backends.elasticsearch import ESBackend, IndexBuffer, get_identifier, update_private_pending
+from mlarchive.archive.query_utils import invalidate_search_cache
+from mlarchive.archive import text_cache
+from mlarchive.archive.thread_cache import thread_cache, messages_deleted
+from mlarchive.archive.utils import _export_lists, flush_noauth_cache
+from mlarchive.utils.batch import BatchBuffer
 
 logger = logging.getLogger(__name__)
 
+# sent when messages are updated in bulk, which does not send post_save.
+# instances is an iterable of the updated messages
+messages_updated = Signal()
+
 
 # --------------------------------------------------
 # Signal Handlers
@@ -32,6 +40,18 @@ def _clear_lists_cache(sender, instance, **kwargs):
     """
     cache.delete('lists')
     cache.delete('lists_public')
+    cache.delete('lists_private')
+    cache.delete('lists_private_ids')
+    flush_noauth_cache()
+
+
+@receiver(m2m_changed, sender=EmailList.members.through)
+def _members_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    """Invalidate the private lists cached for members added or removed"""
+    if action in ('post_add', 'post_remove'):
+        flush_noauth_cache([instance.pk] if reverse else pk_set)
+    elif action == 'post_clear':
+        flush_noauth_cache([instance.pk] if reverse else None)
 
 
 @receiver(pre_delete, sender=Message)
@@ -39,6 +59,7 @@ def _message_remove(sender, instance, **kwargs):
     """When messages are removed, via the admin page, we need to move the message
     archive file to the "_removed" directory and purge the cache
     """
+    text_cache.remove(instance)
     path = instance.get_file_path()
     if not os.path.exists(path):
         return
@@ -66,6 +87,14 @@ def _message_remove(sender, instance, **kwargs):
         purge_files_from_cache(instance)
 
 
+@receiver(post_delete, sender=Message)
+def _message_deleted(sender, instance, **kwargs):
+    """Remove deleted messages from the thread cache, here and in other processes
+    """
+    thread_cache.remove(instance)
+    messages_deleted()
+
+
 @receiver(post_save, sender=Message)
 def _update_thread(sender, instance, **kwargs):
     """When messages are saved, udpate thread info
@@ -82,10 +111,34 @@ def _purge_cache(sender, instance, created, **kwargs):
 
 @receiver(post_save, sender=EmailList)
 def _list_save_handler(sender, instance, **kwargs):
-    # _flush_noauth_cache(instance)
     _export_lists()
 
 
+@receiver(pre_save, sender=EmailList)
+def _list_private_check(sender, instance, **kwargs):
+    """Note if an existing list's private setting is changing, see _list_private_changed"""
+    instance._private_changed = False
+    if instance.pk:
+        previous = EmailList.objects.filter(pk=instance.pk).values_list('private', flat=True).first()
+        instance._private_changed = previous is not None and previous != instance.private
+
+
+@receiver(post_save, sender=EmailList)
+def _list_private_changed(sender, instance, created, **kwargs):
+    """When a list's private setting changes update the private field of the
+    list's indexed messages with a task.  Until it completes searches exclude the
+    list by name, see ElasticsearchQuery.exclude_private_lists()
+    """
+    if created or not getattr(instance, '_private_changed', False):
+        return
+    instance._private_changed = False
+    update_private_pending([instance.name], 1)
+    task = get_update_task('mlarchive.archive.tasks.update_list_private')
+    name, private = instance.name, instance.private
+    transaction.on_commit(lambda: task.delay(name, private))
+    invalidate_search_cache([instance.name])
+
+
 # --------------------------------------------------
 # Helpers
 # --------------------------------------------------
@@ -129,11 +182,6 @@ def purge_files_from_cache(message, created=True):
             logger.error(e)
 
 
-def _flush_noauth_cache(email_list):
-    keys = ['{:04d}-noauth'.format(user.id) for user in email_list.members.all()]
-    cache.delete_many(keys)
-
-
 # --------------------------------------------------
 # Classes
 # --------------------------------------------------
@@ -148,6 +196,7 @@ class BaseSignalProcessor(object):
     def __init__(self, connections):
         self.connections = connections
         self.backend = ESBackend()
+        self.buffer = IndexBuffer(self.backend)
         self.setup()
 
     def setup(self):
@@ -175,17 +224,29 @@ class BaseSignalProcessor(object):
         Given an individual model instance, update the index
         """
         try:
-            self.backend.update([instance])
+            self.buffer.add([instance])
         except Exception:
             # TODO: Maybe log it or let the exception bubble?
             pass
 
+    def handle_bulk_save(self, sender, instances, **kwargs):
+        """
+        Given an iterable of model instances, update the index
+        """
+        instances = list(instances)
+        if not instances:
+            return
+        try:
+            self.buffer.add(instances)
+        except Exception:
+            pass
+
     def handle_delete(self, sender, instance, **kwargs):
         """
         Given an individual model instance, delete from index.
         """
         try:
-            self.backend.remove(instance)
+            self.buffer.remove(instance)
         except Exception:
             # TODO: Maybe log it or let the exception bubble?
             pass
@@ -194,36 +255,68 @@ class BaseSignalProcessor(object):
 class RealtimeSignalProcessor(BaseSignalProcessor):
     """
     Allows for observing when saves/deletes fire & automatically updates the
-    search engine appropriately.
+    search engine appropriately.  Changes are coalesced into bulk requests,
+    see IndexBuffer.
     """
     def setup(self):
         models.signals.post_save.connect(self.handle_save, sender=Message)
         models.signals.post_delete.connect(self.handle_delete, sender=Message)
+        messages_updated.connect(self.handle_bulk_save, sender=Message)
 
     def teardown(self):
         models.signals.post_save.disconnect(self.handle_save, sender=Message)
         models.signals.post_delete.disconnect(self.handle_delete, sender=Message)
+        messages_updated.disconnect(self.handle_bulk_save, sender=Message)
 
 
-class CelerySignalProcessor(BaseSignalProcessor):
+class TaskBuffer(BatchBuffer):
+    """
+    Gathers index changes into batched tasks, settings.CELERY_BATCH_TASK, of up to
+    CELERY_INDEX_BATCH_SIZE identifiers sent CELERY_INDEX_BATCH_DELAY seconds after
+    the first change.  The last change of an identifier wins.  Items are tuples of
+    (action, list name), the task expires cached search results of the lists.
+    """
+    def __init__(self, delay=None, size=None):
+        super(TaskBuffer, self).__init__(
+            settings.CELERY_INDEX_BATCH_DELAY if delay is None else delay,
+            size or settings.CELERY_INDEX_BATCH_SIZE)
 
+    def send(self, items):
+        task = get_update_task(settings.CELERY_BATCH_TASK)
+        task.apply_async(([(action, identifier, list_name) for identifier, (action, list_name) in items],))
+
+
+class CelerySignalProcessor(BaseSignalProcessor):
+    """
+    Indexes changes with Celery tasks.  Changes are queued once the transaction
+    commits and sent in batches, see TaskBuffer.
+    """
     def setup(self):
+        self.task_buffer = TaskBuffer()
         models.signals.post_save.connect(self.enqueue_save, sender=Message)
         models.signals.post_delete.connect(self.enqueue_delete, sender=Message)
+        messages_updated.connect(self.enqueue_bulk_save, sender=Message)
 
     def teardown(self):
         models.signals.post_save.disconnect(self.enqueue_save, sender=Message)
         models.signals.post_delete.disconnect(self.enqueue_delete, sender=Message)
+        messages_updated.disconnect(self.enqueue_bulk_save, sender=Message)
+        self.task_buffer.flush()
 
     def enqueue_save(self, sender, instance, **kwargs):
         return self.enqueue('update', instance, sender, **kwargs)
 
+    def enqueue_bulk_save(self, sender, instances, **kwargs):
+        for instance in instances:
+            self.enqueue('update', instance, sender, **kwargs)
+
     def enqueue_delete(self, sender, instance, **kwargs):
         return self.enqueue('delete', instance, sender, **kwargs)
 
     def enqueue(self, action, instance, sender, **kwargs):
-        enqueue_task(action, instance)
-        return
+        identifier = get_identifier(instance)
+        list_name = instance.email_list.name
+        transaction.on_commit(lambda: self.task_buffer.put(identifier, (action, list_name)))
 
 
 def enqueue_task(action, instance, **kwargs):
@@ -0,0 +1,94 @@
+'''This module implements the on disk spool of the archiver process, see archiver.py.
+
+Incoming messages are written to the spool and acknowledged as soon as they are on
+disk, so delivery doesn't wait on the database and a database outage doesn't fail
+the delivery.  The archiver drains the spool in the background, oldest first.
+
+Layout, like Maildir:
+
+tmp/:  entries being written
+new/:  complete entries, moved from tmp/ once written and synced to disk
+bad/:  entries which couldn't be read, kept for inspection
+
+An entry is a single line JSON header, ie. {"listname": "acme", "private": false},
+followed by the raw message bytes.  Entry names sort in the order received.
+'''
+import itertools
+import json
+import os
+import time
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class Spool(object):
+    '''A directory of messages waiting to be archived.  max_messages is a high water
+    mark used to slow down delivery when the spool isn't draining, see is_full()
+    '''
+    def __init__(self, path, max_messages=10000):
+        self.path = path
+        self.max_messages = max_messages
+        self.tmp_dir = os.path.join(path, 'tmp')
+        self.new_dir = os.path.join(path, 'new')
+        self.bad_dir = os.path.join(path, 'bad')
+        self.counter = itertools.count()
+        for directory in (self.tmp_dir, self.new_dir, self.bad_dir):
+            if not os.path.exists(directory):
+                os.makedirs(directory)
+
+    def __len__(self):
+        return len(os.listdir(self.new_dir))
+
+    def is_full(self):
+        return len(self) >= self.max_messages
+
+    def put(self, data, listname, private=False):
+        '''Write a message to the spool.  Returns the entry name once the entry is
+        synced to disk
+        '''
+        name = '{:020d}.{}.{}'.format(time.time_ns(), os.getpid(), next(self.counter))
+        header = json.dumps({'listname': listname, 'private': private}).encode('utf8')
+        tmp_path = os.path.join(self.tmp_dir, name)
+        with open(tmp_path, 'wb') as f:
+            f.write(header + b'\n' + data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_path, os.path.join(self.new_dir, name))
+        fsync_dir(self.new_dir)
+        return name
+
+    def names(self):
+        '''Returns list of entry names, oldest first'''
+        return sorted(os.listdir(self.new_dir))
+
+    def get(self, name):
+        '''Returns tuple of (listname, private, data) of the entry.  Raises ValueError
+        if the entry is malformed
+        '''
+        with open(os.path.join(self.new_dir, name), 'rb') as f:
+            header = f.readline()
+            data = f.read()
+        try:
+            options = json.loads(header.decode('utf8'))
+            return options['listname'], bool(options.get('private', False)), data
+        except (UnicodeDecodeError, ValueError, TypeError, KeyError):
+            raise ValueError('Invalid spool entry header: {}'.format(header[:100]))
+
+    def remove(self, name):
+        os.remove(os.path.join(self.new_dir, name))
+        fsync_dir(self.new_dir)
+
+    def set_aside(self, name):
+        '''Move an entry which can't be read to bad/'''
+        os.rename(os.path.join(self.new_dir, name), os.path.join(self.bad_dir, name))
+        fsync_dir(self.new_dir)
+
+
+def fsync_dir(path):
+    '''Sync directory entries, ie. a rename, to disk'''
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
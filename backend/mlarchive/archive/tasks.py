@@ -1,14 +1,16 @@
 import logging
+from collections import defaultdict
 
 from celery import Task
 from django.apps import apps
 from django.conf import settings
 from django.core.exceptions import ImproperlyConfigured
 
-from mlarchive.archive.backends.elasticsearch import ESBackend
+from mlarchive.archive.backends.elasticsearch import ESBackend, PREPARE_RELATED, update_private_pending
+from mlarchive.archive.query_utils import invalidate_search_cache, invalidate_search_cache_after_update
 from mlarchive.celeryapp import app
 from mlarchive.archive.utils import create_mbox_file
-from mlarchive.archive.models import EmailList
+from mlarchive.archive.models import EmailList, Message
 
 logger = logging.getLogger(__name__)
 
@@ -86,7 +88,7 @@ class CelerySignalHandler(Task):
             # If the object is gone, we'll use just the identifier
             # against the index.
             try:
-                backend.remove(identifier)
+                backend.remove(identifier, commit=False)
             except Exception as exc:
                 logger.exception(exc)
                 self.retry(exc=exc)
@@ -106,7 +108,7 @@ class CelerySignalHandler(Task):
             # Call the appropriate handler of the current index and
             # handle exception if neccessary
             try:
-                backend.update([instance])
+                backend.update([instance], commit=False)
             except Exception as exc:
                 logger.exception(exc)
                 self.retry(exc=exc)
@@ -120,6 +122,59 @@ class CelerySignalHandler(Task):
             raise ValueError("Unrecognized action %s" % action)
 
 
+class CeleryBatchSignalHandler(CelerySignalHandler):
+    """
+    Indexes a batch of changes, list of (action, identifier, list name), see
+    signals.TaskBuffer.  Instances are loaded with one query per model and sent
+    with one bulk request, removals with another.  Then cached search results of
+    the lists are expired, see invalidate_search_cache_after_update().
+    """
+
+    def run(self, changes, **kwargs):
+        updates = defaultdict(list)
+        deletes = []
+        list_names = set()
+        for change in changes:
+            action, identifier = change[:2]
+            if len(change) > 2 and change[2]:
+                list_names.add(change[2])
+            object_path, pk = self.split_identifier(identifier, **kwargs)
+            if object_path is None or pk is None:
+                continue
+            if action == 'update':
+                updates[object_path].append(int(pk))
+            elif action == 'delete':
+                deletes.append(identifier)
+            else:
+                logger.error("Unrecognized action '%s'. Moving on..." % action)
+
+        backend = ESBackend()
+        commit = bool(settings.ELASTICSEARCH_INDEX_REFRESH)
+        count = 0
+        try:
+            for object_path, pks in updates.items():
+                model_class = self.get_model_class(object_path, **kwargs)
+                queryset = model_class._default_manager.all()
+                if model_class is Message:
+                    queryset = queryset.select_related(*PREPARE_RELATED)
+                instances = queryset.in_bulk(pks)
+                if len(instances) < len(pks):
+                    logger.error("Couldn't load %s objects of %s. Somehow they went missing?" %
+                                 (len(pks) - len(instances), object_path))
+                if instances:
+                    backend.update(list(instances.values()), commit=commit)
+                    count += len(instances)
+            if deletes:
+                backend.remove_many(deletes, commit=commit)
+            invalidate_search_cache_after_update(list_names, refreshed=commit)
+        except Exception as exc:
+            logger.exception(exc)
+            self.retry(exc=exc)
+        msg = "Updated %s, deleted %s (with %s)" % (count, len(deletes), backend.index_name)
+        logger.debug(msg)
+        return msg
+
+
 @app.task
 def update_mbox(files):
     for file in files:
@@ -127,5 +182,18 @@ def update_mbox(files):
         create_mbox_file(file[0], file[1], elist)
 
 
+@app.task(bind=True, max_retries=settings.CELERY_HAYSTACK_MAX_RETRIES,
+          default_retry_delay=settings.CELERY_HAYSTACK_RETRY_DELAY)
+def update_list_private(self, list_name, private):
+    """Update the private field of a list's messages after its privacy changed.
+    Searches exclude the list by name until the update completes, see
+    signals._list_private_changed"""
+    if not ESBackend().update_list_private(list_name, private):
+        raise self.retry()
+    update_private_pending([list_name], -1)
+    invalidate_search_cache([list_name])
+
+
 CelerySignalHandler = app.register_task(CelerySignalHandler())
+CeleryBatchSignalHandler = app.register_task(CeleryBatchSignalHandler())
 # CeleryHaystackUpdateIndex = app.register_task(CeleryHaystackUpdateIndex())
@@ -3,6 +3,8 @@ from django import template
 from django.conf import settings
 from django.utils.http import urlencode
 
+from mlarchive.archive.query_utils import encode_cursor
+
 
 import logging
 logger = logging.getLogger(__name__)
@@ -160,6 +162,17 @@ def custom_date(date):
         return date.strftime('%Y-%m-%d')
 
 
+@register.filter
+def cursor(result):
+    """Returns the paging cursor of a search result, see encode_cursor(), or an
+    empty string for a database result
+    """
+    sort_values = getattr(getattr(result, 'meta', None), 'sort', None)
+    if sort_values is None:
+        return ''
+    return encode_cursor(sort_values)
+
+
 # --------------------------------------------------
 # From: https://djangosnippets.org/snippets/2237/
 # --------------------------------------------------
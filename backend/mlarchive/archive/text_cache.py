@@ -0,0 +1,96 @@
+'''This module implements an on disk cache of the text extracted from messages for
+the index, see full_prepare().
+
+Extracting the text, Message.get_body(), parses the message file and cleans HTML
+parts, and is most of the cost of indexing a message.  The text is cached, gzip
+compressed, in settings.TEXT_CACHE_DIR/<version>/<list>/<hashcode>.gz, so a
+reindex, ie. after a mapping or analyzer change, reads the cached text rather than
+parsing every message again.  The cache is filled when a message is first indexed,
+as it is archived.
+
+An entry starts with a line holding the modification time and size of the message
+file it was extracted from, an entry which doesn't match the file is stale and is
+replaced.  Change TEXT_CACHE_VERSION when the extracted text changes, ie. a change
+to Generator.as_text(), to ignore existing entries.
+'''
+import gzip
+import os
+import tempfile
+
+from django.conf import settings
+
+import logging
+logger = logging.getLogger(__name__)
+
+TEXT_CACHE_VERSION = 1
+
+
+def get_cache_path(message):
+    return os.path.join(
+        settings.TEXT_CACHE_DIR,
+        str(TEXT_CACHE_VERSION),
+        message.email_list.name,
+        message.hashcode + '.gz')
+
+
+def get_file_key(path):
+    '''Returns string identifying the version of a message file'''
+    stat = os.stat(path)
+    return '{} {}'.format(stat.st_mtime_ns, stat.st_size)
+
+
+def get_text(message):
+    '''Returns the index text of the message body, see Message.get_body().  From the
+    cache if the message file hasn't changed since the text was cached, otherwise
+    the text is extracted and cached
+    '''
+    if not settings.TEXT_CACHE_DIR:
+        return message.get_body()
+    try:
+        key = get_file_key(message.get_file_path())
+    except OSError:
+        # missing file, get_body() returns the error
+        return message.get_body()
+    path = get_cache_path(message)
+    try:
+        with gzip.open(path, 'rt', encoding='utf8') as f:
+            if f.readline()[:-1] == key:
+                return f.read()
+    except FileNotFoundError:
+        pass
+    except (OSError, EOFError, UnicodeDecodeError) as error:
+        logger.warning('Error reading text cache entry {} [{}]'.format(path, error))
+    text = message.get_body()
+    write_entry(path, key, text)
+    return text
+
+
+def write_entry(path, key, text):
+    '''Write a cache entry, atomically so a reader doesn't see part of it.  Errors
+    are logged, the cache is only an optimization
+    '''
+    directory = os.path.dirname(path)
+    try:
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as raw, gzip.open(raw, 'wt', encoding='utf8') as f:
+                f.write(key + '\n')
+                f.write(text)
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+    except (OSError, UnicodeEncodeError) as error:
+        logger.warning('Error writing text cache entry {} [{}]'.format(path, error))
+
+
+def remove(message):
+    '''Remove the cache entry of a deleted message'''
+    if not settings.TEXT_CACHE_DIR:
+        return
+    try:
+        os.remove(get_cache_path(message))
+    except FileNotFoundError:
+        pass
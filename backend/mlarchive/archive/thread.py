@@ -21,15 +21,20 @@ the thread.
 '''
 from builtins import input
 
+import datetime
 import re
 
 from collections import defaultdict, namedtuple, OrderedDict
 from operator import methodcaller
 
+from django.db.models import Count, F, Max, Min, Q
+
 CONTAINER_COUNT = 0
 DEBUG = False
 MESSAGE_ID_RE = re.compile(r'<(.*?)>')
 
+ThreadInfo = namedtuple('ThreadInfo', ['message', 'depth', 'order'])
+
 
 class Container(object):
     '''Used to construct the thread ordering then discarded'''
@@ -263,7 +268,6 @@ def compute_thread(thread):
     else:
         messages = thread.message_set.all().order_by('date')
     data = OrderedDict()
-    ThreadInfo = namedtuple('ThreadInfo', ['message', 'depth', 'order'])
     root_node = process(messages)
     for branch in get_root_set(root_node):
         for order, container in enumerate(branch.walk()):
@@ -279,14 +283,115 @@ def compute_thread(thread):
 
 def reconcile_thread(thread_data):
     '''Updates message.thread_depth and message.thread_order as needed, given
-    computed thread info
+    computed thread info.  Changed messages are saved with one bulk update, which
+    does not send post_save.  Returns list of changed messages
     '''
+    changed = []
+    now = datetime.datetime.now()
     for info in thread_data.values():
         message = info.message
         if (message.thread_order != info.order or message.thread_depth != info.depth):
             message.thread_order = info.order
             message.thread_depth = info.depth
-            message.save()
+            message.updated = now
+            changed.append(message)
+    if changed:
+        type(changed[0]).objects.bulk_update(changed, ['thread_order', 'thread_depth', 'updated'])
+    return changed
+
+
+def place_message(message):
+    '''Returns ThreadInfo for message, a new message in message.thread, without
+    computing the whole thread.  Returns None if the message can't be placed this
+    way, use compute_thread().
+
+    The thread_order and thread_depth of the messages in a thread are a preorder
+    listing of the thread tree.  A reply, later than every message in the thread,
+    is the last child of its parent, so it goes after the parent's last descendent
+    at parent depth + 1.  Only the messages after it need updating, see
+    shift_thread_order().  Cases where adding the message could change the rest of
+    the tree are left to compute_thread():
+    - the message is not the latest in the thread
+    - the thread has more than one top-level container or the listing has gaps
+    - a referenced message is not in the thread, unless it is also referenced by
+      the top-level message, or the references are not all ancestors of the parent
+    - a message in the thread refers to this message
+    '''
+    messages = message.thread.message_set.all()
+    stats = messages.aggregate(count=Count('pk'),
+                               orders=Count('thread_order', distinct=True),
+                               max_order=Max('thread_order'),
+                               roots=Count('pk', filter=Q(thread_depth=0)),
+                               max_date=Max('date'))
+    count = stats['count']
+    if count == 0:
+        return ThreadInfo(message=message, depth=0, order=0)
+    if stats['max_date'] > message.date:
+        return None
+    if stats['roots'] != 1 or stats['orders'] != count or stats['max_order'] != count - 1:
+        return None
+
+    refs = get_references_or_in_reply_to(message)
+    if not refs:
+        return None
+    found = {}
+    for msgid, order, depth in messages.filter(msgid__in=refs + [message.msgid]).values_list(
+            'msgid', 'thread_order', 'thread_depth'):
+        if msgid in found:
+            return None
+        found[msgid] = (order, depth)
+    if message.msgid in found or refs[-1] not in found:
+        return None
+    if len(found) != len(refs):
+        # references to messages not in the archive are allowed if they are those of
+        # the top-level message, ie. the thread started as a reply to another list
+        root = messages.get(thread_depth=0)
+        root_refs = get_references_or_in_reply_to(root)
+        if (refs[:len(root_refs)] != root_refs or
+                any(ref in found for ref in root_refs) or
+                any(ref not in found for ref in refs[len(root_refs):])):
+            return None
+        refs = refs[len(root_refs):]
+    target = '<{}>'.format(message.msgid)
+    if messages.filter(Q(references__contains=target) | Q(in_reply_to_value__contains=target)).exists():
+        return None
+
+    # the other references must be ancestors of the parent, in order.  The ancestor
+    # at each depth is the last message before the parent at that depth
+    parent_order, parent_depth = found[refs[-1]]
+    ancestors = [found[ref] for ref in refs[:-1]]
+    if ancestors:
+        path = {}
+        rows = messages.filter(thread_order__gte=min(order for order, depth in ancestors),
+                               thread_order__lt=parent_order,
+                               thread_depth__lt=parent_depth)
+        for order, depth in rows.order_by('thread_order').values_list('thread_order', 'thread_depth'):
+            path[depth] = order
+        depths = [depth for order, depth in ancestors]
+        if depths != sorted(set(depths)):
+            return None
+        if any(path.get(depth) != order for order, depth in ancestors):
+            return None
+
+    # the end of the parent's subtree
+    end = messages.filter(thread_order__gt=parent_order,
+                          thread_depth__lte=parent_depth).aggregate(Min('thread_order'))['thread_order__min']
+    return ThreadInfo(message=message,
+                      depth=parent_depth + 1,
+                      order=count if end is None else end)
+
+
+def shift_thread_order(message):
+    '''Makes room for message, placed by place_message(), by moving the messages at
+    or after its position in the thread down one, with a single update.  Returns list
+    of primary keys of the moved messages
+    '''
+    messages = message.thread.message_set.filter(thread_order__gte=message.thread_order)
+    pks = list(messages.exclude(pk=message.pk).values_list('pk', flat=True))
+    if pks:
+        message.thread.message_set.filter(pk__in=pks).update(thread_order=F('thread_order') + 1,
+                                                             updated=datetime.datetime.now())
+    return pks
 
 
 def container_stats(parent, id_table):
@@ -0,0 +1,205 @@
+'''This module implements an in memory cache used to resolve the thread of incoming
+messages, see MessageWrapper.get_thread().
+
+ThreadCache maps the msgids of a list to their thread and message, so looking up
+the References and In-Reply-To of a reply doesn't take a query per message id,
+and keeps the thread of the latest message for recent subjects, used by subject
+based threading.  It is enabled by the long running archiver process, see
+archiver.py.  When disabled lookups go to the database and nothing is cached.
+
+The subject entries assume messages are archived by the archiver.  Anything else
+that archives messages, archive-mail.py archiving in-process or the load command,
+increments the generation when done, so the archiver clears its caches.
+'''
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from django.core.cache import cache
+
+from mlarchive.archive.models import Message
+
+import logging
+logger = logging.getLogger(__name__)
+
+MSGID_CACHE_SIZE = 100000
+SUBJECT_CACHE_SIZE = 10000
+GENERATION_KEY = 'thread_cache_generation'
+
+
+class LRUCache(object):
+    '''A dictionary holding at most size items, the least recently used is
+    discarded first'''
+    def __init__(self, size):
+        self.size = size
+        self.data = OrderedDict()
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def __len__(self):
+        return len(self.data)
+
+    def get(self, key, default=None):
+        if key not in self.data:
+            return default
+        self.data.move_to_end(key)
+        return self.data[key]
+
+    def set(self, key, value):
+        self.data[key] = value
+        self.data.move_to_end(key)
+        if len(self.data) > self.size:
+            self.data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        return self.data.pop(key, default)
+
+    def clear(self):
+        self.data.clear()
+
+
+class ThreadCache(object):
+    '''Lookups used to thread incoming messages.
+
+    msgids: (list id, msgid) -> (thread id, message id), for msgids which identify
+    one message in the list.
+    subjects: (list id, base_subject) -> (date, thread id), of the latest message
+    with the subject.  Only messages archived by this process update the entry,
+    which assumes incoming messages are archived by one process.
+
+    Both are filled on lookup and as messages are archived, see add().  Deleted
+    messages are removed by the post_delete handler.  Deleting messages also
+    increments a generation number in the Django cache, which clears the caches of
+    other processes on their next sync(), see messages_deleted().
+    '''
+    def __init__(self, msgid_size=MSGID_CACHE_SIZE, subject_size=SUBJECT_CACHE_SIZE):
+        self.msgids = LRUCache(msgid_size)
+        self.subjects = LRUCache(subject_size)
+        self.enabled = False
+        self.generation = None
+
+    def enable(self):
+        self.clear()
+        self.generation = cache.get(GENERATION_KEY)
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+        self.clear()
+
+    def clear(self):
+        self.msgids.clear()
+        self.subjects.clear()
+
+    def sync(self):
+        '''Clear the caches if messages were deleted by another process.  Call
+        before resolving the thread of a message
+        '''
+        if not self.enabled:
+            return
+        generation = cache.get(GENERATION_KEY)
+        if generation != self.generation:
+            logger.info('thread cache cleared, generation {}'.format(generation))
+            self.clear()
+            self.generation = generation
+
+    def get_messages(self, email_list, msgids):
+        '''Returns dictionary of msgid -> (thread id, message id) for the msgids which
+        identify one message in email_list.  Those not cached are found with a single
+        query
+        '''
+        results = {}
+        missing = []
+        for msgid in msgids:
+            entry = self.msgids.get((email_list.pk, msgid)) if self.enabled else None
+            if entry:
+                results[msgid] = entry
+            else:
+                missing.append(msgid)
+        if missing:
+            found = {}
+            qs = Message.objects.filter(email_list=email_list, msgid__in=missing)
+            for msgid, thread_id, pk in qs.values_list('msgid', 'thread_id', 'pk'):
+                found[msgid] = None if msgid in found else (thread_id, pk)
+            for msgid, entry in found.items():
+                if entry:
+                    results[msgid] = entry
+                    if self.enabled:
+                        self.msgids.set((email_list.pk, msgid), entry)
+        return results
+
+    def get_subject_thread_id(self, email_list, base_subject, date):
+        '''Returns the thread id of the most recent message in email_list before date
+        with base_subject, or None
+        '''
+        key = (email_list.pk, base_subject)
+        entry = self.subjects.get(key) if self.enabled else None
+        if entry and entry[0] < date:
+            return entry[1]
+        messages = Message.objects.filter(email_list=email_list, base_subject=base_subject)
+        if not entry:
+            latest = messages.order_by('-date').values_list('date', 'thread_id').first()
+            if latest is None:
+                return None
+            if self.enabled:
+                self.subjects.set(key, latest)
+            if latest[0] < date:
+                return latest[1]
+        # an older message, arriving out of order
+        return messages.filter(date__lt=date).order_by('-date').values_list('thread_id', flat=True).first()
+
+    def add(self, message):
+        '''Add a newly archived message'''
+        if not self.enabled:
+            return
+        self.msgids.set((message.email_list_id, message.msgid), (message.thread_id, message.pk))
+        key = (message.email_list_id, message.base_subject)
+        entry = self.subjects.get(key)
+        if entry and entry[0] <= message.date:
+            self.subjects.set(key, (message.date, message.thread_id))
+
+    def remove(self, message):
+        '''Remove a deleted message'''
+        self.msgids.pop((message.email_list_id, message.msgid))
+        self.subjects.pop((message.email_list_id, message.base_subject))
+
+
+def increment_generation():
+    '''Tell other processes to clear their caches, see ThreadCache.sync()'''
+    try:
+        cache.incr(GENERATION_KEY)
+    except ValueError:
+        cache.set(GENERATION_KEY, 1, timeout=None)
+
+
+_deferred = threading.local()
+
+
+@contextmanager
+def defer_generation():
+    '''Messages deleted within the block increment the generation once, at the end,
+    rather than once per message.  Use around bulk deletes'''
+    if getattr(_deferred, 'deleted', None) is not None:
+        # nested, the outer block increments
+        yield
+        return
+    _deferred.deleted = False
+    try:
+        yield
+    finally:
+        deleted, _deferred.deleted = _deferred.deleted, None
+        if deleted:
+            increment_generation()
+
+
+def messages_deleted():
+    '''Called when a message is deleted.  Increments the generation, at the end of
+    the defer_generation() block if in one'''
+    if getattr(_deferred, 'deleted', None) is None:
+        increment_generation()
+    else:
+        _deferred.deleted = True
+
+
+thread_cache = ThreadCache()
@@ -25,6 +25,10 @@ from mlarchive.archive.models import EmailList
 logger = logging.getLogger(__name__)
 THREAD_SORT_FIELDS = ('-thread__date', 'thread_id', 'thread_order')
 LIST_LISTS_PATTERN = re.compile(r'\s*([\w\-]*) - (.*)$')
+NOAUTH_KEY = 'noauth:{}'
+NOAUTH_GENERATION_KEY = 'noauth_generation'
+NOAUTH_USER_GENERATION_KEY = 'noauth_generation:{}'
+NOAUTH_CACHE_TIMEOUT = 60 * 60 * 48
 
 
 # --------------------------------------------------
@@ -79,26 +83,44 @@ def _get_lists_as_xml():
 def get_noauth(user):
     """This function takes a User object and returns a list of private email list names
     the user does NOT have access to, for use in an exclude().
+
+    The list, sorted by name, is cached per user, anonymous users share one entry.
+    An entry holds the generations, global and of the user, it was computed at, and
+    is only used while they are current.  They are incremented by
+    flush_noauth_cache(), called when lists or their members change, so an entry
+    computed before a change and cached after it isn't used.
     """
-    # noauth_cache = caches['noauth']
-    # if user.is_anonymous:
-    #     user_id = 0
-    # else:
-    #     user_id = user.id
+    if user.is_superuser:
+        return []
+
+    user_id = user.pk if user.is_authenticated else 'anonymous'
+    key = NOAUTH_KEY.format(user_id)
+    user_generation_key = NOAUTH_USER_GENERATION_KEY.format(user_id)
+    cached = cache.get_many([NOAUTH_GENERATION_KEY, user_generation_key, key])
+    generations = [cached.get(NOAUTH_GENERATION_KEY, 0), cached.get(user_generation_key, 0)]
+    entry = cached.get(key)
+    if entry and entry[0] == generations:
+        return entry[1]
+
+    lists = EmailList.objects.filter(private=True)
+    if user.is_authenticated:
+        lists = lists.exclude(members=user)
+    lists = list(lists.order_by('name').values_list('name', flat=True))
+    cache.set(key, (generations, lists), NOAUTH_CACHE_TIMEOUT)
+    return lists
 
-    # key = '{:04d}-noauth'.format(user_id)
-    # noauth = noauth_cache.get(key)
-    # if noauth is not None:
-    #     return noauth
 
-    if user.is_superuser:
-        lists = []
-    elif user.is_authenticated:
-        lists = [x.name for x in EmailList.objects.filter(private=True).exclude(members=user)]
+def flush_noauth_cache(user_ids=None):
+    """Invalidate the cached get_noauth() lists of user_ids, or of all users"""
+    if user_ids is None:
+        keys = [NOAUTH_GENERATION_KEY]
     else:
-        lists = [x.name for x in EmailList.objects.filter(private=True)]
-    # noauth_cache.set(key, lists, 60 * 60 * 48)
-    return lists
+        keys = [NOAUTH_USER_GENERATION_KEY.format(user_id) for user_id in user_ids]
+    for key in keys:
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.set(key, 1, timeout=None)
 
 
 def get_lists():
@@ -122,6 +144,35 @@ def get_public_lists():
         return lists
 
 
+def get_private_lists():
+    lists = cache.get('lists_private')
+    if lists:
+        return lists
+    else:
+        lists = list(EmailList.objects.filter(private=True).order_by('name').values_list('name', flat=True))
+        cache.set('lists_private', lists)
+        return lists
+
+
+def get_private_list_ids():
+    """Returns dictionary of private EmailList name -> primary key"""
+    list_ids = cache.get('lists_private_ids')
+    if list_ids is None:
+        list_ids = dict(EmailList.objects.filter(private=True).values_list('name', 'pk'))
+        cache.set('lists_private_ids', list_ids)
+    return list_ids
+
+
+def get_private_lists_for_user(user):
+    """Returns names of private EmailLists the user has access to"""
+    if user.is_superuser:
+        return list(get_private_lists())
+    if not user.is_authenticated:
+        return []
+    noauth = set(get_noauth(user))
+    return [name for name in get_private_lists() if name not in noauth]
+
+
 def get_lists_for_user(user):
     """Returns names of EmailLists the user has access to"""
     if not user.is_authenticated:
@@ -131,7 +182,8 @@ def get_lists_for_user(user):
         if user.is_superuser:
             return get_lists()
 
-    return EmailList.objects.all().exclude(name__in=get_noauth(user)).order_by('name').values_list('name', flat=True)
+    noauth = set(get_noauth(user))
+    return [name for name in get_lists() if name not in noauth]
 
 
 def jsonapi(fn):
@@ -5,6 +5,7 @@ and facilitate clean unit testing.
 from builtins import range
 
 import datetime
+import logging
 import math
 import os
 import random
@@ -23,10 +24,18 @@ from django.shortcuts import redirect
 from django.urls import reverse
 from django.utils.encoding import smart_text, smart_bytes
 
+from elasticsearch_dsl import MultiSearch
+
+from mlarchive.archive.backends.client import get_client
 from mlarchive.archive.forms import RulesForm
 from mlarchive.archive.models import EmailList, Message
+from mlarchive.archive.query_utils import get_cursor_body, get_search_after, get_sort_values
 from mlarchive.archive.utils import get_lists_for_user
 
+logger = logging.getLogger(__name__)
+
+# number of hits apply_objects() loads with one query
+APPLY_OBJECTS_CHUNK_SIZE = 1000
 
 contain_pattern = re.compile(r'(?P<neg>[-]?)(?P<field>[a-z]+):\((?P<value>[^\)]+)\)')
 exact_pattern = re.compile(r'(?P<neg>[-]?)(?P<field>[a-z]+):\"(?P<value>[^\"]+)\"')
@@ -70,9 +79,19 @@ def chunks(l, n):
 
 def apply_objects(hits):
     '''Add object attribute (Message) to list of hits,
-    to simulate Haystack results'''
-    for hit in hits:
-        hit.object = Message.objects.get(pk=hit.django_id)
+    to simulate Haystack results.  Messages are loaded with one query per
+    APPLY_OBJECTS_CHUNK_SIZE hits.  object is None if the message no longer
+    exists'''
+    hits = list(hits)
+    for start in range(0, len(hits), APPLY_OBJECTS_CHUNK_SIZE):
+        chunk = hits[start:start + APPLY_OBJECTS_CHUNK_SIZE]
+        objects = Message.objects.select_related('email_list', 'thread').in_bulk(
+            [int(hit.django_id) for hit in chunk])
+        for hit in chunk:
+            hit.object = objects.get(int(hit.django_id))
+            if hit.object is None:
+                logger.warning('apply_objects: message {} is in the index but not the database'.format(
+                    hit.django_id))
 
 # --------------------------------------------------
 # View Functions
@@ -166,6 +185,7 @@ def get_export(search, export_type, request):
     search = search.params(preserve_order=True)
     results = list(search.scan())
     apply_objects(results)
+    results = [result for result in results if result.object is not None]
     if export_type == 'url':
         return get_export_url(results, export_type, request)
     else:
@@ -273,40 +293,27 @@ def build_mbox_tar(results, tar, basename):
     return tar
 
 
-def get_message_index(response, message):
-    """Returns the index of message in search response, -1 if not found"""
-    for n, result in enumerate(response):
-        if result.object == message:
-            return n
-    return -1
-
-
-def get_message_before(response, index):
-    """Returns message of search response before index or None"""
-    if index == 0:
-        return None
-    else:
-        return response[index - 1].object
-
-
-def get_message_after(response, index):
-    """Returns next message of search response after index or None"""
-    try:
-        return response[index + 1].object
-    except IndexError:
-        return None
-
-
 def get_query_neighbors(search, message):
     """Returns a tuple previous_message and next_message given a message
-    from the query results"""
-    response = search.execute()
-    apply_objects(response)
-    index = get_message_index(response, message)
-    if index == -1:
+    from the query results.  The sort values of the message are looked up, then
+    the neighbors are the first hit after them, using search_after, in the search
+    order and in reverse order.  So the cost doesn't depend on the position of
+    the message in the results"""
+    body = get_cursor_body(search, 1)
+    body['_source'] = ['django_id']
+    sort_values = get_sort_values(body, message.pk)
+    if sort_values is None:
         return None, None
-    else:
-        return get_message_before(response, index), get_message_after(response, index)
+
+    multi_search = MultiSearch(using=get_client(), index=settings.ELASTICSEARCH_INDEX_NAME)
+    multi_search = multi_search.add(get_search_after(body, sort_values, reverse=True))
+    multi_search = multi_search.add(get_search_after(body, sort_values))
+    previous_response, next_response = multi_search.execute()
+    hits = list(previous_response.hits) + list(next_response.hits)
+    apply_objects(hits)
+    previous_message = previous_response.hits[0].object if previous_response.hits else None
+    next_message = next_response.hits[0].object if next_response.hits else None
+    return previous_message, next_message
 
 
 def get_query_string(request):
@@ -22,6 +22,7 @@ from django.utils.cache import add_never_cache_headers, patch_cache_control
 from django.views.generic import View
 
 from elasticsearch.exceptions import RequestError
+from elasticsearch_dsl import Search
 
 from mlarchive.utils.decorators import (check_access, superuser_only, pad_id, 
     check_list_access)
@@ -29,7 +30,7 @@ from mlarchive.archive import actions
 from mlarchive.archive.backends.elasticsearch import search_from_form
 from mlarchive.archive.query_utils import (get_qdr_kwargs,
     get_cached_query, get_browse_equivalent, parse_query_string, get_order_fields,
-    is_static_on, get_count, CustomPaginator)
+    is_static_on, get_count, get_search_cache_key, CustomPaginator)
 from mlarchive.archive.view_funcs import (initialize_formsets, get_columns, get_export,
     get_query_neighbors, get_query_string, get_lists_for_user, get_random_token)
 
@@ -173,7 +174,7 @@ class CustomSearchView(View):
         extra['query_string'] = query_string
         extra['results_per_page'] = settings.ELASTICSEARCH_RESULTS_PER_PAGE
         extra['queryset_offset'] = str(self.page.start_index() - 1)
-        extra['count'] = get_count(self.search)
+        extra['count'] = self.paginator.count
 
         # export links
         token = get_random_token(length=16)
@@ -235,18 +236,30 @@ class CustomSearchView(View):
             extra['view_thread_url'] = self.base_url + '?' + new_query.urlencode()
 
     def set_page_links(self, extra):
+        """Next and previous page links of a search include a cursor, the sort values
+        of the last or first message of this page, so the page is fetched with
+        search_after rather than an offset, see CustomPaginator"""
         if self.page and self.page.has_other_pages():
+            use_cursor = isinstance(self.search, Search)
             if self.page.has_next():
                 new_query = self.request.GET.copy()
                 new_query['page'] = self.page.next_page_number()
-                if 'index' in new_query:
-                    new_query.pop('index')
+                for key in ('index', 'after', 'before'):
+                    if key in new_query:
+                        new_query.pop(key)
+                cursor = self.paginator.get_next_cursor() if use_cursor else None
+                if cursor:
+                    new_query['after'] = cursor
                 extra['next_page_url'] = self.base_url + '?' + new_query.urlencode()
             if self.page.has_previous():
                 new_query = self.request.GET.copy()
                 new_query['page'] = self.page.previous_page_number()
-                if 'index' in new_query:
-                    new_query.pop('index')
+                for key in ('index', 'after', 'before'):
+                    if key in new_query:
+                        new_query.pop(key)
+                cursor = self.paginator.get_previous_cursor() if use_cursor else None
+                if cursor and self.page.previous_page_number() > 1:
+                    new_query['before'] = cursor
                 extra['previous_page_url'] = self.base_url + '?' + new_query.urlencode()
 
     def get_context(self):
@@ -275,7 +288,8 @@ class CustomSearchView(View):
         if page_no < 1:
             raise Http404("Pages should be 1 or greater.")
 
-        paginator = CustomPaginator(self.search, self.results_per_page)
+        paginator = CustomPaginator(self.search, self.results_per_page, cursor=self.get_cursor(),
+                                    cache_key=self.get_search_cache_key())
 
         try:
             page = paginator.page(page_no)
@@ -284,6 +298,28 @@ class CustomSearchView(View):
 
         return (paginator, page)
 
+    def get_cursor(self):
+        """Returns the paging cursor of the request, tuple of ("after" or "before",
+        cursor), or None.  See set_page_links()"""
+        for direction in ('after', 'before'):
+            value = self.request.GET.get(direction)
+            if value:
+                return (direction, value)
+        return None
+
+    def get_search_cache_key(self):
+        """Returns the key results of the search are cached with, or None if they
+        aren't cached"""
+        if settings.SEARCH_RESULTS_CACHE_TIMEOUT and isinstance(self.search, Search):
+            return get_search_cache_key(self.search, self.get_list_names())
+        return None
+
+    def get_list_names(self):
+        """Returns list of the lists the search is limited to, None for all lists"""
+        if not self.form.is_valid():
+            return None
+        return self.form.cleaned_data.get('f_list') or self.form.cleaned_data.get('email_list') or None
+
     def get_query(self):
         if self.form.is_valid():
             q = self.form.cleaned_data['q']
@@ -332,6 +368,9 @@ class CustomBrowseView(CustomSearchView):
 
         return self.create_response()
 
+    def get_list_names(self):
+        return [self.list_name]
+
     def get_search(self):
         """If there is a search query build an Elasticsearch search object and 
         return that. Otherwise build an ORM Message query and return that"""
@@ -378,7 +417,7 @@ class CustomBrowseView(CustomSearchView):
         extra['query_string'] = query_string
         extra['browse_list'] = self.list_name
         extra['queryset_offset'] = '0'
-        extra['count'] = get_count(self.search)
+        extra['count'] = self.paginator.count
 
         # export links
         token = get_random_token(length=16)
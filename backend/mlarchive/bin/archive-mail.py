@@ -4,29 +4,91 @@ This is the Mailman External Archive interface for the Email Archive.  It takes
 on standard input and saves the message in the archive.  The message listname is required as the
 first argument.  Use --public to specifiy a public list or --private to specify a private list.
 The default is public.
-'''
-# Standalone broilerplate -------------------------------------------------------------
-from django_setup import do_setup
-do_setup()
-# -------------------------------------------------------------------------------------
 
+The message is passed to the persistent archiver process (manage.py archiver) over a Unix
+socket, see mlarchive/archive/archiver.py.  If the archiver is not running the message is
+archived in-process.  Once the message has been sent the archiver may have archived it,
+so if the archiver then fails the script exits with EX_TEMPFAIL and the MTA retries the
+delivery, rather than archiving the message a second time.  To keep delivery fast this
+script must not set up Django or import mlarchive modules unless it falls back to
+in-process archiving.
+'''
+import json
+import os
+import socket
 import sys
 from optparse import OptionParser
 
-from mlarchive.archive.mail import archive_message
+# default of settings.ARCHIVER_SOCKET
+DEFAULT_ARCHIVER_SOCKET = '/var/run/mailarch/archiver.sock'
+ARCHIVER_TIMEOUT = 120
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
 
-import logging
-logger = logging.getLogger('mlarchive.bin.archive-mail')
 
+def get_archiver_socket():
+    '''Returns the archiver socket path, settings.ARCHIVER_SOCKET, read from the
+    environment or .env file as settings/base.py does, without setting up Django
+    '''
+    import environ
+    env = environ.Env(ARCHIVER_SOCKET=(str, DEFAULT_ARCHIVER_SOCKET))
+    environ.Env.read_env(os.path.join(ROOT_DIR, '.env'))
+    return env('ARCHIVER_SOCKET')
 
-def main():
+
+def send_to_archiver(path, data, listname, private=False):
+    '''Send message to the archiver process.  Returns the archive_message exit status,
+    None if the archiver is not running, or EX_TEMPFAIL if the archiver failed after
+    the message was sent.
+    '''
+    header = json.dumps({'listname': listname, 'private': private}).encode('utf8')
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(ARCHIVER_TIMEOUT)
+    try:
+        try:
+            sock.connect(path)
+        except OSError:
+            return None
+        try:
+            sock.sendall(header + b'\n' + data)
+            sock.shutdown(socket.SHUT_WR)
+            response = sock.makefile('rb').readline()
+            return int(response)
+        except (OSError, ValueError):
+            return os.EX_TEMPFAIL
+    finally:
+        sock.close()
+
+
+def archive_in_process(data, listname, private=False):
+    # Standalone broilerplate ---------------------------------------------------------
+    from django_setup import do_setup
+    do_setup()
+    # ---------------------------------------------------------------------------------
+    from mlarchive.archive.mail import archive_message
+    from mlarchive.archive.thread_cache import increment_generation
+
+    import logging
+    logger = logging.getLogger('mlarchive.bin.archive-mail')
     logger.info('called with arguments: %s' % sys.argv)
+    logger.info('envelope: %s' % data.decode('utf8', errors='ignore').split('\n', 1)[0])
+    status = archive_message(data, listname, private=private)
+    logger.info('archive_message exit status: %s' % status)
+    # archived without the archiver's thread cache, see thread_cache.py
+    increment_generation()
+    return status
+
+
+def main():
     usage = "usage: %prog LISTNAME [options]"
     parser = OptionParser(usage=usage)
     parser.add_option("--public", help="archive message to public archive (default)",
                       action="store_true", dest='public', default=False)
     parser.add_option("--private", help="archive message to private archive",
                       action="store_true", dest='private', default=False)
+    parser.add_option("--socket", help="archiver socket path",
+                      dest='socket', default=None)
+    parser.add_option("--no-archiver", help="always archive in-process",
+                      action="store_true", dest='no_archiver', default=False)
     (options, args) = parser.parse_args()
 
     try:
@@ -40,10 +102,15 @@ def main():
                  (sys.argv[0],sys.argv[0]))
 
     data = sys.stdin.buffer.read()
-    logger.info('envelope: %s' % data.decode('utf8', errors='ignore').split('\n', 1)[0])
-    status = archive_message(data,listname,private=options.private)
 
-    logger.info('archive_message exit status: %s' % status)
+    status = None
+    if not options.no_archiver:
+        path = options.socket or get_archiver_socket()
+        status = send_to_archiver(path, data, listname, private=options.private)
+
+    if status is None:
+        status = archive_in_process(data, listname, private=options.private)
+
     sys.exit(status)
 
 if __name__ == "__main__":
@@ -0,0 +1,76 @@
+#!../../../env/bin/python
+'''
+Benchmark archive-mail.py delivery throughput, messages per second, with and without
+the persistent archiver process.  Each message is delivered the same way Mailman
+does, by running archive-mail.py with the message on standard input.  Message-IDs
+are rewritten so every delivery is a new message rather than a duplicate.
+
+Start the archiver first (manage.py archiver) and use a scratch list name.
+
+usage: benchmark_archiver.py LISTNAME MBOX [--count N] [--socket PATH]
+'''
+import argparse
+import email
+import mailbox
+import os
+import subprocess
+import sys
+import time
+from email.utils import make_msgid
+
+ARCHIVE_MAIL = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'archive-mail.py')
+
+
+def get_messages(path, count):
+    '''Returns list of message bytes from mbox with unique Message-IDs'''
+    messages = []
+    mb = mailbox.mbox(path)
+    while len(messages) < count:
+        for msg in mb:
+            if len(messages) == count:
+                break
+            msg = email.message_from_bytes(msg.as_bytes())
+            del msg['Message-ID']
+            msg['Message-ID'] = make_msgid('benchmark')
+            messages.append(msg.as_bytes())
+        if not messages:
+            sys.exit('No messages found in {}'.format(path))
+    return messages
+
+
+def deliver(messages, listname, extra_args):
+    '''Deliver each message with archive-mail.py.  Returns messages per second'''
+    command = [sys.executable, ARCHIVE_MAIL, listname] + extra_args
+    failed = 0
+    start = time.time()
+    for data in messages:
+        proc = subprocess.run(command, input=data, cwd=os.path.dirname(ARCHIVE_MAIL))
+        if proc.returncode != 0:
+            failed += 1
+    elapsed = time.time() - start
+    if failed:
+        print('  {} deliveries failed'.format(failed))
+    return len(messages) / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark archive-mail.py')
+    parser.add_argument('listname')
+    parser.add_argument('mbox')
+    parser.add_argument('-c', '--count', type=int, default=100, help='number of messages to deliver')
+    parser.add_argument('-s', '--socket', help='archiver socket path')
+    args = parser.parse_args()
+
+    socket_args = ['--socket', args.socket] if args.socket else []
+    messages = get_messages(args.mbox, args.count * 2)
+
+    in_process = deliver(messages[:args.count], args.listname, ['--no-archiver'])
+    print('in-process: {:.2f} messages/sec'.format(in_process))
+
+    archiver = deliver(messages[args.count:], args.listname, socket_args)
+    print('archiver:   {:.2f} messages/sec'.format(archiver))
+    print('speedup:    {:.1f}x'.format(archiver / in_process))
+
+
+if __name__ == "__main__":
+    main()
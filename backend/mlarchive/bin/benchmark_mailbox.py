@@ -0,0 +1,152 @@
+#!../../../env/bin/python
+'''
+Benchmark reading a large mbox file with MMapMailbox versus the standard library
+mailbox.mbox, which the load command uses by default.  A synthetic mailbox is
+generated, 1 GB by default, unless an existing file is given with --path.
+
+Each reader runs in its own process.  The time, peak memory (max RSS) and private
+memory at the end of the run are reported for each stage.  Max RSS of MMapMailbox
+includes the mapped file, which is page cache shared with the rest of the system.
+
+Stages:
+
+toc:   find the message boundaries
+read:  toc plus read every message
+parse: toc plus read and parse every message with the email package
+
+usage: benchmark_mailbox.py [--size MB] [--path MBOX] [--stage toc|read|parse]
+'''
+import argparse
+import email
+import mailbox
+import multiprocessing
+import os
+import resource
+import tempfile
+import time
+
+# Standalone broilerplate -------------------------------------------------------------
+from django_setup import do_setup
+do_setup()
+# -------------------------------------------------------------------------------------
+
+from mlarchive.archive.mail import MMapMailbox  # noqa: E402
+
+MESSAGE = '''From sender{n}@example.com  {weekday} Jul {day:2d} 08:{minute:02d}:00 2016
+From: Sender {n} <sender{n}@example.com>
+To: list@example.com
+Date: {weekday}, {day} Jul 2016 08:{minute:02d}:00 +0000
+Message-ID: <{n}@example.com>
+Subject: Synthetic message {n}
+
+{body}
+>From the archive of message {n}
+
+'''
+WEEKDAYS = ('Fri', 'Sat', 'Sun', 'Mon', 'Tue', 'Wed', 'Thu')
+BODY_LINE = 'The quick brown fox jumps over the lazy dog. ' * 2 + '\n'
+
+
+def make_mbox(path, size):
+    '''Write a synthetic mbox of approximately size bytes to path'''
+    written = 0
+    n = 0
+    with open(path, 'w') as f:
+        while written < size:
+            # vary message size from about 1 KB to 24 KB
+            body = BODY_LINE * (10 + (n * 37) % 250)
+            text = MESSAGE.format(n=n, weekday=WEEKDAYS[n % 7], day=1 + n % 28, minute=n % 60, body=body)
+            f.write(text)
+            written += len(text)
+            n += 1
+    return n
+
+
+def run_stdlib(path, stage):
+    mb = mailbox.mbox(path)
+    count = len(mb.keys())
+    if stage == 'read':
+        for key in mb.keys():
+            mb.get_bytes(key)
+    elif stage == 'parse':
+        for msg in mb:
+            pass
+    mb.close()
+    return count
+
+
+def run_mmap(path, stage):
+    mb = MMapMailbox(path)
+    count = len(mb)
+    if stage == 'read':
+        for data in mb:
+            pass
+    elif stage == 'parse':
+        for data in mb:
+            email.message_from_string(str(data, 'ascii', 'surrogateescape'))
+            del data
+    mb.close()
+    return count
+
+
+def get_rss_anon():
+    '''Returns private, anonymous, resident memory in KB.  Max RSS includes the
+    pages of the file mapped by MMapMailbox, which are shared page cache
+    '''
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('RssAnon:'):
+                return int(line.split()[1])
+    return 0
+
+
+def measure(func, path, stage, queue):
+    start = time.time()
+    count = func(path, stage)
+    elapsed = time.time() - start
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    queue.put((count, elapsed, maxrss, get_rss_anon()))
+
+
+def run(func, path, stage):
+    '''Run func in a child process so each reader has its own memory high water mark'''
+    context = multiprocessing.get_context('fork')
+    queue = context.Queue()
+    proc = context.Process(target=measure, args=(func, path, stage, queue))
+    proc.start()
+    result = queue.get()
+    proc.join()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark MMapMailbox')
+    parser.add_argument('-s', '--size', type=int, default=1024, help='synthetic mailbox size in MB')
+    parser.add_argument('-p', '--path', help='use existing mbox file')
+    parser.add_argument('--stage', choices=('toc', 'read', 'parse'), action='append',
+                        help='stage to benchmark, may be repeated (default is all)')
+    args = parser.parse_args()
+    stages = args.stage or ['toc', 'read', 'parse']
+
+    if args.path:
+        path = args.path
+    else:
+        fd, path = tempfile.mkstemp(suffix='.mbox')
+        os.close(fd)
+        print('Generating {} MB mailbox: {}'.format(args.size, path))
+        count = make_mbox(path, args.size * 1024 * 1024)
+        print('{} messages'.format(count))
+
+    try:
+        for stage in stages:
+            for name, func in (('mailbox.mbox', run_stdlib), ('MMapMailbox', run_mmap)):
+                count, elapsed, maxrss, anon = run(func, path, stage)
+                print('{:<6} {:<13} {:>8} messages {:>8.2f} sec {:>8.1f} MB max RSS {:>8.1f} MB private'.format(
+                    stage, name, count, elapsed, maxrss / 1024, anon / 1024))
+    finally:
+        if not args.path:
+            os.remove(path)
+
+
+if __name__ == "__main__":
+    main()
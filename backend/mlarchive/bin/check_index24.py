@@ -14,8 +14,8 @@ import datetime
 import os
 from django.conf import settings
 # from haystack.query import SearchQuerySet
-from elasticsearch import Elasticsearch
 from elasticsearch_dsl import Search
+from mlarchive.archive.backends.client import get_client
 from mlarchive.archive.models import Message
 
 import logging
@@ -34,7 +34,7 @@ def main():
     end = now - datetime.timedelta(minutes=1)
     count = 0
     stat = {}
-    client = Elasticsearch()
+    client = get_client()
     messages = Message.objects.filter(updated__gte=start,updated__lt=end)
     for message in messages:
         s = Search(using=client, index=settings.ELASTICSEARCH_INDEX_NAME)
@@ -40,7 +40,9 @@ def main():
     if args.list and not EmailList.objects.filter(name=args.list).exists():
         parser.error('List {} does not exist'.format(args.list))
     
-    inspector_class = eval(args.inspector)
+    inspector_class = Inspector.registry.get(args.inspector.lower())
+    if inspector_class is None:
+        parser.error('Unknown inspector {}'.format(args.inspector))
     
     kwargs = {}
     if args.list:
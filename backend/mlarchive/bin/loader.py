@@ -1,22 +1,147 @@
 #!../../../env/bin/python
 '''
-This is a utility script that handles loading multiple list archives.
+This is a utility script that handles loading multiple list archives.  Each
+subdirectory of path is a list archive of YYYY-MM mailbox files, see the load
+command.
 
-Note all archives will be loaded as public
-'''
-# Standalone broilerplate -------------------------------------------------------------
-from django_setup import do_setup
-do_setup(django_settings='mlarchive.settings.noindex')
-# -------------------------------------------------------------------------------------
+Lists are loaded in parallel, up to --workers at a time.  Each list is loaded by
+its own worker process, a file at a time in chronological order, so thread
+resolution works the same as a serial load.  A worker that dies, ie. killed when out
+of memory, fails only its list.
 
-from django.core.management import call_command
+Use --checkpoint to record each completed file, with its stats, so an interrupted
+import can be resumed by running again with the same checkpoint file.  Completed
+files are skipped.  A file that was partially loaded is loaded again, messages
+already in the archive are skipped as duplicates.
 
+Note all archives will be loaded as public
+'''
 import argparse
 import ast
 import datetime
 import io
+import json
+import multiprocessing
 import os
 import time
+from multiprocessing.connection import wait
+
+# Standalone broilerplate -------------------------------------------------------------
+from django_setup import do_setup
+do_setup(django_settings='mlarchive.settings.noindex')
+# -------------------------------------------------------------------------------------
+
+from django.core.management import call_command  # noqa: E402
+from django.db import connections  # noqa: E402
+
+from mlarchive.archive.management.commands.load import get_files  # noqa: E402
+
+
+def add_stats(stats, results):
+    for key, val in list(results.items()):
+        stats[key] = stats.get(key, 0) + val
+
+
+def read_checkpoint(path):
+    '''Returns dictionary of completed files from checkpoint file,
+    key=file path, value=stats
+    '''
+    completed = {}
+    if path and os.path.exists(path):
+        with open(path) as f:
+            lines = f.readlines()
+        for line in lines:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue    # partial line written by a crashed worker
+            completed[entry['file']] = entry['stats']
+        if lines and not lines[-1].endswith('\n'):
+            # terminate the partial line so new entries start on their own line
+            with open(path, 'a') as f:
+                f.write('\n')
+    return completed
+
+
+def write_checkpoint(path, listname, filename, stats):
+    '''Append completed file to the checkpoint file.  Workers share the file, each
+    entry is a single append so entries don't interleave
+    '''
+    line = json.dumps({'list': listname, 'file': filename, 'stats': stats}) + '\n'
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, line.encode('utf8'))
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def load_list(path, completed, options):
+    '''Load the mailbox files of one list archive, in order.  Runs in a worker
+    process.  Returns tuple (listname, stats, error)
+    '''
+    listname = os.path.basename(path)
+    stats = {}
+    try:
+        for filename in get_files(path):
+            if filename in completed:
+                continue
+            if options['verbose']:
+                print('Loading: %s' % filename)
+
+            # save output from command so we can aggregate statistics
+            content = io.StringIO()
+            call_command('load', filename, listname=listname, summary=True,
+                         test=options['test'], private=False, stdout=content)
+            results = ast.literal_eval(content.getvalue())
+            if options['checkpoint']:
+                write_checkpoint(options['checkpoint'], listname, filename, results)
+            add_stats(stats, results)
+    except Exception as error:
+        return listname, stats, '{}: {}'.format(error.__class__.__name__, error)
+    return listname, stats, None
+
+
+def run_worker(sender, path, completed, options):
+    '''Worker process target, sends the load_list() result to the parent'''
+    sender.send(load_list(path, completed, options))
+    sender.close()
+
+
+def load_lists(dirs, completed, options, workers):
+    '''Load list archives, up to workers at a time, each in its own process.
+    completed is the set of files already loaded.  Yields tuple (listname, stats,
+    error) as each list finishes
+    '''
+    context = multiprocessing.get_context('fork')
+    pending = list(dirs)
+    running = {}    # result connection -> (process, path)
+    while pending or running:
+        while pending and len(running) < workers:
+            path = pending.pop(0)
+            list_completed = {f for f in completed if os.path.dirname(f) == path}
+            receiver, sender = context.Pipe(duplex=False)
+            process = context.Process(target=run_worker, args=(sender, path, list_completed, options))
+            process.start()
+            # the worker holds the only copy, so the receiver sees EOF if it dies
+            sender.close()
+            running[receiver] = (process, path)
+        for receiver in wait(list(running)):
+            process, path = running.pop(receiver)
+            try:
+                result = receiver.recv()
+            except EOFError:
+                result = None
+            receiver.close()
+            process.join()
+            if result is None:
+                result = (os.path.basename(path), {},
+                          'worker process died, exit code {}'.format(process.exitcode))
+            yield result
+
+
+def get_size(path):
+    return sum(os.path.getsize(f) for f in get_files(path))
 
 
 def main():
@@ -24,6 +149,9 @@ def main():
     parser.add_argument('path')
     parser.add_argument('-v','--verbose', help='verbose output',action='store_true')
     parser.add_argument('-t','--test', help='test run',action='store_true')
+    parser.add_argument('-w','--workers', help='number of worker processes (default is number of CPUs)',
+                        type=int, default=multiprocessing.cpu_count())
+    parser.add_argument('-c','--checkpoint', help='checkpoint file, records completed files to resume an import')
     args = parser.parse_args()
 
     if not os.path.isdir(args.path):
@@ -32,32 +160,37 @@ def main():
     stats = {}
     start_time = time.time()
 
-    all = [ os.path.join(args.path,x) for x in os.listdir(args.path) ]
+    completed = read_checkpoint(args.checkpoint)
+    for results in completed.values():
+        add_stats(stats, results)
+    if completed:
+        print('Resuming: %s files already loaded' % len(completed))
+
+    path = os.path.abspath(args.path)
+    all = [ os.path.join(path,x) for x in os.listdir(path) ]
     dirs = list(filter(os.path.isdir, all))
-    
-    for dir in dirs:
-        print('Loading: %s' % dir)
-        
-        # TODO: add option to load private lists
-        private = False
-
-        # save output from command so we can aggregate statistics
-        content = io.StringIO()
-        listname = os.path.basename(dir)
-
-        call_command('load', dir, listname=listname, summary=True,
-                     test=args.test, private=private, stdout=content)
-
-        # gather stats from output
-        content.seek(0)
-        output = content.read()
-        results = ast.literal_eval(output)
-        for key,val in list(results.items()):
-            stats[key] = stats.get(key,0) + val
+    # start the largest lists first so they don't hold up the end of the import
+    dirs.sort(key=get_size, reverse=True)
+
+    options = {'verbose': args.verbose, 'test': args.test, 'checkpoint': args.checkpoint}
+    failed = []
+
+    # workers must open their own database connections
+    connections.close_all()
+    results = load_lists(dirs, set(completed), options, args.workers)
+    for count, (listname, list_stats, error) in enumerate(results, start=1):
+        add_stats(stats, list_stats)
+        if error:
+            failed.append(listname)
+            print('Failed: %s (%s)' % (listname, error))
+        else:
+            print('Loaded: %s (%s of %s)' % (listname, count, len(dirs)))
 
     elapsed_time = int(time.time() - start_time)
     items = [ '%s:%s' % (k,v) for k,v in list(stats.items()) if k != 'time']
     items.append('Elapsed Time:%s' % str(datetime.timedelta(seconds=elapsed_time)))
+    if failed:
+        items.append('Failed lists:%s' % ' '.join(sorted(failed)))
     items.append('\n')
     print('\n'.join(items))
 
@@ -39,6 +39,7 @@ env = environ.Env(
     OIDC_RP_CLIENT_SECRET=(str, ''),
     SCOUT_MONITOR=(bool, False),
     SCOUT_KEY=(str, ''),
+    ARCHIVER_SOCKET=(str, '/var/run/mailarch/archiver.sock'),
 )
 
 # reading .env file
@@ -163,6 +164,12 @@ TEST_RUNNER = 'django.test.runner.DiscoverRunner'
 # -------------------------------------
 
 SEARCH_RESULTS_PER_PAGE = 40
+# seconds a search results page is cached, see archive/query_utils.py get_search_cache_key().
+# 0 disables the cache
+SEARCH_RESULTS_CACHE_TIMEOUT = 60
+# seconds after an index update, without ELASTICSEARCH_INDEX_REFRESH, that cached results
+# of the lists changed are expired again, longer than the index refresh interval
+SEARCH_RESULTS_CACHE_REFRESH_DELAY = 2.0
 
 # ELASTICSEARCH SETTINGS
 ELASTICSEARCH_INDEX_NAME = 'mail-archive'
@@ -170,10 +177,31 @@ ELASTICSEARCH_SILENTLY_FAIL = True
 ELASTICSEARCH_CONNECTION = {
     'URL': 'http://127.0.0.1:9200/',
     'INDEX_NAME': 'mail-archive',
+    # passed to Elasticsearch(), see archive/backends/client.py
+    'KWARGS': {'maxsize': 10, 'timeout': 30},
 }
 ELASTICSEARCH_RESULTS_PER_PAGE = 40
+# Realtime indexing, see archive/backends/elasticsearch.py IndexBuffer.  Changes are sent
+# in one bulk request BATCH_DELAY seconds after the first, or once BATCH_SIZE are pending,
+# 0 sends each change immediately.  REFRESH False relies on the index refresh interval,
+# 'wait_for' waits until the changes are searchable
+ELASTICSEARCH_INDEX_BATCH_DELAY = 1.0
+ELASTICSEARCH_INDEX_BATCH_SIZE = 500
+ELASTICSEARCH_INDEX_REFRESH = False
+# documents kept while Elasticsearch is unreachable and retried after RETRY_DELAY seconds,
+# doubled after each failure up to RETRY_MAX_DELAY
+ELASTICSEARCH_INDEX_RETRY_DELAY = 5
+ELASTICSEARCH_INDEX_RETRY_MAX_DELAY = 300
+ELASTICSEARCH_INDEX_RETRY_SIZE = 10000
 ELASTICSEARCH_SIGNAL_PROCESSOR = env('ELASTICSEARCH_SIGNAL_PROCESSOR')
 ELASTICSEARCH_DEFAULT_OPERATOR = 'AND'
+# Limit searches to public lists and the private lists a user can access with the
+# "private" and "acl_token" fields of the index, a filter Elasticsearch can cache, rather
+# than excluding every inaccessible private list by name.  Lists whose privacy update is
+# pending, tracked in the cache, are still excluded by name.  Enable once the index has
+# been rebuilt with the fields, rebuild_index also starts the tracking, searches exclude
+# all lists by name while it is lost
+ELASTICSEARCH_PRIVATE_FILTER = False
 
 """
 Elastic field mappings
@@ -185,6 +213,7 @@ Elastic field mappings
 
 ELASTICSEARCH_INDEX_MAPPINGS = {
     'properties': {
+        'acl_token': {'type': 'keyword'},
         'base_subject': {'type': 'alias', 'path': 'subject_base'},
         'date': {'type': 'date'},
         'django_ct': {'type': 'keyword'},
@@ -197,6 +226,7 @@ ELASTICSEARCH_INDEX_MAPPINGS = {
         'from': {'type': 'alias', 'path': 'frm'},
         'id': {'type': 'text', 'fields': {'keyword': {'type': 'keyword', 'ignore_above': 256}}},
         'msgid': {'type': 'keyword'},
+        'private': {'type': 'boolean'},
         'spam_score': {'type': 'integer'},
         'subject': {'type': 'text'},
         'subject_base': {'type': 'keyword'},
@@ -241,6 +271,14 @@ USE_EXTERNAL_PROCESSOR = False
 MAX_THREAD_DEPTH = 6
 THREAD_ORDER_FIELDS = ('-thread__date', 'thread_id', 'thread_order')
 MIME_TYPES_PATH = os.path.join(BASE_DIR, 'mime.types')
+# Unix socket of the persistent archiver process, see archive/archiver.py
+ARCHIVER_SOCKET = env('ARCHIVER_SOCKET')
+# Spool of messages accepted by the archiver and waiting to be archived, see archive/spool.py
+ARCHIVER_SPOOL_DIR = os.path.join(DATA_ROOT, 'spool')
+ARCHIVER_SPOOL_MAX_MESSAGES = 10000
+# Cache of the text extracted from messages for the index, see archive/text_cache.py.
+# None disables the cache
+TEXT_CACHE_DIR = os.path.join(DATA_ROOT, 'text_cache')
 
 # Static Mode
 STATIC_MODE_ENABLED = True
@@ -290,6 +328,10 @@ CELERY_BROKER_URL = 'amqp://'
 CELERY_TIMEZONE = 'America/Los_Angeles'
 CELERY_ENABLE_UTC = True
 CELERY_DEFAULT_TASK = 'mlarchive.archive.tasks.CelerySignalHandler'
+# index changes are sent in batches, see archive/signals.py TaskBuffer
+CELERY_BATCH_TASK = 'mlarchive.archive.tasks.CeleryBatchSignalHandler'
+CELERY_INDEX_BATCH_SIZE = 500
+CELERY_INDEX_BATCH_DELAY = 2.0      # seconds
 CELERY_HAYSTACK_DEFAULT_ALIAS = 'default'
 CELERY_HAYSTACK_MAX_RETRIES = 1
 CELERY_HAYSTACK_RETRY_DELAY = 300
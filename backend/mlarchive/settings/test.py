@@ -14,6 +14,9 @@ ELASTICSEARCH_CONNECTION = {
     'INDEX_NAME': 'test-mail-archive',
 }
 ELASTICSEARCH_SIGNAL_PROCESSOR = 'mlarchive.archive.signals.RealtimeSignalProcessor'
+ELASTICSEARCH_INDEX_BATCH_DELAY = 0
+ELASTICSEARCH_INDEX_REFRESH = 'wait_for'
+ELASTICSEARCH_PRIVATE_FILTER = True
 
 # use standard default of 20 as it's easier to test
 ELASTICSEARCH_RESULTS_PER_PAGE = 20
@@ -23,6 +26,7 @@ SEARCH_SCROLL_BUFFER_SIZE = SEARCH_RESULTS_PER_PAGE
 # ARCHIVE SETTINGS
 ARCHIVE_DIR = os.path.join(DATA_ROOT, 'archive')
 STATIC_INDEX_DIR = os.path.join(DATA_ROOT, 'static')
+TEXT_CACHE_DIR = os.path.join(DATA_ROOT, 'text_cache')
 LOG_FILE = os.path.join(BASE_DIR, 'tests/tmp', 'mlarchive.log')
 
 SERVER_MODE = 'development'
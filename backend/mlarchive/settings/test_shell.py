@@ -19,6 +19,9 @@ DATABASES = {
 AUTHENTICATION_BACKENDS = ('django.contrib.auth.backends.ModelBackend',)
 
 ELASTICSEARCH_SIGNAL_PROCESSOR = 'mlarchive.archive.signals.RealtimeSignalProcessor'
+ELASTICSEARCH_INDEX_BATCH_DELAY = 0
+ELASTICSEARCH_INDEX_REFRESH = 'wait_for'
+ELASTICSEARCH_PRIVATE_FILTER = True
 
 # ELASTICSEARCH SETTINGS
 ELASTICSEARCH_INDEX_NAME = 'test-mail-archive'
@@ -31,6 +34,7 @@ SEARCH_SCROLL_BUFFER_SIZE = SEARCH_RESULTS_PER_PAGE
 # ARCHIVE SETTINGS
 ARCHIVE_DIR = os.path.join(DATA_ROOT, 'archive')
 STATIC_INDEX_DIR = os.path.join(DATA_ROOT, 'static')
+TEXT_CACHE_DIR = os.path.join(DATA_ROOT, 'text_cache')
 LOG_FILE = os.path.join(BASE_DIR, 'tests/tmp', 'mlarchive.log')
 
 SERVER_MODE = 'development'
@@ -198,6 +198,8 @@ var mailarch = {
     doSearch: function() {
         // reload page after changing some query parameters
         delete mailarch.urlParams.page;
+        delete mailarch.urlParams.after;
+        delete mailarch.urlParams.before;
         location.search = $.param(mailarch.urlParams);
     },
     
@@ -213,10 +215,12 @@ var mailarch = {
         var queryid = mailarch.$msgList.data('queryid');
         var browselist = mailarch.$msgList.data('browse-list');
         var referenceId = $("#msg-list .xtr:last .id-col").text();
+        var cursor = $("#msg-list .xtr:last .cursor-col").text();
         var data = $.extend({ "qid": queryid,
                      "referenceitem": mailarch.lastItem,
                      "browselist": browselist,
                      "referenceid": referenceId,
+                     "cursor": cursor,
                      "direction": "next"
         }, mailarch.urlParams);
         var request = $.ajax({
@@ -259,10 +263,12 @@ var mailarch = {
         var referenceItem = mailarch.$msgList.data('queryset-offset');
         var browselist = mailarch.$msgList.data('browse-list');
         var referenceId = $("#msg-list .xtr:first .id-col").text();
+        var cursor = $("#msg-list .xtr:first .cursor-col").text();
         var data = $.extend({ "qid": queryid,
                      "referenceitem": referenceItem,
                      "browselist": browselist,
                      "referenceid": referenceId,
+                     "cursor": cursor,
                      "direction": "previous"
         }, mailarch.urlParams);
         var request = $.ajax({
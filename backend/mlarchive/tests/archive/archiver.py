@@ -0,0 +1,187 @@
+import importlib.util
+import io
+import json
+import os
+import pytest
+import socket
+import threading
+
+from django.conf import settings
+from django.db import OperationalError
+
+from mlarchive.archive import archiver
+from mlarchive.archive.archiver import ArchiveServer, SpoolDrainer, read_request
+from mlarchive.archive.models import Message
+from mlarchive.archive.spool import Spool
+from mlarchive.settings import base
+
+
+SIMPLE_MESSAGE_BYTES = b'''From: Joe <joe@example.com>
+To: Joe <joe@example.com>
+Date: Thu, 7 Nov 2013 17:54:55 +0000
+Message-ID: <0000000002@example.com>
+Content-Type: text/plain; charset="us-ascii"
+Subject: This is a test
+
+Hello,
+
+This is a test email.  database
+'''
+
+
+def load_archive_mail():
+    path = os.path.join(settings.BASE_DIR, 'bin', 'archive-mail.py')
+    spec = importlib.util.spec_from_file_location('archive_mail', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def get_request(listname, private=False, data=SIMPLE_MESSAGE_BYTES):
+    header = json.dumps({'listname': listname, 'private': private}).encode('utf8')
+    return header + b'\n' + data
+
+
+def send(path, request, result):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(path)
+    sock.sendall(request)
+    sock.shutdown(socket.SHUT_WR)
+    result.append(sock.makefile('rb').readline())
+    sock.close()
+
+
+def test_read_request():
+    rfile = io.BytesIO(get_request('acme', private=True))
+    listname, private, data = read_request(rfile)
+    assert listname == 'acme'
+    assert private is True
+    assert data == SIMPLE_MESSAGE_BYTES
+
+
+def test_read_request_invalid():
+    with pytest.raises(ValueError):
+        read_request(io.BytesIO(b'acme\n' + SIMPLE_MESSAGE_BYTES))
+    with pytest.raises(ValueError):
+        read_request(io.BytesIO(get_request('acme', data=b'')))
+
+
+@pytest.mark.django_db(transaction=True)
+def test_archive_server(tmpdir):
+    path = str(tmpdir.join('archiver.sock'))
+    server = ArchiveServer(path)
+    assert oct(os.stat(path).st_mode & 0o777) == oct(0o666)
+    result = []
+    client = threading.Thread(target=send, args=(path, get_request('acme'), result))
+    client.start()
+    server.handle_request()
+    client.join()
+    server.server_close()
+    assert result == [b'0\n']
+    assert Message.objects.filter(msgid='0000000002@example.com', email_list__name='acme').exists()
+    assert not os.path.exists(path)
+
+
+@pytest.mark.django_db(transaction=True)
+def test_archive_server_bad_request(tmpdir):
+    path = str(tmpdir.join('archiver.sock'))
+    server = ArchiveServer(path)
+    result = []
+    client = threading.Thread(target=send, args=(path, b'garbage', result))
+    client.start()
+    server.handle_request()
+    client.join()
+    server.server_close()
+    assert result == [b'1\n']
+    assert Message.objects.count() == 0
+
+
+@pytest.mark.django_db(transaction=True)
+def test_archive_server_spool(tmpdir):
+    path = str(tmpdir.join('archiver.sock'))
+    spool = Spool(str(tmpdir.join('spool')))
+    server = ArchiveServer(path, spool=spool)
+    result = []
+    client = threading.Thread(target=send, args=(path, get_request('acme'), result))
+    client.start()
+    server.handle_request()
+    client.join()
+    # acknowledged once spooled
+    assert result == [b'0\n']
+    assert len(spool) == 1
+    assert Message.objects.count() == 0
+    assert server.drainer.drain() == 1
+    server.server_close()
+    assert len(spool) == 0
+    assert Message.objects.filter(msgid='0000000002@example.com', email_list__name='acme').exists()
+
+
+@pytest.mark.django_db(transaction=True)
+def test_SpoolDrainer_retry(tmpdir, monkeypatch):
+    def fail(*args, **kwargs):
+        raise OperationalError('database unavailable')
+
+    spool = Spool(str(tmpdir))
+    drainer = SpoolDrainer(spool, threading.Lock())
+    spool.put(SIMPLE_MESSAGE_BYTES, 'acme')
+    monkeypatch.setattr(archiver, 'archive_message', fail)
+    monkeypatch.setattr(archiver, 'is_database_available', lambda: False)
+    # database down, message kept
+    for n in range(archiver.MAX_ATTEMPTS + 1):
+        with pytest.raises(OperationalError):
+            drainer.drain()
+    assert len(spool) == 1
+    assert drainer.attempts == {}
+
+    # database up, the message fails
+    failed = []
+    monkeypatch.setattr(archiver, 'is_database_available', lambda: True)
+    monkeypatch.setattr(archiver, 'save_failed_msg', lambda msg, listname, error: failed.append(listname))
+    for n in range(archiver.MAX_ATTEMPTS - 1):
+        with pytest.raises(OperationalError):
+            drainer.drain()
+    assert len(spool) == 1
+    assert drainer.drain() == 1
+    assert failed == ['acme']
+    assert len(spool) == 0
+
+    # archived once the database is back
+    monkeypatch.undo()
+    spool.put(SIMPLE_MESSAGE_BYTES, 'acme')
+    assert drainer.drain() == 1
+    assert Message.objects.filter(msgid='0000000002@example.com').exists()
+
+
+def test_send_to_archiver(tmpdir):
+    archive_mail = load_archive_mail()
+    path = str(tmpdir.join('archiver.sock'))
+    # not running, archive in-process
+    assert archive_mail.send_to_archiver(path, SIMPLE_MESSAGE_BYTES, 'acme') is None
+
+    # archiver fails after the message is sent, the MTA retries
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen(1)
+
+    def fail():
+        conn, address = server.accept()
+        conn.makefile('rb').read()
+        conn.close()
+
+    thread = threading.Thread(target=fail)
+    thread.start()
+    status = archive_mail.send_to_archiver(path, SIMPLE_MESSAGE_BYTES, 'acme')
+    thread.join()
+    server.close()
+    assert status == os.EX_TEMPFAIL
+
+
+def test_get_archiver_socket(monkeypatch):
+    archive_mail = load_archive_mail()
+    monkeypatch.setenv('ARCHIVER_SOCKET', '/tmp/test-archiver.sock')
+    assert archive_mail.get_archiver_socket() == '/tmp/test-archiver.sock'
+    monkeypatch.delenv('ARCHIVER_SOCKET')
+    monkeypatch.setattr(archive_mail, 'ROOT_DIR', '/nonexistent')
+    assert archive_mail.get_archiver_socket() == archive_mail.DEFAULT_ARCHIVER_SOCKET
+    # the default of settings.ARCHIVER_SOCKET
+    assert base.env.scheme['ARCHIVER_SOCKET'][1] == archive_mail.DEFAULT_ARCHIVER_SOCKET
@@ -0,0 +1,115 @@
+import pytest
+import time
+
+from mlarchive.archive import bloom, mail
+from mlarchive.archive.bloom import BloomFilter, DuplicateFilter
+from mlarchive.archive.mail import archive_message
+from mlarchive.archive.models import Message
+from factories import EmailListFactory, MessageFactory
+
+
+SIMPLE_MESSAGE_BYTES = b'''From: Joe <joe@example.com>
+To: Joe <joe@example.com>
+Date: Thu, 7 Nov 2013 17:54:55 +0000
+Message-ID: <0000000002@example.com>
+Content-Type: text/plain; charset="us-ascii"
+Subject: This is a test
+
+Hello,
+
+This is a test email.  database
+'''
+
+
+def test_BloomFilter():
+    bf = BloomFilter(1000, error_rate=0.01)
+    items = ['{}@example.com'.format(n) for n in range(1000)]
+    for item in items:
+        bf.add(item)
+    assert len(bf) == 1000
+    assert bf.is_full()
+    # no false negatives
+    assert all(item in bf for item in items)
+    # false positive rate near error_rate
+    false_positives = sum('{}@example.net'.format(n) in bf for n in range(10000))
+    assert false_positives < 300
+
+
+def test_DuplicateFilter_not_loaded():
+    df = DuplicateFilter()
+    df.sync()
+    assert df.might_contain_msgid('public', '001@example.com') is True
+    assert df.might_contain_hashcode('abc') is True
+
+
+@pytest.mark.django_db(transaction=True)
+def test_DuplicateFilter():
+    public = EmailListFactory.create(name='public')
+    private = EmailListFactory.create(name='private')
+    message = MessageFactory.create(email_list=public, msgid='001@example.com', hashcode='abc')
+    df = DuplicateFilter()
+    df.load()
+    assert df.max_pk == message.pk
+    assert df.might_contain_msgid('public', '001@example.com') is True
+    assert df.might_contain_msgid('private', '001@example.com') is False
+    assert df.might_contain_msgid('other', '001@example.com') is False
+    assert df.might_contain_hashcode('abc') is True
+    assert df.might_contain_hashcode('xyz') is False
+
+    # saved by another process
+    MessageFactory.create(email_list=private, msgid='002@example.com', hashcode='xyz')
+    assert df.might_contain_msgid('private', '002@example.com') is False
+    df.sync()
+    assert df.might_contain_msgid('private', '002@example.com') is True
+    assert df.might_contain_hashcode('xyz') is True
+
+
+@pytest.mark.django_db(transaction=True)
+def test_DuplicateFilter_gaps(monkeypatch):
+    '''A primary key below the last seen that is missing, ie. an uncommitted
+    transaction, is checked again on sync'''
+    public = EmailListFactory.create(name='public')
+    first = MessageFactory.create(email_list=public, msgid='001@example.com')
+    later = MessageFactory.create(email_list=public, msgid='002@example.com')
+    MessageFactory.create(email_list=public, msgid='003@example.com')
+    df = DuplicateFilter()
+    df.load()
+    # simulate later missing during load
+    df.msgids['public'] = BloomFilter(1000)
+    df.msgids['public'].add(first.msgid)
+    df.gaps = {later.pk: time.time()}
+    df.sync()
+    assert df.might_contain_msgid('public', '002@example.com') is True
+    assert df.gaps == {}
+
+    # gaps expire
+    df.gaps = {later.pk + 100: time.time() - bloom.GAP_TIMEOUT - 1}
+    df.sync()
+    assert df.gaps == {}
+
+
+@pytest.mark.django_db(transaction=True)
+def test_DuplicateFilter_full(monkeypatch):
+    monkeypatch.setattr(bloom, 'MIN_CAPACITY', 2)
+    public = EmailListFactory.create(name='public')
+    MessageFactory.create(email_list=public)
+    df = DuplicateFilter()
+    df.load()
+    capacity = df.msgids['public'].capacity
+    MessageFactory.create(email_list=public)
+    MessageFactory.create(email_list=public)
+    df.sync()
+    assert df.msgids['public'].capacity > capacity
+    assert len(df.msgids['public']) == 3
+
+
+@pytest.mark.django_db(transaction=True)
+def test_duplicate_filter_archive_message(monkeypatch):
+    '''Duplicates are still detected with the filter loaded'''
+    df = DuplicateFilter()
+    df.load()
+    monkeypatch.setattr(mail, 'duplicate_filter', df)
+    assert archive_message(SIMPLE_MESSAGE_BYTES, 'acme') == 0
+    assert archive_message(SIMPLE_MESSAGE_BYTES, 'acme') == 0
+    assert Message.objects.filter(msgid='0000000002@example.com').count() == 1
+    assert df.might_contain_msgid('acme', '0000000002@example.com') is True
@@ -0,0 +1,47 @@
+import os
+
+from elasticsearch import ConnectionError
+
+from mlarchive.archive.backends import client as client_module
+from mlarchive.archive.backends.client import check_health, get_client, get_client_stats, reset_client
+from mlarchive.archive.backends.elasticsearch import ESBackend
+
+
+def test_get_client(settings):
+    reset_client()
+    client = get_client()
+    assert get_client() is client
+    assert ESBackend().client is client
+    stats = get_client_stats()
+    assert stats['pid'] == os.getpid()
+    assert stats['nodes'][0]['maxsize'] == client_module.DEFAULT_CLIENT_KWARGS['maxsize']
+    assert stats['dead_nodes'] == 0
+
+
+def test_get_client_settings(settings):
+    client = get_client()
+    settings.ELASTICSEARCH_CONNECTION = {
+        'URL': 'http://127.0.0.1:9200/',
+        'INDEX_NAME': 'test-mail-archive',
+        'KWARGS': {'maxsize': 3},
+    }
+    new_client = get_client()
+    assert new_client is not client
+    assert get_client_stats()['nodes'][0]['maxsize'] == 3
+
+
+def test_get_client_fork(monkeypatch):
+    client = get_client()
+    monkeypatch.setattr(client_module.os, 'getpid', lambda: -1)
+    assert get_client() is not client
+
+
+def test_check_health(monkeypatch):
+    def fail(*args, **kwargs):
+        raise ConnectionError('N/A', 'connection refused', None)
+
+    monkeypatch.setattr(get_client().cluster, 'health', fail)
+    result = check_health()
+    assert result['status'] == 'unavailable'
+    assert 'elapsed' in result
+    assert result['nodes']
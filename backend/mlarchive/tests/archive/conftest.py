@@ -12,6 +12,9 @@ import subprocess
 from factories import EmailListFactory, ThreadFactory, MessageFactory, UserFactory
 from django.conf import settings
 from django.core.management import call_command
+from django.test.signals import setting_changed
+from mlarchive.archive.backends.client import reset_client
+from mlarchive.archive.inspectors import inspector_pipeline
 from mlarchive.archive.mail import get_base_subject
 from mlarchive.archive.models import Message, Thread
 
@@ -34,6 +37,19 @@ def pytest_configure(tmpdir_factory):
     # settings.configure()
 '''
 
+
+
+def reset_settings_caches(sender, setting, **kwargs):
+    '''The shared Elasticsearch client and inspector pipeline are built from settings
+    once, rebuild them when a test changes the settings'''
+    if setting == 'ELASTICSEARCH_CONNECTION':
+        reset_client()
+    elif setting == 'INSPECTORS':
+        inspector_pipeline.reset()
+
+
+setting_changed.connect(reset_settings_caches)
+
 # -----------------------------------
 # Session Fixtures
 # -----------------------------------
@@ -57,6 +73,7 @@ def data_dir(tmp_dir, settings):
     DATA_ROOT = tmp_dir
     settings.ARCHIVE_DIR = os.path.join(DATA_ROOT, 'archive')
     settings.EXPORT_DIR = os.path.join(DATA_ROOT, 'export')
+    settings.TEXT_CACHE_DIR = os.path.join(DATA_ROOT, 'text_cache')
     yield
 
 # -----------------------------------
@@ -2,9 +2,12 @@ import email
 import os
 import pytest
 
+from django.core.exceptions import ImproperlyConfigured
+
 from mlarchive.archive.inspectors import (ListIdSpamInspector, SpamMessage,
-    SpamLevelSpamInspector, NoArchiveInspector, NoArchiveMessage)
-from mlarchive.archive.mail import MessageWrapper
+    SpamLevelSpamInspector, NoArchiveInspector, NoArchiveMessage, InspectorPipeline,
+    get_header_values, inspector_pipeline)
+from mlarchive.archive.mail import NO_REFOLD_POLICY, MessageWrapper
 
 
 @pytest.mark.django_db(transaction=True)
@@ -72,3 +75,48 @@ def test_NoArchiveInspector(client, settings):
     with pytest.raises(NoArchiveMessage) as excinfo:
         inspector.inspect()
     assert 'X-No-Archive' in str(excinfo.value)
+
+
+def test_get_header_values():
+    message = email.message_from_string('List-Id: <acme.example.com>\nX-Spam-Level: *\nx-spam-level: **\n\nBody\n')
+    assert get_header_values(message) == {'list-id': '<acme.example.com>', 'x-spam-level': '*'}
+    # folded and encoded values are parsed
+    message = email.message_from_string(
+        'List-Id: Acme list\n <acme.example.com>\nX-Spam-Status: =?utf-8?q?Yes=2C_score=3D9?=\n\nBody\n',
+        policy=NO_REFOLD_POLICY)
+    header_values = get_header_values(message)
+    assert header_values['list-id'] == message.get('List-Id') == 'Acme list <acme.example.com>'
+    assert header_values['x-spam-status'] == message.get('X-Spam-Status') == 'Yes, score=9'
+
+
+@pytest.mark.django_db(transaction=True)
+def test_InspectorPipeline(settings):
+    settings.INSPECTORS = {
+        'SpamLevelSpamInspector': {'includes': ['acme']},
+        'NoArchiveInspector': {},
+    }
+    pipeline = InspectorPipeline()
+    assert [name for name, _, _ in pipeline.get_inspectors('acme')] == ['SpamLevelSpamInspector', 'NoArchiveInspector']
+    assert [name for name, _, _ in pipeline.get_inspectors('other')] == ['NoArchiveInspector']
+
+    path = os.path.join(settings.BASE_DIR, 'tests', 'data', 'mail_spamlevel.2')
+    with open(path) as f:
+        message = email.message_from_file(f)
+    pipeline.inspect(MessageWrapper.from_message(message, 'other'))
+    with pytest.raises(SpamMessage):
+        pipeline.inspect(MessageWrapper.from_message(message, 'acme'))
+    assert pipeline.stats['NoArchiveInspector'].calls == 1
+    assert pipeline.stats['SpamLevelSpamInspector'].calls == 1
+    assert pipeline.stats['SpamLevelSpamInspector'].matches == 1
+    assert len(pipeline.report()) == 2
+
+    # the shared pipeline is rebuilt when the setting changes
+    assert len(inspector_pipeline.get_inspectors('acme')) == 2
+    settings.INSPECTORS = {}
+    assert inspector_pipeline.get_inspectors('acme') == []
+
+
+def test_InspectorPipeline_unknown(settings):
+    settings.INSPECTORS = {'BogusInspector': {}}
+    with pytest.raises(ImproperlyConfigured):
+        InspectorPipeline().get_inspectors('acme')
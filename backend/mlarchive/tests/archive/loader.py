@@ -0,0 +1,80 @@
+import importlib.util
+import os
+import pytest
+import shutil
+
+from django.conf import settings
+
+from mlarchive.archive.management.commands.load import get_files
+from mlarchive.archive.models import Message
+
+
+def load_loader(monkeypatch):
+    bin_dir = os.path.join(settings.BASE_DIR, 'bin')
+    monkeypatch.syspath_prepend(bin_dir)
+    spec = importlib.util.spec_from_file_location('loader', os.path.join(bin_dir, 'loader.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def make_list_archive(path, files):
+    os.makedirs(path)
+    source = os.path.join(settings.BASE_DIR, 'tests', 'data', 'thread.mail')
+    for name in files:
+        shutil.copy(source, os.path.join(path, name))
+
+
+def test_get_files(tmpdir):
+    path = str(tmpdir.join('acme'))
+    make_list_archive(path, ['2016-07', '2015-01.mail', 'notes.txt'])
+    open(os.path.join(path, '2016-08'), 'w').close()
+    assert get_files(path) == [os.path.join(path, '2015-01.mail'), os.path.join(path, '2016-07')]
+    assert get_files(os.path.join(path, 'notes.txt')) == [os.path.join(path, 'notes.txt')]
+
+
+def test_checkpoint(tmpdir, monkeypatch):
+    loader = load_loader(monkeypatch)
+    path = str(tmpdir.join('checkpoint'))
+    assert loader.read_checkpoint(path) == {}
+    loader.write_checkpoint(path, 'acme', '/data/acme/2016-07', {'count': 4})
+    # partial line written by a worker that died
+    with open(path, 'a') as f:
+        f.write('{"list": "acme", "fi')
+    assert loader.read_checkpoint(path) == {'/data/acme/2016-07': {'count': 4}}
+    loader.write_checkpoint(path, 'acme', '/data/acme/2016-08', {'count': 2})
+    assert loader.read_checkpoint(path) == {'/data/acme/2016-07': {'count': 4}, '/data/acme/2016-08': {'count': 2}}
+
+
+@pytest.mark.django_db(transaction=True)
+def test_load_list_resume(tmpdir, monkeypatch):
+    loader = load_loader(monkeypatch)
+    path = str(tmpdir.join('acme'))
+    make_list_archive(path, ['2016-07', '2016-08'])
+    checkpoint = str(tmpdir.join('checkpoint'))
+    options = {'verbose': False, 'test': True, 'checkpoint': checkpoint}
+    first = os.path.join(path, '2016-07')
+    listname, stats, error = loader.load_list(path, {first}, options)
+    assert (listname, error) == ('acme', None)
+    assert list(loader.read_checkpoint(checkpoint)) == [os.path.join(path, '2016-08')]
+    assert stats['count'] == 4
+    assert Message.objects.filter(email_list__name='acme').count() == 4
+
+
+def test_load_lists_worker_died(tmpdir, monkeypatch):
+    loader = load_loader(monkeypatch)
+
+    def load_list(path, completed, options):
+        if os.path.basename(path) == 'bad':
+            os._exit(1)
+        return os.path.basename(path), {'count': len(completed)}, None
+
+    monkeypatch.setattr(loader, 'load_list', load_list)
+    dirs = [str(tmpdir.join(name)) for name in ('acme', 'bad', 'ford', 'zorn')]
+    completed = {os.path.join(dirs[0], '2016-07')}
+    results = sorted(loader.load_lists(dirs, completed, {}, workers=2))
+    assert results == [
+        ('acme', {'count': 1}, None),
+        ('bad', {}, 'worker process died, exit code 1'),
+        ('ford', {'count': 0}, None),
+        ('zorn', {'count': 0}, None)]
@@ -15,12 +15,14 @@ from io import StringIO
 
 from django.conf import settings
 from django.core.management import call_command
+from django.db import OperationalError
 from django.urls import reverse
 from mlarchive.archive.models import Message, EmailList
 from mlarchive.archive.mail import (archive_message, clean_spaces, MessageWrapper,
     get_base_subject, get_envelope_date, tzoffset, get_from, get_header_date, get_mb,
     is_aware, get_received_date, parsedate_to_datetime, subject_is_reply,
-    lookup_extension)
+    lookup_extension, BulkLoader, ListIndex, Loader, MMapMailbox, NO_REFOLD_POLICY,
+    parse_headers, walk_headers)
 from factories import EmailListFactory, MessageFactory, ThreadFactory
 from mlarchive.utils.test_utils import message_from_file
 
@@ -286,6 +288,119 @@ def test_get_mb():
         assert len(mb) > 0
 
 
+def test_MMapMailbox():
+    path = os.path.join(settings.BASE_DIR, 'tests', 'data', 'export.mbox')
+    mb = MMapMailbox(path)
+    assert mb.format == 'mbox'
+    expected = list(mailbox.mbox(path))
+    messages = [MessageWrapper.from_bytes(data, 'acme').email_message for data in mb]
+    assert len(mb) == len(expected) == 21
+    assert [m['Message-ID'] for m in messages] == [m['Message-ID'] for m in expected]
+    assert [m.get_payload() for m in messages] == [m.get_payload() for m in expected]
+    assert messages[0].get_unixfrom().startswith('From ')
+    mb.close()
+
+
+def test_MMapMailbox_mmdf():
+    path = os.path.join(settings.BASE_DIR, 'tests', 'data', 'mailbox_mmdf')
+    mb = MMapMailbox(path)
+    assert mb.format == 'MMDF'
+    messages = list(mb)
+    assert len(messages) == 5
+    assert not messages[0].tobytes().startswith(b'\x01')
+    assert messages[0].tobytes().startswith(b'Received:')
+
+
+def test_MMapMailbox_separator(tmpdir):
+    data = b'''From joe@example.com  Fri Jul  1 08:00:00 2016
+Subject: one
+
+From your message Mon, 9 Nov 1998 06:09:48 -0000:
+From joe without a date
+
+From larry@example.com  Fri Jul  8 08:00:00 2016
+Subject: two
+
+body
+'''
+    path = str(tmpdir.join('mbox'))
+    with open(path, 'wb') as f:
+        f.write(data)
+    messages = [m.tobytes() for m in MMapMailbox(path)]
+    assert len(messages) == 2
+    assert messages[0].endswith(b'From joe without a date\n')
+    assert messages[1].startswith(b'From larry@example.com')
+
+
+NESTED_MULTIPART_BYTES = b'''From: Joe <joe@example.com>
+To: Joe <joe@example.com>
+Date: Thu, 7 Nov 2013 17:54:55 +0000
+Message-ID: <0000000004@example.com>
+Subject: Nested
+MIME-Version: 1.0
+Content-Type: multipart/mixed; boundary="outer"
+
+This is the preamble.
+--outer
+Content-Type: multipart/alternative; boundary="inner"
+
+--inner
+Content-Type: text/plain
+
+Hello
+--inner
+Content-Type: text/html
+
+<p>Hello</p>
+--inner--
+--outer \t
+Content-Type: application/pdf; name="report.pdf"
+Content-Disposition: attachment; filename="report.pdf"
+
+--outerx
+--outer
+
+No headers.
+--outer--
+This is the epilogue.
+--outer
+'''
+
+
+def test_parse_headers():
+    headers = parse_headers(SIMPLE_MESSAGE_BYTES)
+    assert headers['Message-ID'] == '<0000000002@example.com>'
+    assert headers.get_payload() == ''
+    msg = email.message_from_bytes(SIMPLE_MESSAGE_BYTES, policy=NO_REFOLD_POLICY)
+    assert list(headers.items()) == list(msg.items())
+
+
+@pytest.mark.parametrize('data', [
+    SIMPLE_MESSAGE_BYTES,
+    NESTED_MULTIPART_BYTES,
+    NESTED_MULTIPART_BYTES.replace(b'\n', b'\r\n'),
+    'attachment.mail',
+    'mail_multipart.2'])
+def test_walk_headers(data):
+    if isinstance(data, str):
+        with open(os.path.join(settings.BASE_DIR, 'tests', 'data', data), 'rb') as f:
+            data = f.read()
+    parts = walk_headers(data)
+    expected = email.message_from_bytes(data, policy=NO_REFOLD_POLICY).walk()
+    assert [(p.get_content_type(), p.get_filename()) for p in parts] == \
+        [(p.get_content_type(), p.get_filename()) for p in expected]
+
+
+def test_walk_headers_full_parse():
+    '''Structures left to the full parser'''
+    # no close delimiter
+    assert walk_headers(NESTED_MULTIPART_BYTES.split(b'--outer--')[0]) is None
+    # missing boundary
+    assert walk_headers(NESTED_MULTIPART_BYTES.replace(b'; boundary="outer"', b'')) is None
+    # message/* part
+    assert walk_headers(NESTED_MULTIPART_BYTES.replace(b'application/pdf', b'message/rfc822')) is None
+
+
 def test_get_received_date():
     data = '''Received: from mail.ietf.org ([64.170.98.30]) by localhost \
 (ietfa.amsl.com [127.0.0.1]) (amavisd-new, port 10024) with ESMTP id oE4MnXBb8IJ9 \
@@ -326,6 +441,102 @@ def test_subject_is_reply():
 
 # def test_Loader()
 
+# --------------------------------------------------
+# BulkLoader
+# --------------------------------------------------
+
+
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.parametrize('chunk_size', [2, 1000])
+def test_BulkLoader(chunk_size):
+    '''Messages loaded in bulk should be threaded the same as messages
+    loaded one at a time'''
+    path = os.path.join(settings.BASE_DIR, 'tests', 'data', 'thread.mail')
+    Loader(path, listname='acme', private=False, test=True).process()
+    loader = BulkLoader(path, listname='bulk', private=False, test=True, chunk_size=chunk_size)
+    loader.process()
+    assert loader.stats['count'] == 4
+    assert loader.stats['errors'] == 0
+    assert len(loader.created_ids) == 4
+    expected = Message.objects.filter(email_list__name='acme').order_by('date')
+    messages = Message.objects.filter(email_list__name='bulk').order_by('date')
+
+    def describe(message):
+        in_reply_to = message.in_reply_to.msgid if message.in_reply_to else None
+        return (message.msgid, message.thread.first.msgid, message.thread.date,
+                message.thread_order, message.thread_depth, in_reply_to)
+
+    assert [describe(m) for m in messages] == [describe(m) for m in expected]
+    assert messages[3].in_reply_to == messages[1]
+
+
+@pytest.mark.django_db(transaction=True)
+def test_BulkLoader_mmap():
+    path = os.path.join(settings.BASE_DIR, 'tests', 'data', 'thread.mail')
+    loader = BulkLoader(path, listname='bulk', private=False, test=True, mmap=True)
+    loader.process()
+    assert loader.stats['MMapMailbox'] == 1
+    assert loader.stats['errors'] == 0
+    messages = Message.objects.filter(email_list__name='bulk').order_by('date')
+    assert [m.msgid for m in messages] == ['0000%s@example.com' % n for n in range(1, 5)]
+    assert messages[0].from_line == 'person@example.com Fri Jul 1 08:00:00 2016'
+
+
+@pytest.mark.django_db(transaction=True)
+def test_BulkLoader_duplicate():
+    path = os.path.join(settings.BASE_DIR, 'tests', 'data', 'thread.mail')
+    loader = BulkLoader(path, listname='bulk', private=False, test=True)
+    loader.process()
+    index = loader.index
+    loader = BulkLoader(path, listname='bulk', private=False, test=True, index=index)
+    loader.process()
+    assert loader.created_ids == []
+    assert Message.objects.filter(email_list__name='bulk').count() == 4
+
+
+@pytest.mark.django_db(transaction=True)
+def test_BulkLoader_failed_chunk(monkeypatch):
+    '''A chunk that fails to save leaves no message files in the archive'''
+    def save_chunk(self, chunk):
+        raise ValueError('bulk insert failed')
+
+    monkeypatch.setattr(BulkLoader, 'save_chunk', save_chunk)
+    path = os.path.join(settings.BASE_DIR, 'tests', 'data', 'thread.mail')
+    loader = BulkLoader(path, listname='bulkfail', private=False)
+    loader.process()
+    assert loader.stats['errors'] == 4
+    list_dir = os.path.join(settings.ARCHIVE_DIR, 'bulkfail')
+    assert os.listdir(list_dir) == ['_failed']
+    assert len(os.listdir(os.path.join(list_dir, '_failed'))) == 4
+
+
+@pytest.mark.django_db(transaction=True)
+def test_BulkLoader_write_files():
+    path = os.path.join(settings.BASE_DIR, 'tests', 'data', 'thread.mail')
+    loader = BulkLoader(path, listname='bulkfiles', private=False, chunk_size=2)
+    loader.process()
+    assert loader.stats['errors'] == 0
+    hashcodes = Message.objects.filter(email_list__name='bulkfiles').values_list('hashcode', flat=True)
+    assert sorted(os.listdir(os.path.join(settings.ARCHIVE_DIR, 'bulkfiles'))) == sorted(hashcodes)
+
+
+@pytest.mark.django_db(transaction=True)
+def test_ListIndex():
+    elist = EmailListFactory.create(name='public')
+    thread = ThreadFactory.create(email_list=elist)
+    message = MessageFactory.create(
+        email_list=elist,
+        msgid='001@example.com',
+        base_subject='New Members',
+        thread=thread,
+        date=datetime.datetime(2016, 1, 1))
+    index = ListIndex(elist)
+    assert index.get('001@example.com') == (message.pk, thread)
+    assert index.get('002@example.com') is None
+    assert message.hashcode in index.hashcodes
+    assert index.get_subject_thread('New Members', datetime.datetime(2016, 2, 1)) == thread
+    assert index.get_subject_thread('New Members', datetime.datetime(2015, 2, 1)) is None
+
 # --------------------------------------------------
 # MessageWrapper
 # --------------------------------------------------
@@ -336,6 +547,18 @@ def test_MessageWrapper_from_bytes():
     assert isinstance(mw, MessageWrapper)
 
 
+@pytest.mark.django_db(transaction=True)
+def test_MessageWrapper_from_bytes_lazy():
+    '''Only the headers are parsed, unless the whole message is needed'''
+    mw = MessageWrapper.from_bytes(NESTED_MULTIPART_BYTES, 'acme')
+    mw.process()
+    attachments = mw.get_attachments()
+    assert [(a.sequence, a.name) for a in attachments] == [(4, 'report.pdf')]
+    assert mw._email_message is None
+    assert mw.bytes is NESTED_MULTIPART_BYTES
+    assert mw.email_message.is_multipart()
+
+
 def test_MessageWrapper_from_message():
     msg = email.message_from_bytes(SIMPLE_MESSAGE_BYTES)
     mw = MessageWrapper.from_message(msg, 'acme')
@@ -444,6 +667,86 @@ This is the message.
     assert mw.get_thread_from_header(mw.references) == message.thread
 
 
+@pytest.mark.django_db(transaction=True)
+def test_MessageWrapper_save_thread():
+    '''A reply is placed in the thread without computing the whole thread, the
+    messages after it move down'''
+    elist = EmailListFactory.create(name='public')
+    thread = ThreadFactory.create(email_list=elist)
+    first = MessageFactory.create(email_list=elist, thread=thread, msgid='001@example.com',
+                                  date=datetime.datetime(2016, 1, 1))
+    second = MessageFactory.create(email_list=elist, thread=thread, msgid='002@example.com',
+                                   in_reply_to_value='<001@example.com>', date=datetime.datetime(2016, 1, 2),
+                                   thread_order=1, thread_depth=1)
+    third = MessageFactory.create(email_list=elist, thread=thread, msgid='003@example.com',
+                                  in_reply_to_value='<001@example.com>', date=datetime.datetime(2016, 1, 3),
+                                  thread_order=2, thread_depth=1)
+    data = '''From: joe@example.com
+To: larry@example.com
+Subject: Re: This is a test message
+References: <001@example.com> <002@example.com>
+Message-Id: <004@example.com>
+Date: Mon, 4 Jan 2016 08:04:41 -0800
+
+This is the message.
+'''
+    msg = email.message_from_string(data)
+    mw = MessageWrapper.from_message(msg, 'public')
+    mw.process()
+    assert mw.thread_info is None
+    mw.save(test=True)
+    orders = dict(thread.message_set.values_list('msgid', 'thread_order'))
+    assert orders == {first.msgid: 0, second.msgid: 1, '004@example.com': 2, third.msgid: 3}
+    assert mw.archive_message.thread_depth == 2
+
+
+@pytest.mark.django_db(transaction=True)
+def test_MessageWrapper_save_atomic(monkeypatch):
+    '''A failed save leaves nothing behind, so that the archiver can retry it'''
+    EmailListFactory.create(name='public')
+    process_attachments = MessageWrapper.process_attachments
+
+    def fail(self, test=False):
+        monkeypatch.setattr(MessageWrapper, 'process_attachments', process_attachments)
+        raise OperationalError('database gone away')
+
+    monkeypatch.setattr(MessageWrapper, 'process_attachments', fail)
+    mw = MessageWrapper.from_bytes(SIMPLE_MESSAGE_BYTES, 'public')
+    path = os.path.join(settings.ARCHIVE_DIR, 'public', mw.get_hash())
+    with pytest.raises(OperationalError):
+        mw.save()
+    assert Message.objects.count() == 0
+    assert not glob.glob(path + '*')
+    # the retry
+    mw = MessageWrapper.from_bytes(SIMPLE_MESSAGE_BYTES, 'public')
+    mw.save()
+    assert Message.objects.count() == 1
+    assert glob.glob(path + '*') == [path]
+    os.remove(path)
+
+
+@pytest.mark.django_db(transaction=True)
+def test_MessageWrapper_in_reply_to_prefer_list():
+    '''A reply to a msgid that isn't unique in the list still prefers the list'''
+    public = EmailListFactory.create(name='public')
+    other = EmailListFactory.create(name='other')
+    MessageFactory.create(email_list=other, msgid='001@example.com')
+    first = MessageFactory.create(email_list=public, msgid='001@example.com')
+    MessageFactory.create(email_list=public, msgid='001@example.com')
+    data = '''From: joe@example.com
+To: larry@example.com
+Subject: Re: This is a test message
+In-Reply-To: <001@example.com>
+Message-Id: <002@example.com>
+Date: Mon, 4 Jan 2016 08:04:41 -0800
+
+This is the message.
+'''
+    mw = MessageWrapper.from_message(email.message_from_string(data), 'public')
+    mw.process()
+    assert mw.in_reply_to_id == first.pk
+
+
 def test_MessageWrapper_get_to():
     data = '''From: joe@acme.com
 To: larry@acme.com
@@ -1,6 +1,9 @@
 import pytest
+import threading
+from types import SimpleNamespace
 
 from django.core.cache import cache
+from django.core.cache.backends.locmem import LocMemCache
 from django.conf import settings
 from django.http import QueryDict
 from django.test import RequestFactory
@@ -9,11 +12,13 @@ from factories import EmailListFactory
 
 from elasticsearch import Elasticsearch
 from elasticsearch_dsl import Search
+from elasticsearch_dsl.response import Response
 
 from mlarchive.archive.query_utils import (clean_queryid, generate_queryid, get_cached_query,
     get_filter_params, get_browse_equivalent, parse_query, map_sort_option, get_order_fields,
     DB_THREAD_SORT_FIELDS, IDX_THREAD_SORT_FIELDS, DEFAULT_SORT, get_count,
-    CustomPaginator)
+    CustomPaginator, get_cursor_body, reverse_sort, encode_cursor, decode_cursor)
+from mlarchive.archive import query_utils
 from mlarchive.utils.test_utils import get_request
 
 
@@ -129,3 +134,173 @@ def test_CustomPaginator(messages):
     assert page.start_index() == 1
     assert hasattr(page, '__iter__')
     assert len(page) == 10
+
+
+def test_CustomPaginator_one_request(monkeypatch):
+    requests = []
+
+    def execute(self, ignore_cache=False):
+        requests.append(self.to_dict())
+        return SimpleNamespace(hits=SimpleNamespace(total=SimpleNamespace(value=21)))
+
+    monkeypatch.setattr(Search, 'execute', execute)
+    monkeypatch.setattr(Search, 'count', lambda self: pytest.fail('count request'))
+    s = Search(index=settings.ELASTICSEARCH_INDEX_NAME).query('match', email_list='pubthree')
+    paginator = CustomPaginator(s, 10)
+    page = paginator.page(3)
+    assert paginator.count == 21
+    assert paginator.num_pages == 3
+    assert page.has_next() is False
+    assert len(requests) == 1
+    assert requests[0]['from'] == 20
+    assert requests[0]['size'] == 10
+    assert requests[0]['track_total_hits'] is True
+
+
+def test_reverse_sort():
+    sort = ['_score', {'date': {'order': 'desc'}}, 'django_id', {'frm_name': {'order': 'asc', 'missing': '_first'}}]
+    assert reverse_sort(sort) == [
+        {'_score': {'order': 'asc'}},
+        {'date': {'order': 'asc', 'missing': '_first'}},
+        {'django_id': {'order': 'desc', 'missing': '_first'}},
+        {'frm_name': {'order': 'desc', 'missing': '_last'}}]
+
+
+def test_get_cursor_body():
+    s = Search(index=settings.ELASTICSEARCH_INDEX_NAME).query('match', email_list='pubthree').sort('-date')
+    s.aggs.bucket('list_terms', 'terms', field='email_list')
+    body = get_cursor_body(s[40:60], 20)
+    assert body['sort'] == [{'date': {'order': 'desc'}}, 'django_id']
+    assert body['size'] == 20
+    assert 'from' not in body
+    assert 'aggs' not in body
+    assert 'aggs' in get_cursor_body(s, 20, aggs=True)
+    # relevance
+    body = get_cursor_body(Search().query('match', subject='test'), 20)
+    assert body['sort'] == ['_score', 'django_id']
+
+
+def test_encode_cursor():
+    s = Search(index=settings.ELASTICSEARCH_INDEX_NAME).query('match', email_list='pubthree').sort('-date')
+    body = get_cursor_body(s, 10)
+    cursor = encode_cursor([1383846895000, 7], body)
+    assert '=' not in cursor
+    assert decode_cursor(cursor, body) == [1383846895000, 7]
+    # the same search, another page size
+    assert decode_cursor(cursor, get_cursor_body(s, 20)) == [1383846895000, 7]
+    # another search
+    assert decode_cursor(cursor, get_cursor_body(s.filter('term', frm='joe@example.com'), 10)) is None
+    # without a search digest
+    assert decode_cursor(encode_cursor(['2013-01-01', 7]), body) == ['2013-01-01', 7]
+    # invalid
+    assert decode_cursor(encode_cursor([7]), body) is None
+    assert decode_cursor(encode_cursor([{'a': 1}, 7]), body) is None
+    assert decode_cursor('7', body) is None
+    assert decode_cursor('not a cursor!', body) is None
+
+
+def test_CustomPaginator_cursor(monkeypatch):
+    requests = []
+    response = SimpleNamespace(hits=SimpleNamespace(total=SimpleNamespace(value=100)))
+    monkeypatch.setattr(query_utils, 'get_sort_values', lambda body, message_id: pytest.fail('sort values request'))
+    monkeypatch.setattr(query_utils, 'execute_search_after',
+                        lambda body, sort_values, reverse=False, **params: requests.append(
+                            (body, sort_values, reverse, params)) or response)
+    monkeypatch.setattr(Search, 'execute', lambda self, ignore_cache=False: pytest.fail('offset request'))
+    s = Search(index=settings.ELASTICSEARCH_INDEX_NAME).query('match', email_list='pubthree').sort('date', 'django_id')
+    cursor = encode_cursor(['2013-01-01', 7], get_cursor_body(s, 10))
+    paginator = CustomPaginator(s, 10, cursor=('before', cursor))
+    page = paginator.page(4)
+    assert page.start_index() == 31
+    assert paginator.count == 100
+    body, sort_values, reverse, params = requests[0]
+    assert sort_values == ['2013-01-01', 7]
+    assert reverse is True
+    assert params == {'track_total_hits': True}
+    assert body['size'] == 10
+
+
+def test_CustomPaginator_cursor_other_search(monkeypatch):
+    '''A cursor from another search is ignored, the page is fetched by offset'''
+    requests = []
+
+    def execute(self, ignore_cache=False):
+        requests.append(self.to_dict())
+        return Response(self, {'hits': {'total': {'value': 100}, 'hits': [
+            {'_id': '1', '_source': {'subject': 'Hi'}, 'sort': ['2013-01-01', 1]}]}})
+
+    monkeypatch.setattr(query_utils, 'execute_search_after', lambda *args, **kwargs: pytest.fail('cursor request'))
+    monkeypatch.setattr(Search, 'execute', execute)
+    s = Search(index=settings.ELASTICSEARCH_INDEX_NAME).query('match', email_list='pubthree').sort('date', 'django_id')
+    cursor = encode_cursor(['2013-01-01', 7], get_cursor_body(s.query('match', subject='hi'), 10))
+    paginator = CustomPaginator(s, 10, cursor=('after', cursor))
+    paginator.page(4)
+    assert requests[0]['from'] == 30
+    assert decode_cursor(paginator.get_next_cursor(), get_cursor_body(s, 10)) == ['2013-01-01', 1]
+
+
+@pytest.mark.filterwarnings('error::django.core.cache.backends.base.CacheKeyWarning')
+def test_search_cache_cursor(monkeypatch):
+    '''The page key stays within the memcached key limit for long sort values'''
+    monkeypatch.setattr(query_utils, 'cache', LocMemCache('search_cache', {}))
+    s = Search(index=settings.ELASTICSEARCH_INDEX_NAME).query('match', email_list='pubone').sort('subject_base')
+    response = Response(s, {'hits': {'total': {'value': 100}, 'hits': [
+        {'_id': '1', '_source': {'subject': 'Hi'}, 'sort': ['hi', 1]}]}})
+    requests = []
+    monkeypatch.setattr(query_utils, 'execute_search_after',
+                        lambda *args, **kwargs: requests.append(args) or response)
+    cursor = encode_cursor(['\u00fcber ' * 40, 7], get_cursor_body(s, 10))
+    key = query_utils.get_search_cache_key(s)
+    for _ in range(2):
+        page = CustomPaginator(s, 10, cursor=('after', cursor), cache_key=key).page(4)
+        assert [r.subject for r in page.object_list] == ['Hi']
+    assert len(requests) == 1
+
+
+def test_search_cache(monkeypatch, settings):
+    monkeypatch.setattr(query_utils, 'cache', LocMemCache('search_cache', {}))
+    requests = []
+
+    def execute(self, ignore_cache=False):
+        requests.append(self.to_dict())
+        return Response(self, {'hits': {'total': {'value': 1}, 'hits': [{'_id': '1', '_source': {'subject': 'Hi'}}]}})
+
+    monkeypatch.setattr(Search, 'execute', execute)
+    s = Search(index=settings.ELASTICSEARCH_INDEX_NAME).query('match', email_list='pubone')
+    key = query_utils.get_search_cache_key(s, ['pubone'])
+    # equivalent search, same key
+    assert query_utils.get_search_cache_key(s._clone(), ['pubone']) == key
+    assert query_utils.get_search_cache_key(s.query('match', subject='hi'), ['pubone']) != key
+
+    page = CustomPaginator(s, 10, cache_key=key).page(1)
+    assert [r.subject for r in page.object_list] == ['Hi']
+    page = CustomPaginator(s, 10, cache_key=key).page(1)
+    assert [r.subject for r in page.object_list] == ['Hi']
+    assert len(requests) == 1
+
+    # new message in another list
+    query_utils.invalidate_search_cache(['pubtwo'])
+    assert query_utils.get_search_cache_key(s, ['pubone']) == key
+    assert query_utils.get_search_cache_key(s) != key
+    query_utils.invalidate_search_cache(['pubone'])
+    assert query_utils.get_search_cache_key(s, ['pubone']) != key
+
+
+def test_invalidate_search_cache_after_update(monkeypatch, settings):
+    settings.SEARCH_RESULTS_CACHE_TIMEOUT = 60
+    settings.SEARCH_RESULTS_CACHE_REFRESH_DELAY = 0.01
+    invalidated = []
+    done = threading.Event()
+
+    def invalidate_search_cache(list_names):
+        invalidated.append(list(list_names))
+        if len(invalidated) == 3:
+            done.set()
+
+    monkeypatch.setattr(query_utils, 'invalidate_search_cache', invalidate_search_cache)
+    query_utils.invalidate_search_cache_after_update({'pubone'}, refreshed=True)
+    assert invalidated == [['pubone']]
+    # expired again once the changes are searchable
+    query_utils.invalidate_search_cache_after_update({'pubone'})
+    assert done.wait(5)
+    assert invalidated == [['pubone'], ['pubone'], ['pubone']]
@@ -1,11 +1,13 @@
 import datetime
 import os
 import pytest
+from types import SimpleNamespace
 
 from factories import EmailListFactory, ThreadFactory, MessageFactory
 
 from mlarchive.archive.models import EmailList, Message, Thread
-from mlarchive.archive.signals import get_purge_cache_urls
+from mlarchive.archive import signals
+from mlarchive.archive.signals import TaskBuffer, get_purge_cache_urls
 
 
 @pytest.mark.django_db(transaction=True)
@@ -72,3 +74,39 @@ def test_get_purge_cache_urls(messages):
     # self on delete
     urls = get_purge_cache_urls(message, created=False)
     assert message.get_absolute_url_with_host() in urls
+
+
+def test_TaskBuffer(monkeypatch):
+    sent = []
+
+    class Task(object):
+        def apply_async(self, args, kwargs=None):
+            sent.append(args[0])
+
+    monkeypatch.setattr(signals, 'get_update_task', lambda task_path=None: Task())
+    buffer = TaskBuffer(delay=60, size=3)
+    buffer.put('archive.message.1', ('update', 'acme'))
+    buffer.put('archive.message.1', ('delete', 'acme'))
+    buffer.put('archive.message.2', ('update', 'acme'))
+    assert sent == []
+    buffer.put('archive.message.3', ('update', 'ford'))
+    assert sent == [[('delete', 'archive.message.1', 'acme'), ('update', 'archive.message.2', 'acme'),
+                     ('update', 'archive.message.3', 'ford')]]
+
+
+@pytest.mark.django_db(transaction=True)
+def test_list_private_changed(monkeypatch):
+    updated = []
+    pending = []
+    task = SimpleNamespace(delay=lambda list_name, private: updated.append((list_name, private)))
+    monkeypatch.setattr(signals, 'get_update_task', lambda task_path: task)
+    monkeypatch.setattr(signals, 'update_private_pending',
+                        lambda list_names, delta: pending.append((list_names, delta)))
+    elist = EmailListFactory.create(name='acme')
+    elist.description = 'changed'
+    elist.save()
+    assert updated == []
+    elist.private = True
+    elist.save()
+    assert pending == [(['acme'], 1)]
+    assert updated == [('acme', True)]
@@ -0,0 +1,30 @@
+import os
+import pytest
+
+from mlarchive.archive.spool import Spool
+
+
+def test_Spool(tmpdir):
+    spool = Spool(str(tmpdir), max_messages=2)
+    assert len(spool) == 0
+    first = spool.put(b'first message', 'acme')
+    second = spool.put(b'second message', 'private', private=True)
+    assert spool.names() == [first, second]
+    assert spool.is_full()
+    assert spool.get(first) == ('acme', False, b'first message')
+    assert spool.get(second) == ('private', True, b'second message')
+    assert os.listdir(spool.tmp_dir) == []
+    spool.remove(first)
+    assert spool.names() == [second]
+    assert not spool.is_full()
+
+
+def test_Spool_bad_entry(tmpdir):
+    spool = Spool(str(tmpdir))
+    with open(os.path.join(spool.new_dir, 'bogus'), 'wb') as f:
+        f.write(b'garbage\nmessage')
+    with pytest.raises(ValueError):
+        spool.get('bogus')
+    spool.set_aside('bogus')
+    assert spool.names() == []
+    assert os.listdir(spool.bad_dir) == ['bogus']
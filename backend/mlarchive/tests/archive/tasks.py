@@ -0,0 +1,51 @@
+import pytest
+from celery.exceptions import Retry
+
+from factories import EmailListFactory, MessageFactory
+
+from mlarchive.archive import tasks
+from mlarchive.archive.backends.elasticsearch import ESBackend
+from mlarchive.archive.tasks import CeleryBatchSignalHandler
+
+
+@pytest.mark.django_db(transaction=True)
+def test_CeleryBatchSignalHandler(monkeypatch, settings, django_assert_max_num_queries):
+    settings.ELASTICSEARCH_INDEX_REFRESH = False
+    updated = []
+    removed = []
+    invalidated = []
+    monkeypatch.setattr(ESBackend, 'update',
+                        lambda self, iterable, commit=True: updated.extend(iterable) or invalidated.append(commit))
+    monkeypatch.setattr(ESBackend, 'remove_many', lambda self, identifiers, commit=True: removed.extend(identifiers))
+    monkeypatch.setattr(tasks, 'invalidate_search_cache_after_update',
+                        lambda list_names, refreshed: invalidated.append((sorted(list_names), refreshed)))
+    public = EmailListFactory.create(name='public')
+    messages = [MessageFactory.create(email_list=public) for n in range(3)]
+    changes = [('update', 'archive.message.{}'.format(m.pk), 'public') for m in messages]
+    changes.append(('delete', 'archive.message.999', 'private'))
+    changes.append(('update', 'archive.message.1000'))
+    with django_assert_max_num_queries(1):
+        CeleryBatchSignalHandler.run(changes)
+    assert sorted(m.pk for m in updated) == sorted(m.pk for m in messages)
+    # related objects loaded with the batch
+    with django_assert_max_num_queries(0):
+        assert all(m.email_list.name == 'public' and m.thread for m in updated)
+    assert removed == ['archive.message.999']
+    # the update doesn't wait for the refresh, then the cached results are expired
+    assert invalidated == [False, (['private', 'public'], False)]
+
+
+def test_update_list_private(monkeypatch):
+    pending = []
+    complete = []
+    monkeypatch.setattr(ESBackend, 'update_list_private', lambda self, list_name, private: complete.pop())
+    monkeypatch.setattr(tasks, 'update_private_pending', lambda list_names, delta: pending.append((list_names, delta)))
+    monkeypatch.setattr(tasks, 'invalidate_search_cache', lambda list_names: None)
+    complete.append(True)
+    tasks.update_list_private('acme', True)
+    assert pending == [(['acme'], -1)]
+    # the list stays pending until the update completes
+    complete.append(False)
+    with pytest.raises(Retry):
+        tasks.update_list_private('acme', True)
+    assert pending == [(['acme'], -1)]
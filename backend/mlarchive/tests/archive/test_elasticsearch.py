@@ -1,15 +1,26 @@
 import datetime
+import os
 import pytest
+import threading
 from io import StringIO
+from types import SimpleNamespace
 
 from django.conf import settings
+from django.core.cache.backends.locmem import LocMemCache
 from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.utils.encoding import smart_bytes
 from elasticsearch import Elasticsearch
-from elasticsearch.exceptions import NotFoundError
+from elasticsearch.exceptions import ConnectionError as ESConnectionError, NotFoundError
 from elasticsearch_dsl import Search
-from factories import EmailListFactory, ThreadFactory, MessageFactory
+from django.contrib.auth.models import AnonymousUser
+from factories import EmailListFactory, ThreadFactory, MessageFactory, UserFactory
 
-from mlarchive.archive.models import Message
+from mlarchive.archive.backends import elasticsearch as elasticsearch_backend
+from mlarchive.archive.backends.elasticsearch import (ESBackend, IndexBuffer, PREPARE_RELATED, full_prepare,
+    ElasticsearchQuery, get_access_filter)
+from mlarchive.archive.management.commands import rebuild_index, update_index
+from mlarchive.archive.models import EmailList, Message
 
 
 @pytest.mark.django_db(transaction=True)
@@ -162,3 +173,371 @@ def test_simple():
                           msgid='a01',
                           date=datetime.datetime(2013, 1, 1))
     assert Message.objects.all().count() == 1
+
+
+class PrepareBackend(object):
+    '''Backend with documents prepared from (pk, text) tuples'''
+    client = None
+    index_name = 'test'
+    setup_complete = True
+    silently_fail = True
+
+    def prepare(self, iterable):
+        return [{'_id': 'archive.message.{}'.format(pk), 'text': text} for pk, text in iterable]
+
+    def bulk(self, actions, **kwargs):
+        return elasticsearch_backend.bulk(self.client, actions, index=self.index_name, **kwargs)
+
+
+def test_IndexBuffer(monkeypatch, settings):
+    settings.SEARCH_RESULTS_CACHE_TIMEOUT = 0
+    requests = []
+    monkeypatch.setattr(elasticsearch_backend, 'bulk',
+                        lambda client, actions, **kwargs: requests.append((list(actions), kwargs)))
+    buffer = IndexBuffer(PrepareBackend(), delay=60, size=4, refresh=False)
+    buffer.add([(1, 'one')])
+    buffer.add([(1, 'one updated'), (2, 'two')])
+    buffer.remove('archive.message.3')
+    assert requests == []
+    assert buffer.timer is not None
+    buffer.flush()
+    assert buffer.timer is None
+    assert len(requests) == 1
+    actions, kwargs = requests[0]
+    assert actions == [
+        {'_id': 'archive.message.1', 'text': 'one updated'},
+        {'_id': 'archive.message.2', 'text': 'two'},
+        {'_op_type': 'delete', '_id': 'archive.message.3'}]
+    assert kwargs['refresh'] is False
+    # full batch is sent immediately
+    buffer.add([(4, 'four'), (5, 'five'), (6, 'six'), (7, 'seven')])
+    assert len(requests) == 2
+    stats = buffer.get_stats()
+    assert stats['batches'] == 2
+    assert stats['documents'] == 7
+    assert stats['max_batch'] == 4
+    assert stats['avg_batch'] == 3.5
+
+
+def test_IndexBuffer_no_delay(monkeypatch):
+    requests = []
+    monkeypatch.setattr(elasticsearch_backend, 'bulk',
+                        lambda client, actions, **kwargs: requests.append((list(actions), kwargs)))
+    buffer = IndexBuffer(PrepareBackend(), delay=0, refresh='wait_for')
+    buffer.add([(1, 'one')])
+    assert len(requests) == 1
+    assert requests[0][1]['refresh'] == 'wait_for'
+
+
+def test_IndexBuffer_search_cache(monkeypatch, settings):
+    '''Cached search results of the lists changed are expired after the update, which
+    doesn't wait for the refresh'''
+    settings.SEARCH_RESULTS_CACHE_TIMEOUT = 60
+    events = []
+    monkeypatch.setattr(elasticsearch_backend, 'bulk',
+                        lambda client, actions, **kwargs: events.append(('bulk', kwargs['refresh'])))
+    monkeypatch.setattr(elasticsearch_backend, 'invalidate_search_cache_after_update',
+                        lambda list_names, refreshed: events.append(('invalidate', sorted(list_names), refreshed)))
+    backend = PrepareBackend()
+    backend.prepare = lambda iterable: [
+        {'_id': 'archive.message.{}'.format(pk), 'email_list': name} for pk, name in iterable]
+    buffer = IndexBuffer(backend, delay=60, size=10, refresh=False)
+    buffer.add([(1, 'pubone'), (2, 'pubone'), (3, 'pubtwo')])
+    buffer.remove(Message(pk=4, email_list=EmailList(name='private')))
+    assert events == []
+    buffer.flush()
+    assert events == [('bulk', False), ('invalidate', ['private', 'pubone', 'pubtwo'], False)]
+
+
+def test_IndexBuffer_timer(monkeypatch):
+    flushed = threading.Event()
+    monkeypatch.setattr(elasticsearch_backend, 'bulk', lambda client, actions, **kwargs: flushed.set())
+    buffer = IndexBuffer(PrepareBackend(), delay=0.01)
+    buffer.add([(1, 'one')])
+    assert flushed.wait(5)
+
+
+def test_IndexBuffer_retry(monkeypatch, settings):
+    '''Documents are kept while Elasticsearch is unreachable'''
+    settings.ELASTICSEARCH_INDEX_RETRY_DELAY = 60
+    settings.ELASTICSEARCH_INDEX_RETRY_SIZE = 3
+    requests = []
+
+    def bulk(client, actions, **kwargs):
+        requests.append(list(actions))
+        if len(requests) == 1:
+            raise ESConnectionError('N/A', 'connection refused', None)
+
+    monkeypatch.setattr(elasticsearch_backend, 'bulk', bulk)
+    buffer = IndexBuffer(PrepareBackend(), delay=0)
+    buffer.add([(1, 'one'), (2, 'two')])
+    assert len(requests) == 1
+    assert buffer.retry_delay == 60
+    assert buffer.timer is not None
+    # changes wait for the retry
+    buffer.add([(1, 'one updated'), (3, 'three'), (4, 'four')])
+    buffer.flush()
+    assert len(requests) == 1
+    buffer.flush(retry=True)
+    assert requests[1] == [
+        {'_id': 'archive.message.1', 'text': 'one updated'},
+        {'_id': 'archive.message.2', 'text': 'two'},
+        {'_id': 'archive.message.3', 'text': 'three'}]
+    assert buffer.retry_delay == 0
+    assert buffer.timer is None
+    assert buffer.get_stats()['errors'] == 1
+
+
+class FakeIndices(object):
+    '''Indices client of a cluster with the given aliases, index -> alias'''
+    def __init__(self, aliases):
+        self.aliases = aliases
+        self.requests = []
+
+    def exists(self, index):
+        return index in self.aliases or index in self.aliases.values()
+
+    def exists_alias(self, name):
+        return name in self.aliases.values()
+
+    def get_alias(self, name):
+        return {index: {} for index, alias in self.aliases.items() if alias == name}
+
+    def update_aliases(self, body):
+        self.requests.append(body)
+
+
+def test_build_index(monkeypatch):
+    monkeypatch.setattr(elasticsearch_backend, 'cache', LocMemCache('build_index', {}))
+    requests = []
+    monkeypatch.setattr(elasticsearch_backend, 'bulk',
+                        lambda client, actions, **kwargs: requests.append(kwargs))
+    backend = ESBackend()
+    elasticsearch_backend.set_build_index('mail-archive-new')
+    assert elasticsearch_backend.get_build_index() == 'mail-archive-new'
+    backend.bulk([{'_id': 'archive.message.1'}], refresh='wait_for')
+    assert requests == [
+        {'index': backend.index_name, 'refresh': 'wait_for'},
+        {'index': 'mail-archive-new'}]
+    elasticsearch_backend.set_build_index(None)
+    assert elasticsearch_backend.get_build_index() is None
+    backend.bulk([{'_id': 'archive.message.1'}])
+    assert len(requests) == 3
+
+
+def test_swap_alias():
+    backend = ESBackend()
+    name = backend.index_name
+    backend.client = type('FakeClient', (), {})()
+    backend.client.indices = FakeIndices({name + '-1': name, 'other': 'other'})
+    assert backend.swap_alias(name + '-2') == [name + '-1']
+    assert backend.client.indices.requests[-1] == {'actions': [
+        {'remove': {'index': name + '-1', 'alias': name}},
+        {'add': {'index': name + '-2', 'alias': name}}]}
+    # index from before aliases were used
+    backend.client.indices = FakeIndices({})
+    backend.client.indices.exists = lambda index: index == name
+    assert backend.swap_alias(name + '-2') == []
+    assert backend.client.indices.requests[-1] == {'actions': [
+        {'remove_index': {'index': name}},
+        {'add': {'index': name + '-2', 'alias': name}}]}
+
+
+@pytest.mark.django_db(transaction=True)
+def test_full_prepare_queries(django_assert_num_queries):
+    public = EmailListFactory.create(name='public')
+    thread = ThreadFactory.create()
+    for n in range(3):
+        MessageFactory.create(email_list=public, thread=thread, hashcode='abc{}='.format(n))
+    messages = list(Message.objects.select_related(*PREPARE_RELATED))
+    with django_assert_num_queries(0):
+        docs = [full_prepare(m) for m in messages]
+    assert [d['url'] for d in docs] == [m.get_absolute_url() for m in messages]
+    assert docs[0]['email_list'] == 'public'
+    assert docs[0]['private'] is False
+    assert docs[0]['acl_token'] == 'list-{}'.format(public.pk)
+    assert docs[0]['thread_date'] == thread.date
+
+
+@pytest.mark.django_db(transaction=True)
+def test_update_index_checkpoint(tmpdir, monkeypatch):
+    indexed = []
+    monkeypatch.setattr(ESBackend, 'update', lambda self, iterable, commit=True: indexed.extend(iterable))
+    public = EmailListFactory.create(name='public')
+    messages = [MessageFactory.create(email_list=public) for n in range(5)]
+    first = messages[0].pk
+    qs = Message.objects.all()
+    assert update_index.get_chunks(qs, 2) == [(first - 1, first + 1), (first + 1, first + 3), (first + 3, first + 4)]
+
+    # a checkpoint from an interrupted run
+    path = str(tmpdir.join('checkpoint.json'))
+    options = {'start_date': None, 'end_date': None, 'batch_size': 2, 'index': settings.ELASTICSEARCH_INDEX_NAME}
+    checkpoint = update_index.Checkpoint(path, options)
+    checkpoint.add(first - 1)
+    out = StringIO()
+    call_command('update_index', batchsize=2, checkpoint=path, commit=False, stdout=out)
+    assert sorted(m.pk for m in indexed) == [m.pk for m in messages[2:]]
+    assert 'Resuming, 1 of 3 chunks done' in out.getvalue()
+    assert not os.path.exists(path)
+
+    # different options
+    update_index.Checkpoint(path, options).add(first - 1)
+    with pytest.raises(CommandError):
+        call_command('update_index', batchsize=3, checkpoint=path, stdout=out)
+
+
+@pytest.mark.django_db(transaction=True)
+def test_worker_index_chunk(monkeypatch):
+    indexed = []
+    monkeypatch.setattr(ESBackend, 'update', lambda self, iterable, commit=True: indexed.extend(iterable))
+    public = EmailListFactory.create(name='public')
+    private = EmailListFactory.create(name='private')
+    message = MessageFactory.create(email_list=public)
+    MessageFactory.create(email_list=private)
+    task = (None, {'email_list__name': 'public'}, message.pk - 1, message.pk + 1, 1, False, 1)
+    low, high, documents, queries = update_index.worker_index_chunk(task)
+    assert (low, high, documents, queries) == (message.pk - 1, message.pk + 1, 1, 1)
+    assert indexed == [message]
+
+
+@pytest.mark.django_db(transaction=True)
+def test_IndexPipeline(monkeypatch):
+    submitted = []
+    monkeypatch.setattr(ESBackend, 'update_prepared',
+                        lambda self, documents, commit=True: submitted.extend(d['id'] for d in documents))
+    public = EmailListFactory.create(name='public')
+    messages = [MessageFactory.create(email_list=public) for n in range(5)]
+    qs = Message.objects.all()
+    done = []
+    pipeline = update_index.IndexPipeline(ESBackend(), qs, workers=2, queue_size=1)
+    pipeline.run(update_index.get_chunks(qs, 2), lambda low, high, documents, queries: done.append(documents))
+    assert submitted == ['archive.message.{}'.format(m.pk) for m in messages]
+    assert done == [2, 2, 1]
+    assert [stage.documents for stage in pipeline.stages] == [5, 5, 5]
+    assert pipeline.report()[-1].startswith('pipeline: 5 documents')
+
+
+class FakeSearch(object):
+    hits = []
+
+    def __init__(self, using=None, index=None):
+        self.index = index
+
+    def count(self):
+        return len(self.hits)
+
+    def source(self, fields=None):
+        return self
+
+    def scan(self):
+        return iter(self.hits)
+
+
+def test_remove_stale_records(monkeypatch):
+    monkeypatch.setattr(update_index, 'Search', FakeSearch)
+    monkeypatch.setattr(FakeSearch, 'hits', [
+        {'django_id': str(pk), 'id': 'archive.message.{}'.format(pk)} for pk in (1, 2, 3)])
+    removed = []
+    monkeypatch.setattr(ESBackend, 'remove', lambda self, rec_id, commit=True: removed.append(rec_id))
+    update_index.remove_stale_records(ESBackend('mail-archive-new'), {b'1', b'3'}, 2, verbosity=0)
+    assert removed == ['archive.message.2']
+
+
+@pytest.mark.django_db(transaction=True)
+def test_rebuild_index_deleted(monkeypatch):
+    '''Messages deleted while the index is built are removed from the new index
+    before it is used'''
+    events = []
+    message = MessageFactory.create(email_list=EmailListFactory.create(name='public'))
+    monkeypatch.setattr(rebuild_index, 'call_command', lambda *args, **kwargs: events.append('update_index'))
+    monkeypatch.setattr(ESBackend, 'get_alias_indices', lambda self: [])
+    monkeypatch.setattr(ESBackend, 'create_index', lambda self, bulk_load=False: 'mail-archive-new')
+    monkeypatch.setattr(ESBackend, 'finish_bulk_load', lambda self, name, replicas=None: events.append('finish'))
+    monkeypatch.setattr(ESBackend, 'swap_alias', lambda self, name: events.append('swap') or [])
+    monkeypatch.setattr(rebuild_index, 'remove_stale_records',
+                        lambda backend, database_pks, batch_size, **kwargs: events.append(
+                            ('remove', backend.index_name, database_pks)))
+    call_command('rebuild_index', verbosity=0)
+    assert events == ['update_index', 'finish', ('remove', 'mail-archive-new', {smart_bytes(message.pk)}), 'swap']
+
+
+@pytest.mark.django_db(transaction=True)
+def test_get_access_filter():
+    EmailListFactory.create(name='public')
+    private = EmailListFactory.create(name='private', private=True)
+    EmailListFactory.create(name='other', private=True)
+    user = UserFactory.create()
+    public_only = {'term': {'private': False}}
+    assert get_access_filter(AnonymousUser()).to_dict() == public_only
+    assert get_access_filter(user).to_dict() == public_only
+    private.members.add(user)
+    assert get_access_filter(user).to_dict() == {'bool': {'should': [
+        public_only, {'terms': {'acl_token': ['list-{}'.format(private.pk)]}}]}}
+    # lists whose private field is being updated
+    assert get_access_filter(AnonymousUser(), {'other': 1}).to_dict() == {'bool': {'should': [
+        public_only, {'terms': {'email_list': ['other']}}]}}
+    assert get_access_filter(UserFactory.create(username='super', is_superuser=True)) is None
+
+
+@pytest.mark.django_db(transaction=True)
+def test_exclude_private_lists(settings, rf, monkeypatch):
+    EmailListFactory.create(name='public')
+    EmailListFactory.create(name='private', private=True)
+    request = rf.get('/arch/search/')
+    request.user = AnonymousUser()
+    exclude = {'bool': {'must_not': [{'terms': {'email_list': ['private']}}]}}
+
+    def get_filters():
+        query = ElasticsearchQuery(SimpleNamespace(request=request))
+        query.exclude_private_lists()
+        return query.search.to_dict()['query']['bool']['filter']
+
+    settings.ELASTICSEARCH_PRIVATE_FILTER = False
+    assert get_filters() == [exclude]
+    # pending updates of the private field not known
+    settings.ELASTICSEARCH_PRIVATE_FILTER = True
+    monkeypatch.setattr(elasticsearch_backend, 'cache', LocMemCache('exclude_private_lists', {}))
+    assert get_filters() == [exclude]
+    # the private field replaces the exclusion
+    elasticsearch_backend.update_private_pending(['private'], 1, reset=True)
+    elasticsearch_backend.update_private_pending(['private'], -1)
+    assert get_filters() == [{'term': {'private': False}}]
+    # except for lists whose private field is being updated
+    elasticsearch_backend.update_private_pending(['private'], 1)
+    assert get_filters() == [
+        {'bool': {'should': [{'term': {'private': False}}, {'terms': {'email_list': ['private']}}]}}, exclude]
+
+
+def test_update_private_pending(monkeypatch):
+    monkeypatch.setattr(elasticsearch_backend, 'cache', LocMemCache('private_pending', {}))
+    get_private_pending = elasticsearch_backend.get_private_pending
+    update_private_pending = elasticsearch_backend.update_private_pending
+    assert get_private_pending() is None
+    # not known until reset
+    update_private_pending(['acme'], 1)
+    assert get_private_pending() is None
+    update_private_pending(['acme', 'ford'], 1, reset=True)
+    update_private_pending(['acme'], 1)
+    assert get_private_pending() == {'acme': 2, 'ford': 1}
+    update_private_pending(['acme', 'ford'], -1)
+    assert get_private_pending() == {'acme': 1}
+    elasticsearch_backend.forget_private_pending()
+    assert get_private_pending() is None
+
+
+def test_update_list_private(monkeypatch):
+    results = [{'failures': [], 'version_conflicts': 2}, {'failures': [], 'version_conflicts': 0}]
+    calls = []
+
+    def update_by_query(**kwargs):
+        calls.append(kwargs)
+        return results.pop(0)
+
+    backend = ESBackend()
+    backend.setup_complete = True
+    monkeypatch.setattr(backend.client, 'update_by_query', update_by_query)
+    monkeypatch.setattr(elasticsearch_backend, 'get_build_index', lambda: None)
+    backend.update_list_private('acme', True)
+    assert len(calls) == 2
+    assert calls[0]['refresh'] is True
+    assert calls[0]['body']['query']['bool']['must_not'] == [{'term': {'private': True}}]
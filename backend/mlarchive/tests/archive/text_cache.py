@@ -0,0 +1,66 @@
+import gzip
+import os
+import pytest
+
+from mlarchive.archive import text_cache
+from mlarchive.archive.models import Message
+from factories import EmailListFactory, MessageFactory
+
+
+MESSAGE_BYTES = b'''From: Joe <joe@example.com>
+To: Joe <joe@example.com>
+Date: Thu, 7 Nov 2013 17:54:55 +0000
+Message-ID: <0000000001@example.com>
+Content-Type: text/plain; charset="us-ascii"
+Subject: This is a test
+
+Hello,
+
+This is a test email.
+'''
+
+
+def write_message_file(message, data):
+    path = message.get_file_path()
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+@pytest.mark.django_db(transaction=True)
+def test_get_text(monkeypatch):
+    public = EmailListFactory.create(name='public')
+    message = MessageFactory.create(email_list=public, hashcode='cachetest0=')
+    write_message_file(message, MESSAGE_BYTES)
+    text = text_cache.get_text(message)
+    assert 'This is a test email.' in text
+    assert os.path.exists(text_cache.get_cache_path(message))
+
+    # cached, the message file isn't parsed
+    monkeypatch.setattr(Message, 'get_body', lambda self: pytest.fail('not cached'))
+    assert text_cache.get_text(message) == text
+    monkeypatch.undo()
+
+    # changed file replaces the entry
+    write_message_file(message, MESSAGE_BYTES.replace(b'test email', b'changed email'))
+    assert 'This is a changed email.' in text_cache.get_text(message)
+
+    # corrupt entry is replaced
+    with open(text_cache.get_cache_path(message), 'wb') as f:
+        f.write(b'corrupt')
+    assert 'This is a changed email.' in text_cache.get_text(message)
+    with gzip.open(text_cache.get_cache_path(message), 'rt', encoding='utf8') as f:
+        assert f.readline()[:-1] == text_cache.get_file_key(message.get_file_path())
+
+    # deleting the message removes the entry
+    message.delete()
+    assert not os.path.exists(text_cache.get_cache_path(message))
+
+
+@pytest.mark.django_db(transaction=True)
+def test_get_text_disabled(settings):
+    settings.TEXT_CACHE_DIR = None
+    public = EmailListFactory.create(name='public')
+    message = MessageFactory.create(email_list=public, hashcode='cachetest1=')
+    write_message_file(message, MESSAGE_BYTES)
+    assert 'This is a test email.' in text_cache.get_text(message)
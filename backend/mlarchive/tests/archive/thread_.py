@@ -1,4 +1,5 @@
 import datetime
+import random
 from collections import namedtuple, defaultdict
 
 import pytest
@@ -6,7 +7,8 @@ from factories import EmailListFactory, MessageFactory, ThreadFactory
 from mlarchive.archive.thread import (Container, process, build_container,
     count_root_set, find_root, find_root_set, subject_is_reply,
     gather_subjects, prune_empty_containers, sort_thread, compute_thread,
-    gather_siblings, get_in_reply_to, get_references_or_in_reply_to)
+    gather_siblings, get_in_reply_to, get_references_or_in_reply_to,
+    place_message, reconcile_thread, shift_thread_order)
 from mlarchive.archive.models import Message
 
 
@@ -272,6 +274,124 @@ def test_get_references_or_in_reply_to():
     assert get_references_or_in_reply_to(message) == ['001@example.com']
 
 
+def add_thread_message(thread, **kwargs):
+    '''Returns new, unsaved, message in thread'''
+    return MessageFactory.build(email_list=thread.email_list, thread=thread, **kwargs)
+
+
+@pytest.mark.django_db(transaction=True)
+def test_place_message():
+    elist = EmailListFactory.create()
+    thread = ThreadFactory.create(email_list=elist)
+    # new thread
+    message = add_thread_message(thread, msgid='001@example.com', date=datetime.datetime(2016, 1, 1))
+    assert place_message(message) == (message, 0, 0)
+    message.save()
+    # 001
+    #   002
+    #     003
+    #   004
+    MessageFactory.create(email_list=elist, thread=thread, msgid='002@example.com',
+                          references='<001@example.com>', date=datetime.datetime(2016, 1, 2),
+                          thread_order=1, thread_depth=1)
+    MessageFactory.create(email_list=elist, thread=thread, msgid='003@example.com',
+                          references='<001@example.com> <002@example.com>', date=datetime.datetime(2016, 1, 3),
+                          thread_order=2, thread_depth=2)
+    MessageFactory.create(email_list=elist, thread=thread, msgid='004@example.com',
+                          in_reply_to_value='<001@example.com>', date=datetime.datetime(2016, 1, 4),
+                          thread_order=3, thread_depth=1)
+    # reply to 002, goes after 003
+    message = add_thread_message(thread, msgid='005@example.com', date=datetime.datetime(2016, 1, 5),
+                                 references='<001@example.com> <002@example.com>')
+    assert place_message(message) == (message, 2, 3)
+    # references that aren't ancestors
+    message.references = '<004@example.com> <002@example.com>'
+    assert place_message(message) is None
+    # reference not in thread
+    message.references = '<000@example.com> <002@example.com>'
+    assert place_message(message) is None
+    # not the latest
+    message.references = '<002@example.com>'
+    message.date = datetime.datetime(2016, 1, 3, 12)
+    assert place_message(message) is None
+    # referenced by a message in the thread
+    message = add_thread_message(thread, msgid='006@example.com', date=datetime.datetime(2016, 1, 6),
+                                 in_reply_to_value='<003@example.com>')
+    assert place_message(message) == (message, 3, 3)
+    MessageFactory.create(email_list=elist, thread=thread, references='<006@example.com>',
+                          date=datetime.datetime(2016, 1, 5), thread_order=4, thread_depth=1)
+    assert place_message(message) is None
+
+
+@pytest.mark.django_db(transaction=True)
+def test_place_message_compute_thread():
+    '''Message placement matches computing the whole thread'''
+    rand = random.Random(4)
+    elist = EmailListFactory.create()
+    thread = ThreadFactory.create(email_list=elist)
+    messages = []
+    placed = 0
+    for n in range(60):
+        kwargs = {'msgid': '{:03d}@example.com'.format(n),
+                  'date': datetime.datetime(2016, 1, 1) + datetime.timedelta(hours=n),
+                  'subject': 'Re: Topic'}
+        if not messages:
+            # thread started as a reply to a message not in the archive
+            kwargs['references'] = '<other1@example.com> <other2@example.com>'
+        elif rand.random() < 0.95:
+            parent = rand.choice(messages)
+            chain = get_references_or_in_reply_to(parent) + [parent.msgid]
+            choice = rand.random()
+            if choice < 0.5:
+                kwargs['references'] = ' '.join('<{}>'.format(r) for r in chain)
+            elif choice < 0.8:
+                kwargs['in_reply_to_value'] = '<{}>'.format(parent.msgid)
+            elif choice < 0.9:
+                kwargs['references'] = '<missing{}@example.com> <{}>'.format(n, parent.msgid)
+            else:
+                kwargs['date'] = parent.date - datetime.timedelta(minutes=1)
+                kwargs['in_reply_to_value'] = '<{}>'.format(parent.msgid)
+        message = add_thread_message(thread, **kwargs)
+        info = place_message(message)
+        expected = compute_thread(messages + [message])
+        if info is not None:
+            placed += 1
+            assert (info.order, info.depth) == (expected[message.hashcode].order,
+                                                expected[message.hashcode].depth)
+        message.save()
+        messages = sorted(messages + [message], key=lambda m: m.date)
+        reconcile_thread(expected)
+    assert placed > 10
+
+
+@pytest.mark.django_db(transaction=True)
+def test_reconcile_thread():
+    elist = EmailListFactory.create()
+    thread = ThreadFactory.create(email_list=elist)
+    MessageFactory.create(email_list=elist, thread=thread, msgid='001@example.com',
+                          date=datetime.datetime(2016, 1, 1))
+    reply = MessageFactory.create(email_list=elist, thread=thread, msgid='002@example.com',
+                                  references='<001@example.com>', date=datetime.datetime(2016, 1, 2))
+    changed = reconcile_thread(compute_thread(thread))
+    assert [m.pk for m in changed] == [reply.pk]
+    reply.refresh_from_db()
+    assert (reply.thread_order, reply.thread_depth) == (1, 1)
+    assert reconcile_thread(compute_thread(thread)) == []
+
+
+@pytest.mark.django_db(transaction=True)
+def test_shift_thread_order():
+    elist = EmailListFactory.create()
+    thread = ThreadFactory.create(email_list=elist)
+    first = MessageFactory.create(email_list=elist, thread=thread, thread_order=0)
+    second = MessageFactory.create(email_list=elist, thread=thread, thread_order=1, thread_depth=1)
+    third = MessageFactory.create(email_list=elist, thread=thread, thread_order=2, thread_depth=1)
+    message = MessageFactory.create(email_list=elist, thread=thread, thread_order=1, thread_depth=2)
+    assert sorted(shift_thread_order(message)) == [second.pk, third.pk]
+    orders = dict(thread.message_set.values_list('pk', 'thread_order'))
+    assert orders == {first.pk: 0, message.pk: 1, second.pk: 2, third.pk: 3}
+
+
 @pytest.mark.django_db(transaction=True)
 def test_process_corrupt_refs_1():
     '''Scenario: within a thread, one message's reference list gets
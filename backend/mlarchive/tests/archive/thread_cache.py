@@ -0,0 +1,140 @@
+import datetime
+import pytest
+
+from django.core.cache.backends.locmem import LocMemCache
+
+from mlarchive.archive import mail, thread_cache as thread_cache_module
+from mlarchive.archive.mail import archive_message
+from mlarchive.archive.models import Message
+from mlarchive.archive.thread_cache import LRUCache, ThreadCache
+from factories import EmailListFactory, MessageFactory, ThreadFactory
+
+
+REPLY_MESSAGE_BYTES = b'''From: Joe <joe@example.com>
+To: Joe <joe@example.com>
+Date: Thu, 7 Nov 2013 17:54:55 +0000
+Message-ID: <0000000003@example.com>
+In-Reply-To: <001@example.com>
+References: <000@example.com> <001@example.com>
+Content-Type: text/plain; charset="us-ascii"
+Subject: Re: This is a test
+
+Hello,
+
+This is a test email.  database
+'''
+
+
+def test_LRUCache():
+    lru = LRUCache(2)
+    lru.set('a', 1)
+    lru.set('b', 2)
+    assert lru.get('a') == 1
+    lru.set('c', 3)
+    # b was least recently used
+    assert 'b' not in lru
+    assert lru.get('a') == 1
+    assert lru.get('c') == 3
+    assert len(lru) == 2
+
+
+@pytest.mark.django_db(transaction=True)
+def test_ThreadCache_get_messages():
+    public = EmailListFactory.create(name='public')
+    other = EmailListFactory.create(name='other')
+    message = MessageFactory.create(email_list=public, msgid='001@example.com')
+    MessageFactory.create(email_list=public, msgid='002@example.com')
+    MessageFactory.create(email_list=public, msgid='002@example.com')
+    MessageFactory.create(email_list=other, msgid='003@example.com')
+    tc = ThreadCache()
+    msgids = ['001@example.com', '002@example.com', '003@example.com']
+    # disabled, nothing cached
+    assert tc.get_messages(public, msgids) == {'001@example.com': (message.thread_id, message.pk)}
+    assert len(tc.msgids) == 0
+    tc.enable()
+    assert tc.get_messages(public, msgids) == {'001@example.com': (message.thread_id, message.pk)}
+    assert len(tc.msgids) == 1
+    Message.objects.filter(pk=message.pk).update(msgid='changed@example.com')
+    assert tc.get_messages(public, msgids) == {'001@example.com': (message.thread_id, message.pk)}
+
+
+@pytest.mark.django_db(transaction=True)
+def test_ThreadCache_get_subject_thread_id():
+    public = EmailListFactory.create(name='public')
+    thread1 = ThreadFactory.create()
+    thread2 = ThreadFactory.create()
+    MessageFactory.create(email_list=public, thread=thread1, base_subject='Topic',
+                          date=datetime.datetime(2016, 1, 1))
+    latest = MessageFactory.create(email_list=public, thread=thread2, base_subject='Topic',
+                                   date=datetime.datetime(2016, 1, 3))
+    tc = ThreadCache()
+    tc.enable()
+    assert tc.get_subject_thread_id(public, 'Other', datetime.datetime(2016, 1, 4)) is None
+    assert tc.get_subject_thread_id(public, 'Topic', datetime.datetime(2016, 1, 4)) == thread2.pk
+    assert tc.subjects.get((public.pk, 'Topic')) == (latest.date, thread2.pk)
+    # out of order
+    assert tc.get_subject_thread_id(public, 'Topic', datetime.datetime(2016, 1, 2)) == thread1.pk
+    assert tc.get_subject_thread_id(public, 'Topic', datetime.datetime(2016, 1, 1)) is None
+
+    # archived message updates the entry
+    message = MessageFactory.create(email_list=public, base_subject='Topic',
+                                    date=datetime.datetime(2016, 1, 5))
+    tc.add(message)
+    assert tc.get_subject_thread_id(public, 'Topic', datetime.datetime(2016, 1, 6)) == message.thread_id
+    assert tc.msgids.get((public.pk, message.msgid)) == (message.thread_id, message.pk)
+    tc.remove(message)
+    assert (public.pk, message.msgid) not in tc.msgids
+    assert (public.pk, 'Topic') not in tc.subjects
+
+
+def test_ThreadCache_sync(monkeypatch):
+    monkeypatch.setattr(thread_cache_module, 'cache', LocMemCache('thread_cache', {}))
+    tc = ThreadCache()
+    tc.enable()
+    tc.msgids.set((1, '001@example.com'), (1, 1))
+    tc.sync()
+    assert len(tc.msgids) == 1
+    # message deleted by another process
+    thread_cache_module.increment_generation()
+    tc.sync()
+    assert len(tc.msgids) == 0
+
+
+@pytest.mark.django_db(transaction=True)
+def test_defer_generation(monkeypatch):
+    cache = LocMemCache('thread_cache', {})
+    monkeypatch.setattr(thread_cache_module, 'cache', cache)
+    acme = EmailListFactory.create(name='acme')
+    for n in range(3):
+        MessageFactory.create(email_list=acme, hashcode='defer{}='.format(n))
+    Message.objects.first().delete()
+    assert cache.get(thread_cache_module.GENERATION_KEY) == 1
+    # once for a bulk delete
+    with thread_cache_module.defer_generation():
+        with thread_cache_module.defer_generation():
+            Message.objects.all().delete()
+        assert cache.get(thread_cache_module.GENERATION_KEY) == 1
+    assert cache.get(thread_cache_module.GENERATION_KEY) == 2
+    with thread_cache_module.defer_generation():
+        pass
+    assert cache.get(thread_cache_module.GENERATION_KEY) == 2
+
+
+@pytest.mark.django_db(transaction=True)
+def test_thread_cache_archive_message(monkeypatch):
+    tc = ThreadCache()
+    tc.enable()
+    monkeypatch.setattr(mail, 'thread_cache', tc)
+    acme = EmailListFactory.create(name='acme')
+    parent = MessageFactory.create(email_list=acme, msgid='001@example.com',
+                                   date=datetime.datetime(2013, 11, 1))
+    assert archive_message(REPLY_MESSAGE_BYTES, 'acme') == 0
+    message = Message.objects.get(msgid='0000000003@example.com')
+    assert message.thread == parent.thread
+    assert message.in_reply_to == parent
+    assert tc.msgids.get((acme.pk, message.msgid)) == (message.thread_id, message.pk)
+
+    # deleting removes the message from the cache
+    monkeypatch.setattr('mlarchive.archive.signals.thread_cache', tc)
+    message.delete()
+    assert (acme.pk, '0000000003@example.com') not in tc.msgids
@@ -6,11 +6,13 @@ from mock import patch
 import os
 import subprocess   # noqa
 import xml.etree.ElementTree as ET
+from types import SimpleNamespace
 
 from django.conf import settings
 from django.core.cache import cache
 from django.contrib.auth.models import AnonymousUser
-from mlarchive.archive.utils import (get_noauth, get_lists, get_lists_for_user,
+from mlarchive.archive import signals
+from mlarchive.archive.utils import (NOAUTH_KEY, get_noauth, get_lists, get_lists_for_user,
     lookup_user, process_members, get_membership, check_inactive, EmailList,
     create_mbox_file, _get_lists_as_xml)
 from factories import EmailListFactory
@@ -29,8 +31,10 @@ def test_get_noauth():
 
 
 @pytest.mark.django_db(transaction=True)
-def test_get_noauth_updates(settings):
+def test_get_noauth_updates(settings, monkeypatch):
     settings.CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+    # the private field of indexed messages is updated by a task
+    monkeypatch.setattr(signals, 'get_update_task', lambda task_path: SimpleNamespace(delay=lambda *args: None))
     user = UserFactory.create(username='noauth')
     public = EmailListFactory.create(name='public')
     private = EmailListFactory.create(name='private', private=True)
@@ -53,6 +57,43 @@ def test_get_noauth_updates(settings):
     # assert False
 
 
+@pytest.mark.django_db(transaction=True)
+def test_get_noauth_cache(settings, django_assert_num_queries):
+    settings.CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+    user = UserFactory.create(username='noauth')
+    private = EmailListFactory.create(name='private', private=True)
+    EmailListFactory.create(name='private2', private=True)
+    assert get_noauth(user) == ['private', 'private2']
+    with django_assert_num_queries(0):
+        assert get_noauth(user) == ['private', 'private2']
+    # membership changes
+    private.members.add(user)
+    assert get_noauth(user) == ['private2']
+    user.emaillist_set.remove(private)
+    assert get_noauth(user) == ['private', 'private2']
+    private.members.add(user)
+    private.members.clear()
+    assert get_noauth(user) == ['private', 'private2']
+    # anonymous users share an entry
+    assert get_noauth(AnonymousUser()) == ['private', 'private2']
+    with django_assert_num_queries(0):
+        assert get_noauth(AnonymousUser()) == ['private', 'private2']
+
+
+@pytest.mark.django_db(transaction=True)
+def test_get_noauth_cache_stale(settings):
+    settings.CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+    user = UserFactory.create(username='noauth')
+    private = EmailListFactory.create(name='private', private=True)
+    assert get_noauth(user) == ['private']
+    key = NOAUTH_KEY.format(user.pk)
+    generations = cache.get(key)[0]
+    private.members.add(user)
+    # a request that computed the list before the change caches it after
+    cache.set(key, (generations, ['private']))
+    assert get_noauth(user) == []
+
+
 @pytest.mark.django_db(transaction=True)
 def test_get_lists():
     EmailListFactory.create(name='pubone')
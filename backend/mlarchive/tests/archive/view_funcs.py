@@ -4,7 +4,8 @@ import mailbox
 import os
 import pytest
 import tarfile
-from factories import EmailListFactory, UserFactory
+from types import SimpleNamespace
+from factories import EmailListFactory, MessageFactory, UserFactory
 
 from elasticsearch import Elasticsearch
 from elasticsearch_dsl import Search
@@ -12,13 +13,12 @@ from django.conf import settings
 from django.urls import reverse
 from django.utils.encoding import smart_str
 
+from mlarchive.archive import view_funcs
 from mlarchive.archive.view_funcs import (chunks, initialize_formsets, get_columns,
     get_export, get_query_neighbors, apply_objects)
 from mlarchive.archive.models import EmailList
 from mlarchive.utils.test_utils import get_request
 
-from mlarchive.archive.view_funcs import get_message_index
-
 
 def get_search():
     client = Elasticsearch()
@@ -207,9 +207,6 @@ def test_get_query_neighbors(messages):
     assert before == response[2].object
     assert after == response[4].object
     # first message
-    print(search.to_dict())
-    i = get_message_index(search, response[0].object)
-    print('index: {}'.format(i))
     before, after = get_query_neighbors(search, response[0].object)
     assert before is None
     assert after == response[1].object
@@ -221,3 +218,17 @@ def test_get_query_neighbors(messages):
     before, after = get_query_neighbors(search, response[0].object)
     assert before is None
     assert after is None
+
+
+@pytest.mark.django_db(transaction=True)
+def test_apply_objects(django_assert_num_queries, monkeypatch):
+    monkeypatch.setattr(view_funcs, 'APPLY_OBJECTS_CHUNK_SIZE', 2)
+    public = EmailListFactory.create(name='public')
+    messages = [MessageFactory.create(email_list=public) for n in range(3)]
+    hits = [SimpleNamespace(django_id=str(m.pk)) for m in reversed(messages)]
+    hits.append(SimpleNamespace(django_id='0'))
+    with django_assert_num_queries(2):
+        apply_objects(hits)
+        # related objects are loaded
+        assert [h.object.email_list.name for h in hits[:3]] == ['public'] * 3
+    assert [h.object for h in hits] == list(reversed(messages)) + [None]
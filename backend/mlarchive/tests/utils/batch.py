@@ -0,0 +1,40 @@
+import pytest
+
+from celery.signals import task_postrun
+from django.core.signals import request_finished
+
+from mlarchive.utils.batch import BatchBuffer
+
+
+class ListBuffer(BatchBuffer):
+    def __init__(self, delay=60, size=100):
+        super(ListBuffer, self).__init__(delay, size)
+        self.sent = []
+
+    def send(self, items):
+        self.sent.append(items)
+
+
+def test_BatchBuffer_abstract():
+    with pytest.raises(TypeError):
+        BatchBuffer(60, 100)
+
+
+# Django's own request_finished receiver closes database connections
+@pytest.mark.django_db
+def test_BatchBuffer_request_finished():
+    buffer = ListBuffer()
+    buffer.put('a', 1)
+    buffer.put('b', 2)
+    buffer.put('a', 3)
+    assert buffer.sent == []
+    request_finished.send(sender=None)
+    assert buffer.sent == [[('a', 3), ('b', 2)]]
+    assert buffer.timer is None
+
+
+def test_BatchBuffer_task_postrun():
+    buffer = ListBuffer()
+    buffer.put('a', 1)
+    task_postrun.send(sender=None, task_id='1', task=None)
+    assert buffer.sent == [[('a', 1)]]
@@ -0,0 +1,73 @@
+import abc
+import atexit
+import threading
+import weakref
+
+from celery.signals import task_postrun
+from django.core.signals import request_finished
+from django.dispatch import receiver
+
+_buffers = weakref.WeakSet()
+
+
+class BatchBuffer(abc.ABC):
+    '''Collects items by key, a later put() of a key replaces the earlier item, and
+    passes them to send() in one batch, delay seconds after the first pending item
+    or once size items are pending.  With delay 0 items are sent immediately.
+    Subclasses implement send(items), items is a list of (key, item) in the order
+    first put.
+
+    Pending items are also sent at the end of each request and Celery task, see
+    flush_all(), and at exit, so a process that is recycled between requests
+    doesn't lose them.  A process killed while items are pending loses them, the
+    index is reconciled with update_index --age.
+    '''
+    def __init__(self, delay, size):
+        self.delay = delay
+        self.size = size
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.timer = None
+        _buffers.add(self)
+        atexit.register(self.flush)
+
+    def put(self, key, item):
+        with self.lock:
+            self.pending[key] = item
+            count = len(self.pending)
+            if self.delay and count < self.size and self.timer is None:
+                self.timer = threading.Timer(self.delay, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+        if not self.delay or count >= self.size:
+            self.flush()
+
+    def flush(self):
+        '''Send the pending items'''
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+        if pending:
+            self.send(list(pending.items()))
+
+    @abc.abstractmethod
+    def send(self, items):
+        pass
+
+
+def flush_all():
+    '''Send the pending items of all buffers in this process'''
+    for buffer in list(_buffers):
+        buffer.flush()
+
+
+@receiver(request_finished)
+def _request_finished(sender, **kwargs):
+    flush_all()
+
+
+@task_postrun.connect
+def _task_postrun(sender=None, **kwargs):
+    flush_all()